@@ -0,0 +1,113 @@
+# archiveindex.py - persistent index of the archives games are imported from
+#
+# For every archive unpacked while the index is in use, it records the
+# members with their sizes and timestamps and the game's executable.
+# Archives are identified by a hash of their contents. Sources (URLs and
+# local files) refer to those. A local file is only looked up again while
+# its size and modification time are unchanged.
+#
+# With the index a build can be planned without downloading or unpacking
+# anything: the members are then returned with stand-ins for their data
+# which only know their size.
+
+import os, json, hashlib, struct, tempfile
+
+INDEX_VERSION = 2
+
+def content_hash(members):
+    # hash of the unpacked contents, so a game is the same no matter where
+    # it has been fetched from
+    h = hashlib.sha1()
+    for filename, dt, data in members:
+        name = filename.encode("utf-8")
+        h.update(struct.pack(">H6HL", len(name), *dt, len(data)) + name)
+        h.update(data)
+
+    return h.hexdigest()
+
+class IndexedData:
+    # stands in for the contents of an archive member that hasn't been read
+    __slots__ = ( "size", )
+
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+class ArchiveIndex:
+    def __init__(self, path):
+        self.path = path
+        self.archives = { }     # content hash -> record
+        self.sources = { }      # source -> content hash and file stats
+        self.changed = False
+
+        try:
+            with open(self.path, "r") as f:
+                index = json.load(f)
+            if index.get("version") == INDEX_VERSION:
+                self.archives = index["archives"]
+                self.sources = index["sources"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def source_key(self, src):
+        # local files are stored by their absolute path along with their
+        # size and modification time
+        if src.lower().startswith("http://") or src.lower().startswith("https://"):
+            return src, None
+
+        try:
+            st = os.stat(src)
+        except OSError:
+            return None, None
+
+        return os.path.abspath(src), [ st.st_size, st.st_mtime_ns ]
+
+    def lookup(self, src):
+        # return the record of the archive a source refers to or None
+        key, stats = self.source_key(src)
+        entry = self.sources.get(key)
+        if not entry or entry["stats"] != stats: return None
+        return self.archives.get(entry["hash"])
+
+    def members(self, src):
+        # return the members of an indexed archive without their data
+        record = self.lookup(src)
+        if not record: return None
+        return [ (filename, tuple(dt), IndexedData(size)) for filename, dt, size in record["members"] ]
+
+    def add(self, src, members, executable):
+        # record the members of an unpacked archive and its executable
+        if members == None or any(isinstance(data, IndexedData) for _, _, data in members):
+            return
+
+        key, stats = self.source_key(src)
+        if not key: return
+
+        digest = content_hash(members)
+        source = { "hash": digest, "stats": stats }
+        if self.sources.get(key) == source and digest in self.archives:
+            return
+
+        self.archives[digest] = {
+            "members": [ [ filename, list(dt), len(data) ] for filename, dt, data in members ],
+            "executable": executable }
+        self.sources[key] = source
+        self.changed = True
+
+    def save(self):
+        if not self.changed: return
+
+        # replace the index atomically, so concurrent runs never see a
+        # partially written one
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({ "version": INDEX_VERSION, "archives": self.archives, "sources": self.sources }, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print("Unable to save archive index:", str(e))
+            return
+
+        self.changed = False
@@ -1,13 +1,19 @@
+import re, struct
+
 BOOTLOADER = [ {
 "name":"AHDI", "file": "SHDRIVER.SYS",
 
+# the patches are made for AHDI 6.061 only. They are applied at fixed
+# offsets and only if all sites contain the bytes expected there, other
+# versions are left unpatched
 "patchdesc": "ACSI #0 only",
-"patch": [ (0x28, 0xF0, 0xF0), (0x29, 0xAD, 0xAD),  # check for pattern 
-           # test ACSI #0 only
-           (0x62, 0x00, 0xFF), (0x63, 0xFF, 0x01), (0x64, 0xFF, 0x00), (0x65, 0x01, 0x00),
-           # skip inquiry call as it's very slow
-           (0x2c50, 0x61, 0x4e), (0x2c51, 0x00, 0x71), (0x2c52, 0xf2, 0x4e), (0x2c53, 0xd2, 0x71)
-          ],  
+"patches": [ # check for pattern
+             { "desc": "AHDI 6.061", "offset": 0x28, "find": b"\xf0\xad", "replace": b"\xf0\xad" },
+             # test ACSI #0 only
+             { "desc": "ACSI #0 only", "offset": 0x62, "find": b"\x00\xff\xff\x01", "replace": b"\xff\x01\x00\x00" },
+             # skip inquiry call as it's very slow
+             { "desc": "skip inquiry", "offset": 0x2c50, "find": b"\x61\x00\xf2\xd2", "replace": b"\x4e\x71\x4e\x71" }
+           ],
 
 # hexdump of the AHDI bootloader in the MBR
 "mbr":"""
@@ -129,3 +135,50 @@ BOOTLOADER = [ {
 }
 
               ]
+
+# HDDriver and CBHD are started by the AHDI bootloader if they are named
+# SHDRIVER.SYS. They are recognized by a signature in the program's text
+# and data segments and don't need any patches
+for name, signature in [ ("HDDriver", rb"HDDRIVER|HDDriver"), ("CBHD", rb"CBHD") ]:
+    BOOTLOADER.append( { "name": name, "file": "SHDRIVER.SYS", "signature": signature,
+                         "mbr": BOOTLOADER[0]["mbr"], "bootsector": BOOTLOADER[0]["bootsector"] } )
+
+# file names the bootloaders load drivers from
+FILES = set(d["file"] for d in BOOTLOADER)
+
+# GEMDOS program header: magic, length of text, data and bss segment, ...
+PRG_MAGIC = b"\x60\x1a"
+PRG_HEADER = 28
+
+def identify(name, data):
+    # return the registry entry of a driver file or None if this isn't
+    # one the bootloaders can load. Drivers without a signature are the
+    # default for their file name
+    candidates = [ d for d in BOOTLOADER if d["file"] == name ]
+    driver = next((d for d in candidates if not "signature" in d), None)
+
+    # scan the text and data segments of a GEMDOS program for the
+    # signatures of all candidates at once. The symbol table and anything
+    # appended to the program isn't searched
+    signatures = [ (i, d) for i, d in enumerate(candidates) if "signature" in d ]
+    if signatures and len(data) >= PRG_HEADER and data[:2] == PRG_MAGIC:
+        text, dta = struct.unpack(">LL", data[2:10])
+        regex = re.compile(b"|".join(b"(?P<d%d>%s)" % (i, d["signature"]) for i, d in signatures))
+        m = regex.search(data, PRG_HEADER, PRG_HEADER+text+dta)
+        if m: driver = candidates[int(m.lastgroup[1:])]
+
+    return driver
+
+def patch(driver, data):
+    # return a patched copy of the driver or None if any patch site
+    # doesn't contain the expected bytes. Nothing is patched in that case
+    for p in driver["patches"]:
+        if data[p["offset"]:p["offset"]+len(p["find"])] != p["find"]:
+            print("Patch failed:", p["desc"], "not found at offset", hex(p["offset"]))
+            return None
+
+    data = bytearray(data)
+    for p in driver["patches"]:
+        data[p["offset"]:p["offset"]+len(p["replace"])] = p["replace"]
+
+    return data
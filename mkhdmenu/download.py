@@ -0,0 +1,187 @@
+# download.py - HTTP(S) downloads over persistent connections
+#
+# The archives of a config typically all come from the same server. The
+# connections are thus kept open and reused for further downloads from the
+# same host. Interrupted downloads are resumed using range requests instead
+# of being restarted from the beginning.
+
+import threading, http.client, urllib.parse, urllib.request
+from io import BytesIO
+
+CHUNK_SIZE = 65536
+MAX_REDIRECTS = 5
+USER_AGENT = "mkhdmenu"
+
+class ConnectionPool:
+    # idle keep-alive connections by scheme and host
+    def __init__(self, max_idle=8, timeout=30):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = { }
+        self.lock = threading.Lock()
+
+    def get(self, scheme, host):
+        # return a connection and whether it has been used before
+        with self.lock:
+            conns = self.idle.get((scheme, host))
+            if conns: return conns.pop(), True
+
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=self.timeout), False
+        return http.client.HTTPConnection(host, timeout=self.timeout), False
+
+    def put(self, scheme, host, conn):
+        with self.lock:
+            conns = self.idle.setdefault((scheme, host), [ ])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns: conn.close()
+            self.idle = { }
+
+pool = ConnectionPool()
+
+def request(url, headers):
+    # send a GET request over a pooled connection. The server may have closed
+    # an idle connection meanwhile, so a reused one is retried once on a fresh
+    # connection
+    u = urllib.parse.urlsplit(url)
+    path = (u.path or "/") + ("?" + u.query if u.query else "")
+
+    while True:
+        conn, reused = pool.get(u.scheme, u.netloc)
+        try:
+            conn.request("GET", path, headers=headers)
+            return conn, conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            if not reused: raise
+
+def release(url, conn, response):
+    # hand a connection whose response has been read completely back to the pool
+    u = urllib.parse.urlsplit(url)
+    if response.will_close: conn.close()
+    else:                   pool.put(u.scheme, u.netloc, conn)
+
+def content_range_start(response):
+    # Content-Range: bytes 1000-1999/2000
+    try:
+        return int(response.getheader("Content-Range", "").split()[1].split("-")[0])
+    except (IndexError, ValueError):
+        return None
+
+def use_proxy(url):
+    u = urllib.parse.urlsplit(url)
+    return u.scheme in urllib.request.getproxies() and not urllib.request.proxy_bypass(u.hostname or "")
+
+def download_via_proxy(url, f):
+    # proxies are left to urllib, without connection reuse and resume
+    with urllib.request.urlopen(urllib.request.Request(url, headers={ "User-Agent": USER_AGENT })) as response:
+        if response.getcode() != 200:
+            print("Download failed with code", response.getcode())
+            return None
+
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+            f.write(chunk)
+
+    f.seek(0)
+    return f
+
+def download(url, f=None, retries=3):
+    # stream the body of url into the file object f, a BytesIO by default.
+    # Returns f positioned at its start or None if the download failed
+    if f == None: f = BytesIO()
+
+    try:
+        if use_proxy(url): return download_via_proxy(url, f)
+    except Exception as e:
+        print("Download of", url, "failed:", str(e))
+        return None
+
+    received = 0
+    validator = None
+    redirects = 0
+    failures = 0
+
+    while True:
+        headers = { "User-Agent": USER_AGENT, "Accept-Encoding": "identity" }
+        if received:
+            # continue where the last attempt stopped, but only if the
+            # file on the server hasn't changed meanwhile
+            headers["Range"] = "bytes=" + str(received) + "-"
+            if validator: headers["If-Range"] = validator
+
+        try:
+            conn, response = request(url, headers)
+        except (http.client.HTTPException, OSError) as e:
+            failures += 1
+            if failures > retries:
+                print("Download of", url, "failed:", str(e))
+                return None
+            continue
+
+        if response.status in [ 301, 302, 303, 307, 308 ]:
+            location = response.getheader("Location")
+            response.read()
+            release(url, conn, response)
+
+            redirects += 1
+            if not location or redirects > MAX_REDIRECTS:
+                print("Download of", url, "failed: Too many redirects")
+                return None
+
+            url = urllib.parse.urljoin(url, location)
+            received = 0
+            f.seek(0)
+            f.truncate()
+            continue
+
+        if response.status == 206 and received and content_range_start(response) == received:
+            pass
+        elif response.status == 200:
+            # a full response, either to the first request or because the
+            # server doesn't support ranges or the file has changed
+            if received:
+                f.seek(0)
+                f.truncate()
+                received = 0
+            validator = response.getheader("ETag") or response.getheader("Last-Modified")
+        else:
+            print("Download failed with code", response.status)
+            conn.close()
+            return None
+
+        try:
+            # http.client doesn't complain if the connection is closed
+            # before Content-Length bytes have been received
+            length = response.length
+            start = received
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk: break
+                f.write(chunk)
+                received += len(chunk)
+                if length != None: length -= len(chunk)
+
+            if length: raise http.client.IncompleteRead(b"", length)
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+
+            # only give up if several attempts in a row made no progress
+            failures = failures + 1 if received == start else 1
+            if failures > retries:
+                print("Download of", url, "failed:", str(e))
+                return None
+
+            print("Resuming download of", url, "at", received, "bytes")
+            continue
+
+        release(url, conn, response)
+        f.seek(0)
+        return f
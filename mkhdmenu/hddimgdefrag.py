@@ -0,0 +1,336 @@
+# hddimgdefrag.py - make all files of an Atari ST harddisk image contiguous in place
+#
+# By default only fragmented files are being moved, each one into the first
+# area large enough to hold it, moving as few other files out of the way as
+# possible if there's none. Alternatively all files are being packed to
+# the start of the partition in the order they are needed when booting:
+# drivers, the AUTO folder, accessories and the desktop first and the other
+# files in directory order behind them.
+#
+# The target of every cluster is planned first. The plan is then carried
+# out in rounds and clusters are only ever copied to free clusters: the
+# copies are written and allocated, the chains and directory entries are
+# switched over to them and only then the old clusters are freed. The image
+# is synced after each step, so an interrupted run leaves at most some lost
+# clusters behind, but never a damaged file. Clusters waiting for their
+# target to be freed, e.g. in cycles, are parked in spare free clusters.
+
+import os, sys, struct
+
+from hddimgreader import SectorImage, partition_entries, cluster_chain, FAT_BAD
+from hddimgresize import is_plain, check_partition, copy_sectors, used_clusters, BLOCK
+
+DEFRAG_MODES = ( "min", "boot" )
+
+def sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+def scan_directories(f, start, fs):
+    # return all files and directories occupying clusters, parents first.
+    # Each item knows the slot of its directory entry, so the start cluster
+    # can be updated without walking the whole tree again
+    items = [ ]
+
+    def scan(parent, path):
+        if parent:
+            data = b"".join(read_cluster(f, start, fs, c) for c in cluster_chain(fs["fat"], parent["start"]))
+        else:
+            f.seek(512*(start+fs["root"]))
+            data = f.read(512*(fs["ndirs"]//16))
+
+        for slot in range(len(data)//32):
+            entry = data[32*slot:32*slot+32]
+            if entry[0] == 0: break
+            attr = entry[11]
+            if entry[0] == 0xe5 or attr == 0x0f or attr & 0x08 or entry[0] == ord("."): continue
+
+            name = entry[0:8].decode("latin-1").rstrip()
+            if entry[8:11].rstrip(): name += "." + entry[8:11].decode("latin-1").rstrip()
+
+            item = { "path": path + name, "start": struct.unpack("<H", entry[26:28])[0],
+                     "dir": bool(attr & 0x10), "parent": parent, "slot": slot, "subdirs": [ ] }
+            if item["start"] < 2: continue
+
+            items.append(item)
+            if item["dir"]:
+                if parent: parent["subdirs"].append(item)
+                scan(item, item["path"] + "\\")
+
+    scan(None, "")
+    return items
+
+def read_cluster(f, start, fs, cluster):
+    f.seek(512*(start+fs["data"]+fs["spc"]*(cluster-2)))
+    return f.read(512*fs["spc"])
+
+def is_fragmented(clusters):
+    return any(clusters[i+1] != clusters[i]+1 for i in range(len(clusters)-1))
+
+def boot_priority(item):
+    # drivers are loaded first, then the AUTO folder is run and finally
+    # the accessories and the desktop are loaded
+    path = item["path"]
+    if "\\" not in path and path.endswith(".SYS"): return 0
+    if path == "AUTO" or path.startswith("AUTO\\"): return 1
+    if "\\" not in path and path.endswith((".ACC", ".INF")): return 2
+    return 3
+
+def write_fat(f, start, fs, clusters):
+    # write only those sectors of all FATs containing the given entries
+    fat = fs["fat"]
+    for s in sorted(set(c//256 for c in clusters)):
+        data = fat[256*s:256*s+256]
+        if sys.byteorder != "little": data.byteswap()
+        for n in range(fs["nfats"]):
+            f.seek(512*(start+fs["res"]+n*fs["spf"]+s))
+            f.write(data.tobytes())
+
+def set_entry(f, start, fs, parent, slot, cluster):
+    # set the start cluster of the entry in the given directory slot
+    if parent:
+        per_cluster = 16*fs["spc"]
+        c = list(cluster_chain(fs["fat"], parent["start"]))[slot // per_cluster]
+        sector = start+fs["data"]+fs["spc"]*(c-2) + (slot % per_cluster)//16
+    else:
+        sector = start+fs["root"] + slot//16
+
+    f.seek(512*sector + 32*(slot%16) + 26)
+    f.write(struct.pack("<H", cluster))
+
+def copy_runs(f, data, spc, moves):
+    # copy clusters in runs contiguous at both ends
+    run = [ ]
+
+    def flush():
+        if run: copy_sectors(f, data+spc*(run[0]-2), data+spc*(run[1]-2), spc*run[2])
+
+    for c, n in sorted(moves.items()):
+        if run and c == run[0]+run[2] and n == run[1]+run[2] and spc*(run[2]+1) <= BLOCK:
+            run[2] += 1
+        else:
+            flush()
+            run = [ c, n, 1 ]
+    flush()
+
+def move_round(f, start, fs, items, moves):
+    # move clusters to free clusters. Every step leaves a consistent file
+    # system behind: the old clusters are only freed once nothing refers to
+    # them anymore
+    fat = fs["fat"]
+
+    # copy the data and allocate the copies. Nothing refers to them yet
+    copy_runs(f, start+fs["data"], fs["spc"], moves)
+    for c, n in moves.items():
+        fat[n] = moves.get(fat[c], fat[c])
+    write_fat(f, start, fs, moves.values())
+    sync(f)
+
+    # let the chains continue in the copies ...
+    targets = set(moves.values())
+    relinked = [ c for c in range(2, len(fat)) if fat[c] in moves and c not in targets ]
+    for c in relinked: fat[c] = moves[fat[c]]
+    write_fat(f, start, fs, relinked)
+
+    # ... and let the directory entries point to them, incl. '.' and '..'
+    moved = [ i for i in items if i["start"] in moves ]
+    for i in moved: i["start"] = moves[i["start"]]
+    for i in moved:
+        set_entry(f, start, fs, i["parent"], i["slot"], i["start"])
+        if i["dir"]:
+            set_entry(f, start, fs, i, 0, i["start"])
+            for d in i["subdirs"]: set_entry(f, start, fs, d, 1, i["start"])
+    sync(f)
+
+    # finally free the old clusters
+    for c in moves: fat[c] = 0
+    write_fat(f, start, fs, moves.keys())
+    sync(f)
+
+def move_clusters(f, start, fs, items, moves, limit):
+    # carry out the plan. Each round moves all clusters whose target is
+    # free. Clusters waiting for others are parked in spare clusters, the
+    # nearest to a free target first, so long chains take a few rounds only
+    # and cycles are broken up. Returns the number of clusters not moved
+    fat = fs["fat"]
+    pending = dict(moves)
+
+    while pending:
+        ready = { c: n for c, n in pending.items() if not fat[n] }
+
+        # order the waiting clusters by the round they'd become ready in,
+        # followed by the cycles. Parking only pays off for clusters other
+        # clusters are waiting for
+        source = { n: c for c, n in pending.items() }
+        order = [ ]
+        level = [ source[c] for c in ready if c in source ]
+        while level:
+            order += level
+            level = [ source[c] for c in level if c in source ]
+        seen = set(ready) | set(order)
+        for c in pending:
+            while not c in seen:
+                seen.add(c)
+                order.append(c)
+                c = source[c]
+
+        targets = set(pending.values())
+        spare = ( c for c in range(2, limit) if not fat[c] and not c in targets )
+        parked = { }
+        for c in order:
+            if not c in source: continue
+            s = next(spare, None)
+            if s == None: break
+            parked[c] = s
+
+        if not ready and not parked: break
+
+        move_round(f, start, fs, items, { **ready, **parked })
+        for c in ready: del pending[c]
+        for c, s in parked.items(): pending[s] = pending.pop(c)
+
+    return len(pending)
+
+def free_run(taken, count, limit):
+    # return the first cluster of the first run of count free clusters
+    run = 0
+    for c in range(2, limit):
+        run = run+1 if not taken[c] else 0
+        if run == count: return c-count+1
+    return None
+
+def plan_boot(fat, items, limit):
+    # pack all files to the front in boot order. Lost clusters are kept
+    # behind them
+    slots = ( c for c in range(2, limit) if fat[c] != FAT_BAD )
+    targets = { }
+    for item in sorted(items, key=boot_priority):
+        for c in cluster_chain(fat, item["start"]): targets[c] = next(slots)
+    for c in used_clusters(fat):
+        if not c in targets: targets[c] = next(slots)
+
+    return { c: n for c, n in targets.items() if c != n }, [ ]
+
+def best_window(taken, count, limit):
+    # return the start of the run of count clusters with the fewest clusters
+    # of other files to be moved out of the way or None
+    best = None
+    fixed = blockers = 0
+    for c in range(2, limit):
+        fixed += taken[c] == 1
+        blockers += taken[c] == 2
+        if c >= count+2:
+            fixed -= taken[c-count] == 1
+            blockers -= taken[c-count] == 2
+        if c >= count+1 and not fixed and (best == None or blockers < best[0]):
+            best = (blockers, c-count+1)
+
+    return best[1] if best else None
+
+def plan_min(fat, items, limit):
+    # move only fragmented files, each into the first run of clusters that
+    # are free or occupied by fragmented files themselves. If there's no
+    # such run, the unfragmented files in the way are moved elsewhere. Files
+    # which cannot be placed at all stay where they are and the plan is
+    # made again without them
+    files = [ (i, list(cluster_chain(fat, i["start"]))) for i in items ]
+    fragmented = [ n for n, (i, clusters) in enumerate(files) if is_fragmented(clusters) ]
+    stuck = [ ]
+
+    while True:
+        # clusters are free (0), fixed (1) or belong to a file which may
+        # still be moved out of the way (2)
+        taken = bytearray(1 if fat[c] else 0 for c in range(limit))
+        owner = { }
+        for n, (item, clusters) in enumerate(files):
+            for c in clusters:
+                if not n in fragmented: taken[c], owner[c] = 2, n
+                elif not n in stuck:    taken[c] = 0
+
+        moves = { }
+        def place(n, pos):
+            for i, c in enumerate(files[n][1]):
+                taken[pos+i] = 1
+                if c != pos+i: moves[c] = pos+i
+
+        for n in fragmented:
+            if n in stuck: continue
+            count = len(files[n][1])
+            pos = free_run(taken, count, limit)
+            if pos != None:
+                place(n, pos)
+                continue
+
+            pos = best_window(taken, count, limit)
+            if pos == None: break
+
+            blockers = sorted(set(owner[c] for c in range(pos, pos+count) if taken[c] == 2))
+            for b in blockers:
+                for c in files[b][1]: taken[c] = 0
+            place(n, pos)
+
+            for b in blockers:
+                p = free_run(taken, len(files[b][1]), limit)
+                if p == None: break
+                place(b, p)
+            else:
+                continue
+            break
+        else:
+            return moves, [ files[n][0] for n in stuck ]
+
+        stuck.append(n)
+
+def defrag_partition(f, start, fs, mode, drive):
+    fat = fs["fat"]
+    limit = min(len(fat), (fs["nsects"]-fs["data"])//fs["spc"] + 2)
+    items = scan_directories(f, start, fs)
+
+    fragmented = sum(1 for i in items if is_fragmented(list(cluster_chain(fat, i["start"]))))
+
+    moves, stuck = (plan_boot if mode == "boot" else plan_min)(fat, items, limit)
+    for item in stuck:
+        print("Warning, no room to defragment", drive+"\\"+item["path"])
+
+    left = move_clusters(f, start, fs, items, moves, limit)
+    if left: print("Warning, no free cluster left to move", left, "clusters on", drive)
+
+    still = sum(1 for i in items if is_fragmented(list(cluster_chain(fat, i["start"]))))
+    print("Partition", drive, "fragmented files:", fragmented, "->", still, "moved clusters:", len(moves)-left)
+    return True
+
+def defrag_image(name, mode, options):
+    print("== defragmenting '"+name+"' ==")
+
+    try:
+        f = open(name, "r+b")
+    except Exception as e:
+        print(str(e))
+        return False
+
+    with f:
+        if not is_plain(f):
+            print("Error, only plain images can be defragmented in place")
+            return False
+
+        img = SectorImage(f)
+        entries = [ e for e in partition_entries(img) if e[1] == b"GEM" ]
+        if not entries:
+            print("Error, no GEM partitions found")
+            return False
+
+        # check all partitions before touching anything
+        parts = [ ]
+        for i, (flags, pid, start, length) in enumerate(entries):
+            drive = chr(ord("C")+i) + ":"
+            fs = check_partition(img, start, length, drive)
+            if not fs: return False
+            parts.append( (start, fs, drive) )
+
+        for start, fs, drive in parts:
+            if not defrag_partition(f, start, fs, mode, drive):
+                return False
+
+        sync(f)
+
+    return True
@@ -0,0 +1,128 @@
+# hddimgdiff.py - compare two Atari ST harddisk images file by file
+#
+# Both images are compared by their partition layout and their directory
+# trees. File contents are compared by hashing the cluster chains directly
+# from the images in parallel, so neither image is loaded into memory.
+
+import hashlib, contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+from hddimgreader import open_image, check_csum, read_layout, chain_extents, iter_extents
+from hddimgfile import gem_partitions, walk, FLAG_DIRECTORY
+
+# bootsector values compared between partitions
+LAYOUT = [ ("nsects", "Total number of sectors"),
+           ("spc",    "Sectors per cluster"),
+           ("res",    "Reserved sectors"),
+           ("nfats",  "Number of FATs"),
+           ("spf",    "Sectors per FAT"),
+           ("ndirs",  "Number of root directory entries") ]
+
+def scan_image(img):
+    # return the parsed partitions and a flat path -> (entry, partition) map
+    partitions = [ read_layout(p) for p in gem_partitions(img) ]
+
+    files = { }
+    for p in range(len(partitions)):
+        drive = chr(ord("C")+p) + ":\\"
+        for path, entry in walk(partitions[p]):
+            if entry.attr & FLAG_DIRECTORY: path += "\\"
+            files[drive+path] = (entry, partitions[p])
+
+    return partitions, files
+
+def hash_file(path, entry, fs):
+    # returns None if the file can't be read, e.g. due to a damaged chain
+    h = hashlib.sha1()
+    try:
+        extents = chain_extents(fs["fat"], entry.cluster)
+        for chunk in iter_extents(extents, entry.size, fs["spc"], fs["sectors"][fs["data"]:]):
+            h.update(chunk)
+    except Exception as e:
+        print("Error reading", path+":", str(e))
+        return None
+    return h.digest()
+
+def diff_layout(img_a, img_b, parts_a, parts_b):
+    diffs = [ ]
+
+    if len(img_a) != len(img_b):
+        diffs.append("Image size in sectors: " + str(len(img_a)) + " -> " + str(len(img_b)))
+
+    if check_csum(img_a[0]) != check_csum(img_b[0]):
+        diffs.append("MBR bootloader " + ("added" if check_csum(img_b[0]) else "removed"))
+
+    for p in range(max(len(parts_a), len(parts_b))):
+        drive = chr(ord("C")+p) + ":"
+        if p >= len(parts_a):
+            diffs.append("Partition " + drive + " added")
+        elif p >= len(parts_b):
+            diffs.append("Partition " + drive + " removed")
+        else:
+            for key, desc in LAYOUT:
+                if parts_a[p][key] != parts_b[p][key]:
+                    diffs.append("Partition " + drive + " " + desc + ": " + str(parts_a[p][key]) + " -> " + str(parts_b[p][key]))
+
+            if parts_a[p]["sectors"][0] != parts_b[p]["sectors"][0] and check_csum(parts_a[p]["sectors"][0]) != check_csum(parts_b[p]["sectors"][0]):
+                diffs.append("Partition " + drive + " bootloader " + ("added" if check_csum(parts_b[p]["sectors"][0]) else "removed"))
+
+    return diffs
+
+def diff_images(name_a, name_b, workers=None):
+    # returns the number of differences or None on error. Both images are
+    # closed again whatever happens while comparing them
+    with contextlib.ExitStack() as stack:
+        images = [ ]
+        for name in ( name_a, name_b ):
+            img = open_image(name)
+            if not img: return None
+            stack.callback(img.close)
+            images.append(img)
+
+        return compare_images(*images, workers)
+
+def compare_images(img_a, img_b, workers=None):
+    try:
+        parts_a, files_a = scan_image(img_a)
+        parts_b, files_b = scan_image(img_b)
+    except Exception as e:
+        print("Error scanning images:", str(e))
+        return None
+
+    print("== Layout ==")
+    layout = diff_layout(img_a, img_b, parts_a, parts_b)
+    for d in layout: print(d)
+
+    added = [ p for p in files_b if not p in files_a ]
+    removed = [ p for p in files_a if not p in files_b ]
+
+    # files of different size have changed for sure, only files of the
+    # same size need to be hashed
+    common = [ p for p in files_b if p in files_a and not p.endswith("\\") ]
+    candidates = [ p for p in common if files_a[p][0].size == files_b[p][0].size ]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hashes_a = pool.map(lambda p: hash_file(p, *files_a[p]), candidates)
+        hashes_b = pool.map(lambda p: hash_file(p, *files_b[p]), candidates)
+
+        # unreadable files are reported as changed
+        same = set(p for p, a, b in zip(candidates, hashes_a, hashes_b) if a != None and a == b)
+
+    changed = [ p for p in common if not p in same ]
+    touched = [ p for p in same if (files_a[p][0].time, files_a[p][0].date, files_a[p][0].attr) != 
+                                   (files_b[p][0].time, files_b[p][0].date, files_b[p][0].attr) ]
+
+    print("== Files ==")
+    for path in sorted(added):   print("+", path)
+    for path in sorted(removed): print("-", path)
+    for path in sorted(changed): print("*", path)
+    for path in sorted(touched): print("~", path, "(timestamp/attributes only)")
+
+    print("== Summary ==")
+    print("Layout differences:              ", len(layout))
+    print("Added files/directories:         ", len(added))
+    print("Removed files/directories:       ", len(removed))
+    print("Changed files:                   ", len(changed))
+    print("Changed timestamps/attributes:   ", len(touched))
+
+    return len(layout) + len(added) + len(removed) + len(changed) + len(touched)
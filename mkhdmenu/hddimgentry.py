@@ -0,0 +1,30 @@
+# hddimgentry.py - the entries of the file trees of all partitions
+#
+# Images may contain tens of thousands of files and several images may be
+# built at once, so the entries use __slots__ instead of dicts. Directories
+# have a list of entries in subdir, files have their contents in data. The
+# reader additionally sets the attributes, start cluster and size as found
+# in the directory entry.
+
+class Entry:
+    __slots__ = ( "name", "time", "date", "data", "subdir", "attr", "cluster", "size" )
+
+    def __init__(self, name, time=0, date=0, data=None, subdir=None, attr=0, cluster=0, size=0):
+        self.name = name
+        self.time = time
+        self.date = date
+        self.data = data
+        self.subdir = subdir
+        self.attr = attr
+        self.cluster = cluster
+        self.size = size
+
+    def __repr__(self):
+        kind = "dir" if self.subdir != None else "file"
+        return "<Entry " + kind + " " + self.name + ">"
+
+def tree_signature(files):
+    # a snapshot of a file tree which compares equal to one taken later
+    # unless entries have been added, replaced or renamed in the meantime.
+    # Contents read from an image only compare equal to themselves
+    return [ (f.name, f.time, f.date, f.data if f.subdir == None else tree_signature(f.subdir)) for f in files ]
@@ -0,0 +1,149 @@
+# hddimgextract.py - extract the files of an Atari ST harddisk image to the host
+#
+# The image is not loaded into memory. Only the FATs and directories are being
+# parsed and the contents of each file is then streamed from its cluster chain
+# either into a host directory or into a tar archive.
+
+import os, sys, datetime, tarfile, contextlib
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+from hddimgreader import open_image, hdd_img_parse, partitions_parse, iter_data
+
+def fat_timestamp(time, date):
+    # FAT timestamps are stored in UTC by mkhdmenu
+    try:
+        dt = datetime.datetime(1980+((date>>9)&0x7f), (date>>5)&0x0f, date&0x1f,
+                               (time>>11)&0x1f, (time>>5)&0x3f, 2*(time&0x1f), tzinfo=datetime.timezone.utc)
+        return dt.timestamp()
+    except ValueError:
+        return None
+
+def safe_name(name):
+    # names are taken from the image as they are and must neither contain
+    # path separators nor refer to the current or parent directory
+    return name not in ( "", ".", ".." ) and not any(c in name for c in "/\\:\0")
+
+def walk(fs, path):
+    # yield (path, entry) for all directories and files, parents first.
+    # Entries with unsafe names are skipped incl. their contents
+    for f in fs:
+        if not safe_name(f.name):
+            print("Warning, skipping unsafe name", repr(f.name), "in", path)
+            continue
+
+        name = path + "/" + f.name if path else f.name
+        yield name, f
+        if f.subdir != None:
+            yield from walk(f.subdir, name)
+
+def list_partitions(name, options):
+    img = open_image(name)
+    if not img: return None, None
+
+    hdd = hdd_img_parse(img, options)
+    if not hdd:
+        img.close()
+        return None, None
+
+    partitions = partitions_parse(hdd, options, False)
+    if not partitions:
+        img.close()
+        return None, None
+
+    # partitions are named like the drives they show up as on the ST
+    items = [ ]
+    for p in range(len(partitions)):
+        for path, f in walk(partitions[p]["fs"], chr(ord("C")+p)):
+            items.append( (path, f, partitions[p]) )
+
+    return img, items
+
+def extract_file(path, f, part):
+    with open(path, "wb") as out:
+        for chunk in iter_data(f.cluster, f.size, part["fat"], part["data"]):
+            out.write(chunk)
+
+    ts = fat_timestamp(f.time, f.date)
+    if ts != None: os.utime(path, (ts, ts))
+
+def host_path(dst, path):
+    # never write outside dst, e.g. through symlinks already in place
+    root = os.path.realpath(dst)
+    target = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([ root, target ]) != root:
+        raise ValueError("'"+path+"' would be extracted outside of '"+dst+"'")
+    return target
+
+def extract_to_directory(items, dst, workers):
+    # create the directory tree first incl. the drives holding files only ...
+    for path, f, part in items:
+        os.makedirs(host_path(dst, path if f.subdir != None else os.path.dirname(path)), exist_ok=True)
+
+    # ... then stream all files in parallel ...
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = [ pool.submit(extract_file, host_path(dst, path), f, part) for path, f, part in items if f.subdir == None ]
+        for job in jobs: job.result()
+
+    # ... and finally restore the directory timestamps which were
+    # changed by creating the files. Deepest directories first
+    for path, f, part in reversed(items):
+        if f.subdir != None:
+            ts = fat_timestamp(f.time, f.date)
+            if ts != None: os.utime(host_path(dst, path), (ts, ts))
+
+def read_file(f, part):
+    return b"".join(iter_data(f.cluster, f.size, part["fat"], part["data"]))
+
+def extract_to_tar(items, tar, workers, window=64):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # files are read ahead in parallel but at most window files are
+        # being kept in memory at once
+        for i in range(0, len(items), window):
+            batch = items[i:i+window]
+            jobs = [ pool.submit(read_file, f, part) if f.subdir == None else None for path, f, part in batch ]
+
+            for (path, f, part), job in zip(batch, jobs):
+                info = tarfile.TarInfo(path)
+                ts = fat_timestamp(f.time, f.date)
+                if ts != None: info.mtime = int(ts)
+
+                if job:
+                    data = job.result()
+                    info.size = len(data)
+                    tar.addfile(info, BytesIO(data))
+                else:
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    tar.addfile(info)
+
+def extract_image(name, dst, options, workers=None):
+    # a tar stream written to stdout must not be mixed with any other output
+    tar_stdout = dst == "-"
+    stdout = sys.stdout.buffer
+
+    with contextlib.redirect_stdout(sys.stderr if tar_stdout else sys.stdout):
+        img, items = list_partitions(name, options)
+        if img == None: return False
+
+        print("== extracting '"+name+"' to '"+dst+"' ==")
+
+        try:
+            if tar_stdout:
+                with tarfile.open(fileobj=stdout, mode="w|") as tar:
+                    extract_to_tar(items, tar, workers)
+            elif dst.lower().endswith((".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")):
+                mode = "w|" + { "gz":"gz", "tgz":"gz", "bz2":"bz2", "xz":"xz" }.get(dst.lower().rsplit(".",1)[-1], "")
+                with tarfile.open(dst, mode) as tar:
+                    extract_to_tar(items, tar, workers)
+            else:
+                extract_to_directory(items, dst, workers)
+        except Exception as e:
+            print("Exception:", str(e))
+            img.close()
+            return False
+
+        print("Extracted", sum(1 for i in items if i[1].subdir == None), "files")
+
+    img.close()
+    return True
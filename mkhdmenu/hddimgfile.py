@@ -0,0 +1,187 @@
+# hddimgfile.py - random access to single files inside an Atari ST harddisk image
+#
+# Only the sectors needed to locate a file are being read: the MBR, the
+# partition's bootsector and FAT and the directories along the path. The
+# file's cluster chain is then followed lazily while reading and recently
+# read clusters are kept in a small LRU cache.
+#
+#   import hddimgfile
+#   with hddimgfile.open("games.hd", "C:\\GAMES\\OIDS\\OIDS.PRG") as f:
+#       header = f.read(28)
+
+import io
+from collections import OrderedDict
+
+from hddimgreader import open_image, read_sectors, read_layout, cluster_chain, decode_directory, partition_entries, FLAG_VOLNAME, FLAG_DIRECTORY
+
+def gem_partitions(img):
+    # return the sectors of all GEM partitions, the first one being C:
+    return [ img[start:start+length] for flags, pid, start, length in partition_entries(img) if pid == b"GEM" ]
+
+def find_partition(img, drive):
+    # return the sectors of the n'th GEM partition, drive 0 being C:
+    partitions = gem_partitions(img)
+    return partitions[drive] if drive >= 0 and drive < len(partitions) else None
+
+def read_cluster(fs, cluster):
+    return read_sectors(fs["sectors"], fs["data"]+fs["spc"]*(cluster-2), fs["spc"])
+
+def list_directory(dir_data):
+    # yield all file and directory entries of a directory, skipping
+    # volume names and VFAT entries
+    for entry in decode_directory(dir_data):
+        if not entry.attr & FLAG_VOLNAME:
+            yield entry
+
+def read_directory(fs, entry=None):
+    # read a subdirectory or the root directory if no entry is given
+    if not entry:
+        return read_sectors(fs["sectors"], fs["root"], fs["ndirs"]//16)
+
+    return b"".join(read_cluster(fs, c) for c in cluster_chain(fs["fat"], entry.cluster))
+
+def walk(fs, entry=None, path=""):
+    # yield (path, entry) for all files and directories, parents first
+    for e in list_directory(read_directory(fs, entry)):
+        if e.name == "." or e.name == "..": continue
+
+        yield path + e.name, e
+        if e.attr & FLAG_DIRECTORY:
+            yield from walk(fs, e, path + e.name + "\\")
+
+def find_entry(dir_data, name):
+    for entry in list_directory(dir_data):
+        if entry.name.upper() == name.upper():
+            return entry
+
+    return None
+
+def lookup(fs, path):
+    # walk the path through the directory clusters, starting at the root directory
+    dir_data = read_directory(fs)
+
+    parts = [ p for p in path.replace("/", "\\").split("\\") if p ]
+    for i in range(len(parts)):
+        entry = find_entry(dir_data, parts[i])
+        if not entry: return None
+
+        if i == len(parts)-1:
+            return entry
+
+        if not entry.attr & FLAG_DIRECTORY: return None
+        dir_data = read_directory(fs, entry)
+
+    return None
+
+class ImageFile(io.RawIOBase):
+    # a read-only, seekable file inside an image
+    def __init__(self, fs, entry, name, image=None, cache_size=64):
+        self.fs = fs
+        self.name = name
+        self.size = entry.size
+        self.time = entry.time
+        self.date = entry.date
+
+        # clusters of the chain known so far, extended while reading
+        self.chain = [ entry.cluster ]
+        self.pos = 0
+
+        # clusters recently read
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+        # image opened by us and to be closed with this file
+        self.image = image
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:   pos = offset
+        elif whence == io.SEEK_CUR: pos = self.pos + offset
+        elif whence == io.SEEK_END: pos = self.size + offset
+        else: raise ValueError("invalid whence")
+
+        if pos < 0: raise ValueError("negative seek position")
+        self.pos = pos
+        return self.pos
+
+    def cluster(self, index):
+        # follow the chain up to the requested cluster ...
+        fat = self.fs["fat"]
+        while len(self.chain) <= index:
+            n = fat[self.chain[-1]]
+            if n < 2 or n >= 0xfff0 or n >= len(fat) or len(self.chain) >= len(fat):
+                raise IOError("Cluster chain of "+self.name+" is too short")
+            self.chain.append(n)
+
+        # ... and read it if it's not cached
+        c = self.chain[index]
+        if c in self.cache:
+            self.cache.move_to_end(c)
+            return self.cache[c]
+
+        data = read_cluster(self.fs, c)
+        self.cache[c] = data
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return data
+
+    def readinto(self, b):
+        csize = 512*self.fs["spc"]
+
+        b = memoryview(b).cast("B")
+        n = 0
+        while n < len(b) and self.pos < self.size:
+            index, offset = divmod(self.pos, csize)
+            chunk = self.cluster(index)[offset:offset+min(len(b)-n, self.size-self.pos)]
+            b[n:n+len(chunk)] = chunk
+            n += len(chunk)
+            self.pos += len(chunk)
+
+        return n
+
+    def close(self):
+        if self.image:
+            self.image.close()
+            self.image = None
+        super().close()
+
+def open(image, path, cache_size=64):
+    # image may either be the name of an image file or an image already
+    # opened via hddimgreader.open_image(). The latter is much cheaper when
+    # many files are read from the same image
+    name = path
+    owned = None
+    if isinstance(image, str):
+        owned = open_image(image, True)
+        if not owned: raise FileNotFoundError("Unable to open image: " + image)
+        image = owned
+
+    try:
+        # path may start with a drive letter, C: being the default
+        drive = 0
+        if len(path) > 1 and path[1] == ":":
+            drive = ord(path[0].upper()) - ord("C")
+            path = path[2:]
+
+        part = find_partition(image, drive) if drive >= 0 else None
+        if part == None:
+            raise FileNotFoundError("No such partition in image: " + name)
+
+        fs = read_layout(part)
+        entry = lookup(fs, path)
+        if not entry or entry.attr & FLAG_DIRECTORY:
+            raise FileNotFoundError("No such file in image: " + name)
+    except Exception:
+        if owned: owned.close()
+        raise
+
+    return io.BufferedReader(ImageFile(fs, entry, name, owned, cache_size))
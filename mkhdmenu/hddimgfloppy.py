@@ -0,0 +1,117 @@
+# hddimgfloppy.py - write Atari ST floppy images
+#
+# Floppies use the same allocator and directory encoder as the harddisk
+# partitions, only the FAT is stored with 12 bits per entry and the
+# bootsector describes the disk geometry. Images are written as plain .ST
+# or as run length encoded .MSA files.
+
+import struct, random
+
+from hddimgreader import open_compressed
+from hddimgwriter import import_fs, count_clusters, check_names
+
+# tracks, sides, sectors per track and media byte of the standard formats
+FLOPPY_FORMATS = { "360K":  ( 80, 1,  9, 0xf8 ),
+                   "400K":  ( 80, 1, 10, 0xf8 ),
+                   "720K":  ( 80, 2,  9, 0xf9 ),
+                   "800K":  ( 80, 2, 10, 0xf9 ),
+                   "1440K": ( 80, 2, 18, 0xf0 ) }
+
+def floppy_layout(nsects, spc, ndirs):
+    # return the number of sectors per FAT and the number of usable
+    # clusters. Each FAT12 entry takes one and a half bytes
+    spf = 1
+    while True:
+        nclusters = (nsects - 1 - 2*spf - ndirs//16) // spc
+        if 3*(nclusters+2) <= 2*512*spf: return spf, nclusters
+        spf += 1
+
+def encode_fat12(fat, spf):
+    # pack two entries into three bytes, FAT16 end of chain markers are
+    # truncated to their FAT12 counterparts
+    data = bytearray(512*spf)
+    for i in range(0, len(fat), 2):
+        lo = fat[i] & 0xfff
+        hi = fat[i+1] & 0xfff if i+1 < len(fat) else 0
+        data[3*i//2:3*i//2+3] = bytes([ lo & 0xff, lo >> 8 | (hi & 0x0f) << 4, hi >> 4 ])
+
+    return data
+
+def encode_msa(st, spt, sides):
+    # tracks are run length encoded with 0xe5 <byte> <count.w> runs if
+    # that saves space. The marker byte itself is always encoded as a run
+    track_size = 512*spt
+    tracks = len(st) // (track_size*sides)
+    msa = bytearray(struct.pack(">HHHHH", 0x0e0f, spt, sides-1, 0, tracks-1))
+
+    for t in range(0, len(st), track_size):
+        track = st[t:t+track_size]
+        packed = bytearray()
+        i = 0
+        while i < len(track):
+            j = i+1
+            while j < len(track) and track[j] == track[i]: j += 1
+            if j-i > 4 or track[i] == 0xe5:
+                packed += struct.pack(">BBH", 0xe5, track[i], j-i)
+            else:
+                packed += track[i:j]
+            i = j
+
+        if len(packed) >= track_size: packed = track
+        msa += struct.pack(">H", len(packed)) + packed
+
+    return bytes(msa)
+
+def build_floppy(files, fmt):
+    # return the .ST image of a floppy containing the given file tree
+    tracks, sides, spt, media = FLOPPY_FORMATS[fmt]
+    nsects = tracks*sides*spt
+    spc = 2
+    ndirs = 224 if spt > 11 else 112
+    spf, nclusters = floppy_layout(nsects, spc, ndirs)
+
+    if count_clusters(files, 512*spc) > nclusters:
+        print("Error, files don't fit onto a", fmt, "floppy")
+        return None
+
+    if len(files) > ndirs:
+        print("Error, root directory overflow")
+        return None
+
+    if not check_names(files): return None
+
+    bootsector = bytearray(512)
+    bootsector[0:2] = b"\x60\x38"       # bra.s to the end of the BPB
+    random_serial = bytearray([random.randint(0,255) for i in range(3)])
+    bootsector[2:16] = struct.pack("<6s3sHBH", bytes(6), random_serial, 512, spc, 1)
+    bootsector[16:30] = struct.pack("<BHHBHHHH", 2, ndirs, nsects, media, spf, spt, sides, 0)
+
+    data = bytearray(512*spc*nclusters)
+    fat = [ 0 ] * (nclusters+2)
+    fat[0] = 0xf00 | media
+    fat[1] = 0xfff
+
+    root = import_fs(files, fat, data, spc)
+    if root == None: return None
+    fats = encode_fat12(fat, spf)
+
+    st = bootsector + fats + fats + root + bytes(32*ndirs - len(root)) + data
+    return bytes(st + bytes(512*nsects - len(st)))
+
+def write_floppy(name, files, fmt):
+    print("== writing '"+name+"' ==")
+
+    st = build_floppy(files, fmt)
+    if st == None: return False
+
+    tracks, sides, spt, media = FLOPPY_FORMATS[fmt]
+    image = encode_msa(st, spt, sides) if name.lower().endswith(".msa") else st
+
+    try:
+        with open_compressed(name, "wb") as f:
+            f.write(image)
+    except Exception as e:
+        print("Exception:", str(e))
+        return False
+
+    return True
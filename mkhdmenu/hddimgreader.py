@@ -8,14 +8,260 @@
 # https://teslabs.com/openplayer/docs/docs/specs/fat16_specs.pdf
 # https://averstak.tripod.com/fatdox/dir.htm
 
-import struct
+import struct, io, os, sys, threading, shutil, tempfile, contextlib, hashlib, bisect
+import gzip, bz2, lzma
+from array import array
 
+from hddimgentry import Entry, tree_signature
+
+# zstd is part of the standard library since python 3.14, older versions
+# may have the zstandard module installed
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+# compressed images are detected by their magic bytes when being read and
+# by their file name extension when being written
+COMPRESSION = [ (b"\x1f\x8b",          ".gz",  gzip.open),
+                (b"BZh",               ".bz2", bz2.open),
+                (b"\xfd7zXZ\x00",      ".xz",  lzma.open),
+                (b"\x28\xb5\x2f\xfd",  ".zst", zstd.open if zstd else None) ]
+
+def open_compressed(name, mode="rb"):
+    # open a plain or compressed image file for reading or writing. The name
+    # "-" stands for stdin or stdout respectively
+    if "r" in mode:
+        if name == "-": f = open(sys.__stdin__.fileno(), "rb", closefd=False)
+        else:           f = open(name, "rb")
+
+        magic = f.peek(6)[:6]
+        compression = [ c for c in COMPRESSION if magic.startswith(c[0]) ]
+    else:
+        if name == "-": f = open(sys.__stdout__.fileno(), "wb", closefd=False)
+        else:           f = None
+
+        compression = [ c for c in COMPRESSION if name.lower().endswith(c[1]) ]
+
+    if not compression:
+        return f if f else open(name, mode)
+
+    magic, ext, opener = compression[0]
+    if not opener:
+        if f: f.close()
+        raise IOError("No "+ext+" support available, please install the zstandard module")
+
+    # named files are reopened by the decompressor, so they get closed with it
+    if name != "-":
+        if f: f.close()
+        return opener(name, mode)
+
+    return opener(f, mode)
+
+FLAG_RO = 0x01
+FLAG_HIDDEN = 0x02
+FLAG_SYSTEM = 0x04
+FLAG_VOLNAME = 0x08
+FLAG_DIRECTORY = 0x10
+FLAG_ARCHIVE = 0x20
+
+# special FAT16 entries
+FAT_RESERVED = 0xfff0
+FAT_BAD = 0xfff7
+FAT_EOC = 0xfff8
+
+class SectorImage:
+    # A list-like view of the 512 byte sectors of an image file. Sectors are
+    # only read when being accessed, so large images can be parsed without
+    # loading them entirely. Slicing returns a view of the same file.
+    def __init__(self, f, start=0, length=None, lock=None):
+        if length == None:
+            size = os.fstat(f.fileno()).st_size
+            if size % 512: print("Warning: Image size is not a multiple of 512")
+            length = size // 512 - start
+            
+        self.f = f
+        self.start = start
+        self.length = length
+        # the file may be shared by several threads
+        self.lock = lock if lock else threading.Lock()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, _ = i.indices(self.length)
+            return SectorImage(self.f, self.start+start, max(0, stop-start), self.lock)
+
+        if i < 0: i += self.length
+        if i < 0 or i >= self.length: raise IndexError("sector out of range")
+        return self.read(i, 1)
+
+    def read(self, sector, count):
+        # read a run of consecutive sectors with a single file access
+        count = min(count, self.length - sector)
+        if count <= 0: return b""
+
+        # pread doesn't move the file position, so no locking is needed
+        if hasattr(os, "pread"):
+            return os.pread(self.f.fileno(), 512*count, 512*(self.start+sector))
+        
+        with self.lock:
+            self.f.seek(512*(self.start+sector))
+            return self.f.read(512*count)
+
+    def close(self):
+        self.f.close()
+
+# An overlay image only stores the sectors differing from a base image. The
+# first sector holds the header incl. the base image's name relative to the
+# overlay, followed by a table of (start, count) extents of the sectors
+# stored and the sectors themselves in the order of the table. The base's
+# size, modification time and sha1 are recorded to detect a changed base
+OVERLAY_MAGIC = b"MKHDOVL2"
+OVERLAY_HEADER = ">8sLLL20sQH"
+
+class OverlayImage:
+    # A list-like view of an overlay image just like SectorImage. Sectors
+    # stored in the overlay are read from it, all others from the base
+    def __init__(self, data, base, extents, start=0, length=None, sha1=None):
+        self.data = data
+        self.base = base
+        self.extents = extents
+        self.starts = [ e[0] for e in extents ]
+        self.start = start
+        self.length = length
+        self.sha1 = sha1
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, _ = i.indices(self.length)
+            return OverlayImage(self.data, self.base, self.extents, self.start+start, max(0, stop-start), self.sha1)
+
+        if i < 0: i += self.length
+        if i < 0 or i >= self.length: raise IndexError("sector out of range")
+        return self.read(i, 1)
+
+    def read(self, sector, count):
+        count = min(count, self.length - sector)
+        if count <= 0: return b""
+
+        # split the request into runs stored in the overlay and runs to be
+        # read from the base
+        chunks = [ ]
+        sector += self.start
+        end = sector + count
+        while sector < end:
+            i = bisect.bisect_right(self.starts, sector) - 1
+            if i >= 0 and sector < self.extents[i][0] + self.extents[i][1]:
+                n = min(end, self.extents[i][0] + self.extents[i][1]) - sector
+                chunks.append(self.data.read(self.extents[i][2] + sector - self.extents[i][0], n))
+            else:
+                n = min(end, self.starts[i+1] if i+1 < len(self.starts) else end) - sector
+                chunks.append(self.base.read(sector, n))
+            sector += n
+
+        return b"".join(chunks)
+
+    def check_base(self):
+        # the base must not have been changed since the overlay was created
+        h = hashlib.sha1()
+        for s in range(0, len(self.base), 2048):
+            h.update(self.base.read(s, 2048))
+        return h.digest() == self.sha1
+
+    def close(self):
+        self.data.close()
+        self.base.close()
+
+def open_overlay(name, img):
+    magic, total, nextents, base_len, sha1, mtime, nlen = struct.unpack(OVERLAY_HEADER, img[0][:struct.calcsize(OVERLAY_HEADER)])
+    base_name = img[0][struct.calcsize(OVERLAY_HEADER):struct.calcsize(OVERLAY_HEADER)+nlen].decode("utf-8")
+    if name != "-" and not os.path.isabs(base_name):
+        base_name = os.path.join(os.path.dirname(name), base_name)
+
+    # the position of each extent's first sector in the overlay's data
+    table = (8*nextents+511)//512
+    extents = [ ]
+    offset = 0
+    for start, count in struct.iter_unpack(">LL", img.read(1, table)[:8*nextents]):
+        extents.append( (start, count, offset) )
+        offset += count
+
+    base = open_image(base_name, True)
+    if not base: raise IOError("Unable to open base image " + base_name)
+    overlay = OverlayImage(img[1+table:], base, extents, 0, total, sha1)
+
+    # the sha1 is only checked if the size matches but the base has been
+    # touched since the overlay was created, e.g. by copying it
+    if len(base) != base_len or (os.stat(base_name).st_mtime_ns != mtime and not overlay.check_base()):
+        base.close()
+        raise IOError("Base image " + base_name + " has changed")
+
+    return overlay
+
+def is_overlay(name):
+    with open_compressed(name, "rb") as f:
+        return f.read(len(OVERLAY_MAGIC)) == OVERLAY_MAGIC
+
+def read_sectors(img, start, count):
+    # read a run of sectors from a lazy image or a list of sectors
+    if hasattr(img, "read"): return img.read(start, count)
+    return b"".join(img[start:start+count])
+
+def open_image(name, quiet=False):
+    if not quiet: print("Opening",name,"...")
+
+    try:
+        f = open_compressed(name, "rb")
+
+        # compressed images and pipes cannot be accessed randomly and are
+        # unpacked into a temporary file first
+        if name != "-" and isinstance(f, io.BufferedReader):
+            img = SectorImage(f)
+        else:
+            tmp = tempfile.TemporaryFile()
+            shutil.copyfileobj(f, tmp, 1024*1024)
+            f.close()
+
+            # the sectors are read with os.pread, bypassing python's buffer
+            tmp.flush()
+            img = SectorImage(tmp)
+
+        # overlays are read through transparently
+        if img.read(0, 1)[:len(OVERLAY_MAGIC)] == OVERLAY_MAGIC:
+            try:
+                return open_overlay(name, img)
+            except Exception:
+                img.close()
+                raise
+
+        return img
+    except Exception as e:
+        print(str(e))
+
+    return None
+    
 def load_image(name):
     print("Loading",name,"...")
     
     try:
+        if name != "-" and is_overlay(name):
+            overlay = open_image(name, True)
+            if not overlay: return None
+            data = overlay.read(0, len(overlay))
+            overlay.close()
+            return [ data[i:i+512] for i in range(0, len(data), 512) ]
+
         img = []
-        with open(name, "rb") as f:
+        with open_compressed(name, "rb") as f:
             # read into array of sectors
             d = f.read(512)
             while len(d) == 512:
@@ -37,6 +283,39 @@ def check_csum(sec, s=0x1234):
     for i in range(256): csum = (csum + struct.unpack(">H", sec[2*i:2*i+2])[0]) & 0xffff
     return csum == s
     
+def partition_entries(img):
+    # yield (flags, id, start, length) of all partitions with absolute start
+    # sectors. An XGM entry in the MBR points to a chain of extended root
+    # sectors, each describing one partition relative to itself and linking
+    # to the next root sector relative to the first one. Only the root
+    # sectors themselves are being read
+    mbr = img[0]
+    for i in range(4):
+        flags, pid, start, length = struct.unpack(">B3sLL", mbr[0x1c6+12*i:0x1c6+12*(i+1)])
+        if not flags & 1: continue
+
+        if pid != b"XGM":
+            yield flags, pid, start, length
+            continue
+
+        root = start
+        visited = set()
+        while root != None:
+            if root in visited or root >= len(img):
+                print("Error, invalid XGM partition chain")
+                return
+            visited.add(root)
+
+            sec = img[root]
+            link = None
+            for j in range(4):
+                xflags, xpid, xstart, xlength = struct.unpack(">B3sLL", sec[0x1c6+12*j:0x1c6+12*(j+1)])
+                if not xflags & 1: continue
+
+                if xpid == b"XGM": link = start + xstart
+                else:              yield xflags, xpid, root + xstart, xlength
+            root = link
+
 def hdd_img_parse(img, options):
     # parse the mbr
     if not options["quiet"]: print("== MBR ==")
@@ -68,27 +347,22 @@ def hdd_img_parse(img, options):
     if hdd["mbr"]["hd_siz"] != len(img):
         print("Warning, size != image length (",len(img),")")
 
-    # parse the four partition entries
+    # parse the partition entries incl. those of extended partitions
     hdd["partition"] = [ ]
     hdd["mbr"]["partition"] = [ ]
-    for i in range(4):
-        entry = mbr[0x1c6+12*i:0x1c6+12*(i+1)]
-
+    for i, entry in enumerate(partition_entries(img)):
         p = { }
-        p["flags"], p["id"], p["start"], p["length"] = struct.unpack(">B3sLL", entry)
- 
-        if p["flags"] & 1:
-            # partition exists
-            p["id"] = p["id"].decode("latin-1")
-            print("Partition", i, "ID:", p["id"], "Start:", p["start"], "Length:", p["length"], "bootable" if p["flags"] & 0x80 else "")
-
-            # check if partition data is within disk image
-            if p["start"] + p["length"] > len(img):
-                print("Error, partition exceeds image length by",p["start"] + p["length"]-len(img),"sectors")
-                return None
+        p["flags"], p["id"], p["start"], p["length"] = entry
+        p["id"] = p["id"].decode("latin-1")
+        print("Partition", i, "ID:", p["id"], "Start:", p["start"], "Length:", p["length"], "bootable" if p["flags"] & 0x80 else "")
 
-            hdd["mbr"]["partition"].append(p)
-            hdd["partition"].append(img[p["start"]:p["start"] + p["length"]])
+        # check if partition data is within disk image
+        if p["start"] + p["length"] > len(img):
+            print("Error, partition exceeds image length by",p["start"] + p["length"]-len(img),"sectors")
+            return None
+
+        hdd["mbr"]["partition"].append(p)
+        hdd["partition"].append(img[p["start"]:p["start"] + p["length"]])
 
     # check if there are any partitions at all
     if not hdd["mbr"]["partition"]:
@@ -101,21 +375,69 @@ def hdd_img_parse(img, options):
 
     return hdd
 
-def parse_fat16(part, data):
+def decode_fat(data, bits):
+    # return the entries of a FAT. FAT12 entries >= 0xff0 are widened to
+    # their FAT16 counterparts, so the same constants apply to both
+    if bits == 16:
+        return list(struct.unpack("<"+str(len(data)//2)+"H", data[:len(data)//2*2]))
+
+    # two FAT12 entries are packed into three bytes
+    fat = [ ]
+    for lo, mid, hi in zip(data[0::3], data[1::3], data[2::3]):
+        for v in [ lo | (mid & 0x0f) << 8, mid >> 4 | hi << 4 ]:
+            fat.append(v | 0xf000 if v >= 0xff0 else v)
+
+    return fat
+
+def decode_bootsector(bootsec):
+    part = { }
+
+    # decode little endian (x86) format
+    part["bra_s"] = struct.unpack(">H", bootsec[0:2])[0]
+    part["filler"], part["serial"], part["bps"], part["spc"], part["res"] = struct.unpack("<6s3sHBH", bootsec[2:16])
+    part["nfats"], part["ndirs"], part["nsects"], part["media"], part["spf"], part["spt"], part["nsides"], part["nhid"] = struct.unpack("<BHHBHHHH", bootsec[16:30])
+    return part
+
+def read_layout(img, fat_bits=16):
+    # return the layout and the first FAT of a partition without checking
+    # it or scanning its directories. The FAT is returned as an array which
+    # may be modified and written back. All offsets are in sectors
+    part = decode_bootsector(img[0])
+    root = part["res"]+part["nfats"]*part["spf"]
+
+    fat = array("H", decode_fat(read_sectors(img, part["res"], part["spf"]), fat_bits))
+
+    return { "sectors": img, "spc": part["spc"], "fat": fat, "res": part["res"],
+             "nfats": part["nfats"], "spf": part["spf"], "nsects": part["nsects"],
+             "root": root, "ndirs": part["ndirs"], "data": root+part["ndirs"]//16 }
+
+def cluster_chain(fat, cluster):
+    # yield all clusters of a chain. The chain can never be longer than
+    # the FAT, this catches loops in corrupted FATs
+    for i in range(len(fat)):
+        if cluster < 2 or cluster >= len(fat): return
+        yield cluster
+        cluster = fat[cluster]
+        if cluster >= FAT_RESERVED: return
+
+    raise IOError("Cluster chain loops")
+
+def chain_extents(fat, cluster):
+    # return a chain as list of [start, count] extents of contiguous clusters
+    extents = [ ]
+    for c in cluster_chain(fat, cluster):
+        if extents and c == sum(extents[-1]): extents[-1][1] += 1
+        else:                                 extents.append([c, 1])
+    return extents
+
+def parse_fat(part, data):
     
     # create a list of all FATs
     fats = []
     
     # parse each FAT
     for p in range(part["nfats"]):
-        fat = []
-        for i in range(part["spf"]):        
-            fsec = data[i+part["spf"]*p]
-
-            # each 512 byte sector contains 256 FAT16 entries
-            v = struct.unpack("<256H", fsec)
-            fat.extend(v)
-
+        fat = decode_fat(read_sectors(data, part["spf"]*p, part["spf"]), part["fat_bits"])
         fats.append(fat)                            
 
     # check if all fats are the same and bail out if not
@@ -128,154 +450,259 @@ def parse_fat16(part, data):
     # continue with one fat only
     print("Total number of FAT entries:     ", len(fat))
 
-    # check if the FAT is big enough
-    clusters_needed = (len(data)+part["spc"]-1) // part["spc"]
+    # check if the FAT is big enough for all clusters of the data area
+    clusters_needed = part["nclusters"] + 2
     if clusters_needed > len(fat):
         print("Error, not enough FAT entries,",clusters_needed,"needed")
         return None
 
     # fat entries 0 and 1 should be fff8 and ffff
-    if fat[0] != 0xfff8 or fat[1] != 0xffff:
+    if part["fat_bits"] == 16 and (fat[0] != 0xfff8 or fat[1] != 0xffff):
         print("Warning, illegal FAT entries 0/1", hex(fat[0]), hex(fat[1]))
 
-    # create a "reverse" FAT containing a the cluster referencing
-    # the given one
-    rev_fat = [None for x in range(len(fat))]
-    for i in range(len(fat)):
-        if fat[i] > 0 and fat[i] < len(fat):
-            # there must not already be a reference as a cluster may
-            # never be part of two files or directories
-            if rev_fat[fat[i]] != None:
-                print("Error, doubly referenced cluster", i, "in FAT", p)
-                return None
-            
-            rev_fat[fat[i]] = i
-
-    # scan for cluster chains
-    chains = { }
-    for i in range(2, len(fat)):
-        # check for clusters that are used but not referenced by any other cluster
-
-        # start clusters are allocated clusters which are not referenced by another cluster
-        if fat[i] and rev_fat[i] == None:
-            #  print("Cluster",i,"is a start cluster")
-
-            # build the cluster chain
-            chains[i] = []
-            n = i
-            while fat[n] < 0xfff0:
-                chains[i].append(fat[n])
-                n = fat[n]
+    part["entries"] = fat
+    return part
 
-#    for i in chains:
-#        print("Chain:", i, chains[i])
+def check_fat(part, root_dir, data_sectors):
+    # Check the FAT against the directory tree. Every chain is followed
+    # once from its directory entry while the owner of each cluster is
+    # recorded. This detects loops, cross-linked clusters, chains leaving
+    # the data area or ending in free/bad clusters and chain lengths not
+    # matching the file sizes in linear time. Allocated clusters not owned
+    # by any entry afterwards are lost. The chains followed are stored as
+    # lists of [start, count] extents of contiguous clusters, so lost chains
+    # running into a file's chain, as left behind by an interrupted
+    # defragmentation, don't hide parts of it.
+    fat = part["entries"]
+    chains = part["chains"] = { }
+    end = part["nclusters"] + 2
+    csize = 512*part["spc"]
+    owner = array("L", [0]) * len(fat)
+
+    report = { "clusters": part["nclusters"], "used": 0, "lost_clusters": 0, "lost_chains": 0,
+               "loops": [], "crosslinks": [], "past_end": [], "broken": [], "size_mismatch": [] }
+
+    walk = 0
+    def follow(path, cluster):
+        # follow a chain and return its clusters
+        nonlocal walk
+        walk += 1
+
+        chain = [ ]
+        extents = chains.setdefault(cluster, [ ])
+        while True:
+            if cluster < 2 or cluster >= end:
+                report["past_end"].append(path)
+                break
+            if owner[cluster] == walk:
+                report["loops"].append(path)
+                break
+            if owner[cluster]:
+                report["crosslinks"].append(path)
+                break
+
+            owner[cluster] = walk
+            if chain and cluster == chain[-1]+1: extents[-1][1] += 1
+            else:                                extents.append([cluster, 1])
+            chain.append(cluster)
+
+            n = fat[cluster]
+            if n >= FAT_EOC: break
+            if n < 2 or n >= FAT_RESERVED:
+                # free, reserved or bad cluster in the middle of a chain
+                report["broken"].append(path)
+                break
+            cluster = n
+
+        return chain
+
+    def check_dir(path, dir_data):
+        for entry in decode_directory(dir_data):
+            # skip volume names, VFAT entries and '.' and '..'
+            if entry.attr & FLAG_VOLNAME or entry.name in [ ".", ".." ]: continue
+
+            name = path + entry.name
+            if entry.attr & FLAG_DIRECTORY:
+                chain = follow(name+"\\", entry.cluster)
+                sub = b"".join(read_sectors(data_sectors, part["spc"]*(c-2), part["spc"]) for c in chain)
+                check_dir(name + "\\", sub)
+            elif entry.cluster or entry.size:
+                chain = follow(name, entry.cluster)
+                if len(chain) != max(1, (entry.size+csize-1)//csize):
+                    report["size_mismatch"].append(name)
+
+    check_dir("\\", root_dir)
+
+    # scan for allocated clusters not owned by any file or directory
+    lost = bytearray(end)
+    for c in range(2, end):
+        if fat[c] and fat[c] != FAT_BAD:
+            if owner[c]: report["used"] += 1
+            else:        lost[c] = 1
+
+    # lost chains start at lost clusters not referenced by other lost clusters
+    starts = bytearray(lost)
+    for c in range(2, end):
+        if lost[c] and fat[c] >= 2 and fat[c] < end: starts[fat[c]] = 0
+
+    report["lost_clusters"] = lost.count(1)
+    report["lost_chains"] = starts.count(1)
+    report["errors"] = len(report["loops"]) + len(report["crosslinks"]) + len(report["past_end"]) + len(report["broken"])
+
+    return report
+
+def print_fat_report(report):
+    print("Clusters used:                   ", report["used"], "of", report["clusters"])
+
+    for key, desc in [ ("loops", "Error, cluster chain loops in"),
+                       ("crosslinks", "Error, cross-linked cluster in"),
+                       ("past_end", "Error, cluster chain exceeds data area in"),
+                       ("broken", "Error, broken cluster chain in"),
+                       ("size_mismatch", "Warning, cluster chain doesn't match file size of") ]:
+        for path in report[key]: print(desc, path)
+
+    if report["lost_clusters"]:
+        print("Warning,", report["lost_clusters"], "lost clusters in", report["lost_chains"], "chains")
+
+# name, extension, attributes, time, date, start cluster and size
+DIR_ENTRY = struct.Struct("<8s3sB10xHHHL")
+
+def decode_directory(dir_data):
+    # yield all used entries of a directory, decoded in a single pass
+    length = len(dir_data)//DIR_ENTRY.size*DIR_ENTRY.size
+    for name, ext, attr, time, date, cluster, size in DIR_ENTRY.iter_unpack(memoryview(dir_data)[:length]):
+        if name[0] != 0xe5 and name[0] != 0:
+            # decode 8.3 file name
+            name = name.decode("latin-1").rstrip(" ")
+            ext = ext.decode("latin-1").rstrip(" ")
+            if ext != "": name += "."+ext
 
-    part["chains"] = chains
-    return part
+            yield Entry(name, time, date, attr=attr, cluster=cluster, size=size)
 
 def get_data(cluster, fat, data_sectors):
-    def get_cluster_data(cluster, fat, data_sectors):
-        data = bytearray()
-        for i in range(fat["spc"]):
-            data += data_sectors[fat["spc"]*(cluster-2)+i]
-
-        return data
-            
     if not cluster in fat["chains"]:
         print("Error, file/dir cluster", cluster, "does not point to a cluster chain")
         return None
 
-    # get first data cluster
-    data = get_cluster_data(cluster, fat, data_sectors)
+    # read each extent of the chain at once
+    spc = fat["spc"]
+    return b"".join(read_sectors(data_sectors, spc*(start-2), spc*count) for start, count in fat["chains"][cluster])
+
+class ChainData:
+    # stands in for the contents of a file which are only read from the
+    # image when they are actually needed
+    __slots__ = ( "cluster", "size", "fat", "data_sectors" )
+
+    def __init__(self, cluster, size, fat, data_sectors):
+        self.cluster = cluster
+        self.size = size
+        self.fat = fat
+        self.data_sectors = data_sectors
+
+    def __len__(self):
+        return self.size
+
+    def view(self):
+        if not self.size: return b""
+        return get_data(self.cluster, self.fat, self.data_sectors)[:self.size]
+
+def defer_data(files, fat, data_sectors):
+    # let all files of a tree parsed without data read their contents on demand
+    for f in files:
+        if f.subdir != None: defer_data(f.subdir, fat, data_sectors)
+        else:                f.data = ChainData(f.cluster, f.size, fat, data_sectors)
+
+def iter_data(cluster, size, fat, data_sectors, max_run=64):
+    # yield the contents of a file in chunks of at most max_run clusters
+    if not size: return
+    if not cluster in fat["chains"]:
+        print("Error, file cluster", cluster, "does not point to a cluster chain")
+        return
 
-    # append data from cluster chain
-    for c in fat["chains"][cluster]:
-        data += get_cluster_data(c, fat, data_sectors)
+    yield from iter_extents(fat["chains"][cluster], size, fat["spc"], data_sectors, max_run)
 
-    return data
+def iter_extents(extents, size, spc, data_sectors, max_run=64):
+    # yield size bytes of a chain in chunks of at most max_run clusters,
+    # one extent of contiguous clusters after the other
+    for start, count in extents:
+        for c in range(start, start+count, max_run):
+            if size <= 0: return
 
-def parse_directory(path, dir_data, fat, data_sectors):
-    FLAG_RO = 0x01
-    FLAG_HIDDEN = 0x02
-    FLAG_SYSTEM = 0x04
-    FLAG_VOLNAME = 0x08
-    FLAG_DIRECTORY = 0x10
-    FLAG_ARCHIVE = 0x20
-    
+            chunk = read_sectors(data_sectors, spc*(c-2), spc*min(max_run, start+count-c))
+            if len(chunk) > size: chunk = chunk[:size]
+            if not chunk:
+                print("Error, cluster chain exceeds data area")
+                return
+
+            size -= len(chunk)
+            yield chunk
+
+def parse_directory(path, dir_data, fat, data_sectors, load_data=True):
     # split dirctory data into individual entries
     dir_entries = []
-    for index in range(len(dir_data)//32):
-        entry_data = dir_data[index*32:(index+1)*32]
-        if entry_data[0] != 0xe5 and entry_data[0] != 0:
-            # parse one directory entry
-            entry = { }
-            name, ext, entry["attr"], entry["time"], entry["date"], entry["cluster"], entry["size"] = struct.unpack("<8s3sB4x6xHHHL", entry_data)
-
-            # decode 8.3 file name
-            entry["name"] = name.decode("latin-1").rstrip(" ")
-            ext = ext.decode("latin-1").rstrip(" ")
-            if ext != "": entry["name"] += "."+ext 
-
-            # normal directories have only the directory flag set
-            if entry["attr"] == FLAG_DIRECTORY:
-                # don't scan '.' or '..'
-                if entry["name"] != "." and entry["name"] != "..":
-                    data = get_data(entry["cluster"], fat, data_sectors)
-                    if not data:
-                        print("Error getting directory data for", entry["name"])
-                        return None
-                    
-                    subdir = parse_directory(path + entry["name"] + "/", data, fat, data_sectors)
-                    if subdir == None: return None                    
-                    entry["subdir"] = subdir
-                    dir_entries.append(entry)
-
-            # regular files have neither the directory nor the volume nor the system flag set
-            # ignore hidden, archive and ro flags
-            elif entry["attr"] & ~(FLAG_RO | FLAG_ARCHIVE | FLAG_HIDDEN) == 0:
-                data = get_data(entry["cluster"], fat, data_sectors)
+    for entry in decode_directory(dir_data):
+        # normal directories have only the directory flag set
+        if entry.attr == FLAG_DIRECTORY:
+            # don't scan '.' or '..'
+            if entry.name != "." and entry.name != "..":
+                data = get_data(entry.cluster, fat, data_sectors)
                 if not data:
-                    print("Error getting file data for", entry["name"])
+                    print("Error getting directory data for", entry.name)
                     return None
                 
-                # check if there's enough data
-                if len(data) < entry["size"]:
-                    print("Error, not enough data for specified file length in", path + entry["name"])
-                    return None
-                    
-                # truncate to file length
-                entry["data"] = data[:entry["size"]]
+                subdir = parse_directory(path + entry.name + "/", data, fat, data_sectors, load_data)
+                if subdir == None: return None                    
+                entry.subdir = subdir
                 dir_entries.append(entry)
 
-            elif entry["attr"] == FLAG_VOLNAME:
-                if path != "/": print("Warning, volume name in non-rootdir")
-                    
-            elif entry["attr"] == 0x0f:
-                print("Warning, ignoring what seems to be a VFAT entry in", path)
+        # regular files have neither the directory nor the volume nor the system flag set
+        # ignore hidden, archive and ro flags
+        elif entry.attr & ~(FLAG_RO | FLAG_ARCHIVE | FLAG_HIDDEN) == 0:
+            # only collect the file's meta data, the contents are read later
+            if not load_data:
+                dir_entries.append(entry)
+                continue
+            
+            data = get_data(entry.cluster, fat, data_sectors)
+            if not data:
+                print("Error getting file data for", entry.name)
+                return None
+            
+            # check if there's enough data
+            if len(data) < entry.size:
+                print("Error, not enough data for specified file length in", path + entry.name)
+                return None
+                
+            # truncate to file length
+            entry.data = data[:entry.size]
+            dir_entries.append(entry)
+
+        elif entry.attr == FLAG_VOLNAME:
+            if path != "/": print("Warning, volume name in non-rootdir")
                 
-            else:                
-                print("Warning, unexpected flags, ignoring file entry in", path)
+        elif entry.attr == 0x0f:
+            print("Warning, ignoring what seems to be a VFAT entry in", path)
+            
+        else:                
+            print("Warning, unexpected flags, ignoring file entry in", path)
 
     return dir_entries
                 
-def partition_parse(img, options):
+def partition_parse(img, options, load_data=True, fat_bits=16):
+    # TOS uses FAT16 on all harddisk partitions regardless of their size,
+    # floppies use FAT12
     print("Size", len(img))
 
     # check partition boot sector
     bootsec = img[0]
     
-    part = { }
-
-    # decode little endian (x86) format
-    part["bra_s"] = struct.unpack(">H", bootsec[0:2])[0]
-    part["filler"], part["serial"], part["bps"], part["spc"], part["res"] = struct.unpack("<6s3sHBH", bootsec[2:16])
+    part = decode_bootsector(bootsec)
     print("BRA.S:                           ", hex(part["bra_s"]))
     print("Filler:                          ", ' '.join('{:02x}'.format(x) for x in part["filler"]))
     print("Serial:                          ", ' '.join('{:02x}'.format(x) for x in part["serial"]))
     print("Bytes per sector:                ", part["bps"])
     print("Sectors per cluster:             ", part["spc"])
     print("Reserved:                        ", part["res"])
-    part["nfats"], part["ndirs"], part["nsects"], part["media"], part["spf"], part["spt"], part["nsides"], part["nhid"] = struct.unpack("<BHHBHHHH", bootsec[16:30])
     print("Number of FATs:                  ", part["nfats"])
     print("Number of root directory entries:", part["ndirs"])
     print("Total number of sectors:         ", part["nsects"])
@@ -310,38 +737,52 @@ def partition_parse(img, options):
     # do various checks
     if part["res"] < 1: print("Error, reserved sectors must at least be 1")
     if part["bps"] != 512: print("Warning, sector size != 512")
-    if part["media"] != 0xf8: print("Warning, media byte should be 0xf8 for hard disks")
+    if fat_bits == 16 and part["media"] != 0xf8: print("Warning, media byte should be 0xf8 for hard disks")
     if part["nsects"] != len(img): print("Warning, number of sectors mismatch")
-    if part["spt"]: print("Warning, sectors per track should be 0 for hard disks")
-    if part["nsides"]: print("Warning, number of sides should be 0 for hard disks")
+    if fat_bits == 16 and part["spt"]: print("Warning, sectors per track should be 0 for hard disks")
+    if fat_bits == 16 and part["nsides"]: print("Warning, number of sides should be 0 for hard disks")
     if part["nfats"] != 2: print("Warning, number of FATs should be 2")
-    if part["ndirs"] % 32: print("Warning, number of root directory entries is not a multiple of 32")
+    if fat_bits == 16 and part["ndirs"] % 32: print("Warning, number of root directory entries is not a multiple of 32")
+    
+    if part["spc"] < 1:
+        print("Error, sectors per cluster must at least be 1")
+        return None
     
     # get data area
     data = img[part["res"]+part["nfats"]*part["spf"]+part["ndirs"]//16:]
+    part["nclusters"] = len(data) // part["spc"]
+    part["fat_bits"] = fat_bits
     
     # parse the fat
-    fat = parse_fat16(part, img[part["res"]:part["res"]+part["nfats"]*part["spf"]])
+    fat = parse_fat(part, img[part["res"]:part["res"]+part["nfats"]*part["spf"]])
     if not fat: return None
 
-    # scan the entire filesystem, starting with the root directory
     root_dir_start = part["res"]+part["nfats"]*part["spf"]
     root_dir = bytearray()
     for i in range(part["ndirs"]//16): root_dir += img[root_dir_start+i]
-    fs = parse_directory("/", root_dir, fat, data)
+
+    # check the FAT for consistency before relying on it
+    part["check"] = check_fat(fat, root_dir, data)
+    print_fat_report(part["check"])
+    if part["check"]["errors"]:
+        print("Error, inconsistent FAT")
+        return None
+
+    # scan the entire filesystem, starting with the root directory
+    fs = parse_directory("/", root_dir, fat, data, load_data)
     if fs == None: return None
 
     # return partition info
-    return { "fat":fat, "fs": fs, "info":part }
+    return { "fat":fat, "fs": fs, "info":part, "data":data }
 
-def partitions_parse(hdd, options):
+def partitions_parse(hdd, options, load_data=True):
     # check all partitions
     partitions = []
 
     for i in range(len(hdd["partition"])):
         if hdd["mbr"]["partition"][i]["id"] == "GEM":    
             print("== Partition", i, "==")
-            partition = partition_parse(hdd["partition"][i], options)
+            partition = partition_parse(hdd["partition"][i], options, load_data)
             if not partition: return None
             partitions.append(partition)
         else:
@@ -349,6 +790,80 @@ def partitions_parse(hdd, options):
 
     return partitions
 
+def decode_msa(data):
+    # decode an MSA floppy image into a plain .ST image. Tracks are either
+    # stored raw or run length encoded with 0xe5 <byte> <count.w> runs
+    if len(data) < 10: return None
+    magic, spt, sides, start, end = struct.unpack(">HHHHH", data[:10])
+    if magic != 0x0e0f or end < start:
+        print("Error, not an MSA image")
+        return None
+
+    track_size = 512*spt
+
+    # tracks before the first one stored are empty
+    st = bytearray(track_size*(sides+1)*start)
+    pos = 10
+    for track in range((end-start+1)*(sides+1)):
+        length = struct.unpack(">H", data[pos:pos+2])[0]
+        chunk = data[pos+2:pos+2+length]
+        pos += 2+length
+
+        if length == track_size:
+            st += chunk
+        else:
+            # copy everything between the runs at once
+            out = len(st)
+            i = 0
+            while i < len(chunk):
+                j = chunk.find(b"\xe5", i)
+                if j < 0: j = len(chunk)
+                st += chunk[i:j]
+                if j+4 > len(chunk): break
+                st += chunk[j+1:j+2] * (chunk[j+2] << 8 | chunk[j+3])
+                i = j+4
+
+            if len(st) - out != track_size:
+                print("Error, corrupted MSA track", track)
+                return None
+
+    return bytes(st)
+
+def read_floppy(data):
+    # return the files of an .ST or .MSA floppy image as a list of (filename,
+    # date_time, data) just like the members of a ZIP archive. Directories
+    # are included with a trailing "/"
+    if data[:2] == b"\x0e\x0f":
+        data = decode_msa(data)
+        if not data: return None
+
+    sectors = [ data[i:i+512] for i in range(0, len(data)//512*512, 512) ]
+
+    # only report the details if something went wrong
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        floppy = partition_parse(sectors, { "quiet": True, "export-bootloader": None }, True, 12) if sectors else None
+    if not floppy:
+        print(log.getvalue(), end="")
+        print("Error, unable to read floppy image")
+        return None
+
+    def date_time(f):
+        return ( 1980+(f.date>>9), (f.date>>5)&0x0f, f.date&0x1f,
+                 f.time>>11, (f.time>>5)&0x3f, 2*(f.time&0x1f) )
+
+    def walk(fs, path):
+        for f in fs:
+            if f.subdir != None:
+                members.append( (path+f.name+"/", date_time(f), b"") )
+                walk(f.subdir, path+f.name+"/")
+            else:
+                members.append( (path+f.name, date_time(f), bytes(f.data)) )
+
+    members = [ ]
+    walk(floppy["fs"], "")
+    return members
+
 def read_hddimage(name, options):
     hdd_img = load_image(name)
     if not hdd_img: return None
@@ -359,16 +874,24 @@ def read_hddimage(name, options):
     hdd = hdd_img_parse(hdd_img, options)
     if not hdd: return None
 
-    partitions = partitions_parse(hdd, options)
+    # only the directories are parsed, file contents are read when needed
+    partitions = partitions_parse(hdd, options, False)
+    if partitions == None: return None
+    gem = [ i for i, p in enumerate(hdd["mbr"]["partition"]) if p["id"] == "GEM" ]
 
     # drop everythig but the minimum partition info needed
     for i in range(len(partitions)):
+        defer_data(partitions[i]["fs"], partitions[i]["fat"], partitions[i]["data"])
+
         # all we need to know is the size of each partition and the
         # files/directories to be stored there
         pinfo = {}
         pinfo["size"] = partitions[i]["info"]["nsects"]        
         pinfo["files"] = partitions[i]["fs"]
+
+        # partitions whose files stay untouched are copied verbatim
+        pinfo["sectors"] = hdd["partition"][gem[i]]
+        pinfo["signature"] = tree_signature(pinfo["files"])
         partitions[i] = pinfo
     
     return partitions
-
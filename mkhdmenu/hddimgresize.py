@@ -0,0 +1,248 @@
+# hddimgresize.py - change the partition layout of an Atari ST harddisk image in place
+#
+# Instead of reading all files and rebuilding the image, only the MBR and
+# the bootsectors are being updated and the FATs are grown as needed. When a
+# partition shrinks, the clusters behind its new end are moved to free
+# clusters in front of it. The partitions are then shifted to their new
+# places with large block copies, copying only the part of each data area
+# that's actually in use. New partitions are appended empty.
+#
+# The image is modified in place, so better keep a copy of it.
+
+import sys, io, struct, contextlib
+from array import array
+
+from hddimgreader import SectorImage, partition_entries, partition_parse, read_layout, cluster_chain, check_csum, COMPRESSION, OVERLAY_MAGIC, FAT_BAD
+from hddimgwriter import partition_layout, partition_table, xgm_root, write_partition, adjust_csum, MAX_CLUSTERS
+
+# number of sectors copied at once
+BLOCK = 2048
+
+def geometry(fs, nsects):
+    # return sectors per FAT and number of clusters for the new partition
+    # size. FATs are never shrunk, so the data area only moves if the FAT
+    # has to grow
+    rootsecs = fs["ndirs"]//16
+    spf = max(fs["spf"], (nsects - fs["res"] - rootsecs + 256*fs["spc"]-1) // (256*fs["spc"]))
+    nclusters = min(256*spf-2, (nsects - fs["res"] - fs["nfats"]*spf - rootsecs) // fs["spc"])
+    return spf, nclusters
+
+def used_clusters(fat):
+    return [ c for c in range(2, len(fat)) if fat[c] and fat[c] != FAT_BAD ]
+
+def copy_sectors(f, src, dst, count):
+    # copy count sectors from src to dst. If both areas overlap with dst
+    # behind src, the copy has to be done back to front
+    if src == dst or not count: return
+
+    blocks = range(0, count, BLOCK)
+    if dst > src: blocks = reversed(blocks)
+
+    for b in blocks:
+        f.seek(512*(src+b))
+        data = f.read(512*min(BLOCK, count-b))
+        f.seek(512*(dst+b))
+        f.write(data)
+
+def fix_directories(f, start, fs, moves):
+    # update the start clusters of all directory entries incl. '.' and '..'
+    # to the clusters they were moved to
+    spc = fs["spc"]
+
+    def fix_dir(runs):
+        # runs are (sector, count) of the directory's contents
+        data = bytearray()
+        for sector, count in runs:
+            f.seek(512*sector)
+            data += f.read(512*count)
+
+        subdirs = [ ]
+        changed = False
+        for offset in range(0, len(data), 32):
+            if data[offset] == 0: break
+            attr = data[offset+11]
+            if data[offset] == 0xe5 or attr == 0x0f or attr & 0x08: continue
+
+            cluster = struct.unpack("<H", data[offset+26:offset+28])[0]
+            if cluster in moves:
+                cluster = moves[cluster]
+                data[offset+26:offset+28] = struct.pack("<H", cluster)
+                changed = True
+
+            if attr & 0x10 and data[offset] != ord("."):
+                subdirs.append(cluster)
+
+        if changed:
+            pos = 0
+            for sector, count in runs:
+                f.seek(512*sector)
+                f.write(data[pos:pos+512*count])
+                pos += 512*count
+
+        for cluster in subdirs:
+            fix_dir([ (start+fs["data"]+spc*(c-2), spc) for c in cluster_chain(fs["fat"], cluster) ])
+
+    fix_dir([ (start+fs["root"], fs["ndirs"]//16) ])
+
+def relocate(f, start, fs, limit):
+    # move all clusters at or behind limit to free clusters in front of it
+    fat = fs["fat"]
+    spc = fs["spc"]
+
+    free = ( c for c in range(2, limit) if not fat[c] )
+    moves = { c: next(free) for c in used_clusters(fat) if c >= limit }
+    if not moves: return 0
+
+    for c, n in moves.items():
+        copy_sectors(f, start+fs["data"]+spc*(c-2), start+fs["data"]+spc*(n-2), spc)
+
+    # relink all chains ...
+    for c in range(2, len(fat)):
+        if fat[c] in moves: fat[c] = moves[fat[c]]
+
+    # ... move the FAT entries themselves ...
+    for c, n in moves.items():
+        fat[n] = fat[c]
+        fat[c] = 0
+
+    # ... and update the directory entries
+    fix_directories(f, start, fs, moves)
+
+    return len(moves)
+
+def is_plain(f):
+    # compressed images and overlays cannot be modified in place
+    f.seek(0)
+    magic = f.read(8)
+    return magic != OVERLAY_MAGIC and not any(magic.startswith(c[0]) for c in COMPRESSION)
+
+def check_partition(img, start, length, drive):
+    # check the file system of a partition before modifying it and return
+    # its parameters
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        ok = partition_parse(img[start:start+length], { "quiet": True, "export-bootloader": None }, False)
+    if not ok:
+        print(log.getvalue(), end="")
+        print("Error, partition", drive, "is inconsistent")
+        return None
+
+    return read_layout(img[start:start+length])
+
+def resize_image(name, sizes, options):
+    # sizes are the new sizes of all partitions in sectors
+    print("== resizing '"+name+"' ==")
+
+    try:
+        f = open(name, "r+b")
+    except Exception as e:
+        print(str(e))
+        return False
+
+    with f:
+        if not is_plain(f):
+            print("Error, only plain images can be resized in place")
+            return False
+
+        img = SectorImage(f)
+        entries = list(partition_entries(img))
+        if not entries or any(pid != b"GEM" for flags, pid, start, length in entries):
+            print("Error, only images with GEM partitions can be resized")
+            return False
+
+        if len(sizes) < len(entries):
+            print("Error, partitions cannot be removed")
+            return False
+
+        # check all partitions before touching anything
+        parts = [ ]
+        for i, (flags, pid, start, length) in enumerate(entries):
+            drive = chr(ord("C")+i) + ":"
+
+            fs = check_partition(img, start, length, drive)
+            if not fs: return False
+
+            spf, nclusters = geometry(fs, sizes[i])
+            if nclusters > MAX_CLUSTERS:
+                print("Error, partition", drive, "would have too many clusters")
+                return False
+
+            used = used_clusters(fs["fat"])
+            if len(used) > nclusters:
+                print("Error, files on partition", drive, "don't fit into", sizes[i], "sectors")
+                return False
+
+            print("Partition", drive, length, "->", sizes[i], "sectors")
+            parts.append( (start, fs, spf, nclusters) )
+
+        # move the clusters behind the new end of shrinking partitions
+        for i, (start, fs, spf, nclusters) in enumerate(parts):
+            moved = relocate(f, start, fs, nclusters+2)
+            if moved: print("Moved", moved, "clusters on partition", chr(ord("C")+i)+":")
+
+        # shift the bootsectors and the root directories and used clusters
+        # to the new partition starts
+        layout, total = partition_layout([ { "size": s } for s in sizes ])
+        copies = [ ]
+        for i, (start, fs, spf, nclusters) in enumerate(parts):
+            new = layout[i][1]
+            last = max(used_clusters(fs["fat"]), default=1)
+            copies.append( (start, new, fs["res"]) )
+            copies.append( (start+fs["root"], new+fs["res"]+fs["nfats"]*spf, fs["ndirs"]//16 + fs["spc"]*(last-1)) )
+
+        f.seek(0, 2)
+        if f.tell() < 512*total: f.truncate(512*total)
+
+        # areas moving to the front are copied first, front to back, then
+        # those moving to the end, back to front. This way no area is
+        # overwritten before it has been copied
+        for src, dst, count in sorted(c for c in copies if c[1] < c[0]):
+            copy_sectors(f, src, dst, count)
+        for src, dst, count in sorted((c for c in copies if c[1] > c[0]), reverse=True):
+            copy_sectors(f, src, dst, count)
+
+        # write the FATs and update the bootsectors
+        for i, (start, fs, spf, nclusters) in enumerate(parts):
+            new = layout[i][1]
+
+            fat = fs["fat"][:256*spf]
+            fat.extend(array("H", [0]) * (256*spf - len(fat)))
+            if sys.byteorder != "little": fat.byteswap()
+            for n in range(fs["nfats"]):
+                f.seek(512*(new+fs["res"]+n*spf))
+                f.write(fat.tobytes())
+
+            f.seek(512*new)
+            bootsector = bytearray(f.read(512))
+            bootable = check_csum(bootsector)
+            bootsector[19:21] = struct.pack("<H", sizes[i])
+            bootsector[22:24] = struct.pack("<H", spf)
+            if bootable: adjust_csum(bootsector)
+            f.seek(512*new)
+            f.write(bootsector)
+
+        # append new empty partitions
+        for i in range(len(parts), len(sizes)):
+            f.seek(512*layout[i][1])
+            write_partition(f, { "size": sizes[i], "files": [ ] }, options, i, None)
+
+        # finally write the new partition table
+        partitions = [ { "size": s } for s in sizes ]
+        f.seek(0)
+        mbr = bytearray(f.read(512))
+        bootable = check_csum(mbr)
+        mbr[0x1c6:0x1f6] = bytes(48)
+        partition_table(mbr, partitions, entries[0][0] & 0x80)
+        if bootable: adjust_csum(mbr)
+        f.seek(0)
+        f.write(mbr)
+
+        for i in range(len(sizes)):
+            if layout[i][0] != None:
+                f.seek(512*layout[i][0])
+                f.write(xgm_root(partitions, layout, i))
+
+        f.seek(0, 2)
+        if f.tell() > 512*total: f.truncate(512*total)
+
+    return True
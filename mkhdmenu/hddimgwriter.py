@@ -1,6 +1,192 @@
-import struct, random
-
-from bootloader import BOOTLOADER
+import struct, random, os, stat, shutil, tempfile, hashlib
+
+import bootloader
+from payloadstore import view
+from hddimgreader import open_compressed, open_image, OVERLAY_MAGIC, OVERLAY_HEADER, DIR_ENTRY
+from hddimgentry import tree_signature
+
+# extra sectors between MBR and first partition. Typically 1
+EXTRA = 1
+
+# shared block of zeros used to write free space without allocating it
+ZERO_BLOCK = bytes(65536)
+
+# cluster sizes tried by the automatic layout. TOS can't handle more than
+# 32766 clusters per partition
+SPC_CHOICES = ( 1, 2, 4, 8, 16, 32 )
+MAX_CLUSTERS = 32766
+
+class SyncFile:
+    # A write-only file object updating an existing image file or device.
+    # Data is compared block by block with what's already stored and only
+    # blocks that differ are being written, adjacent ones with a single write.
+    def __init__(self, name, block_size=65536, max_run=16*1024*1024):
+        self.f = open(name, "r+b" if os.path.exists(name) else "w+b")
+        self.block_size = block_size
+        self.max_run = max_run
+        
+        self.buffer = bytearray()   # data not yet compared
+        self.pos = 0                # target offset of buffer
+        self.run = [ ]              # differing blocks not yet written ...
+        self.run_start = 0          # ... and their target offset
+        self.written = 0
+        self.skipped = 0
+
+    def write(self, data):
+        self.buffer += data
+
+        # compare all complete blocks, the existing data is read in large
+        # chunks of several blocks
+        if len(self.buffer) >= 16*self.block_size:
+            self.sync(len(self.buffer) - len(self.buffer) % self.block_size)
+            
+        return len(data)
+
+    def sync(self, length):
+        # read the existing data for all blocks at once
+        self.f.seek(self.pos)
+        old = self.f.read(length)
+
+        for offset in range(0, length, self.block_size):
+            block = bytes(self.buffer[offset:min(offset+self.block_size, length)])
+            if old[offset:offset+self.block_size] == block:
+                self.flush_run()
+                self.skipped += len(block)
+            else:
+                if not self.run: self.run_start = self.pos + offset
+                self.run.append(block)
+                if len(self.run)*self.block_size >= self.max_run: self.flush_run()
+
+        del self.buffer[:length]
+        self.pos += length
+
+    def flush_run(self):
+        if not self.run: return
+
+        data = b"".join(self.run)
+        self.f.seek(self.run_start)
+        self.f.write(data)
+        self.written += len(data)
+        self.run = [ ]
+
+    def close(self):
+        self.sync(len(self.buffer))
+        self.flush_run()
+
+        # a target file may have been bigger than the new image
+        fd = self.f.fileno()
+        if stat.S_ISREG(os.fstat(fd).st_mode) and os.fstat(fd).st_size > self.pos:
+            self.f.truncate(self.pos)
+        
+        self.f.flush()
+        os.fsync(fd)
+        self.f.close()
+
+class OverlayFile:
+    # A write-only file object creating an overlay image on top of a base
+    # image. Data is compared sector by sector with the base and only the
+    # sectors that differ are being stored. They are collected in a
+    # temporary file as the extent table has to precede them
+    def __init__(self, name, base, chunk=2048):
+        self.name = name
+        self.chunk = chunk
+        if name != "-" and os.path.abspath(name) == os.path.abspath(base):
+            raise IOError("An overlay cannot replace its own base image")
+
+        self.base_name = base
+        self.base = open_image(base, True)
+        if not self.base: raise IOError("Unable to open base image " + base)
+        self.mtime = os.stat(base).st_mtime_ns
+        self.sha1 = hashlib.sha1()
+
+        self.buffer = bytearray()   # data not yet compared
+        self.pos = 0                # sector of buffer
+        self.extents = [ ]          # [ start, count ] of sectors stored
+        self.data = tempfile.TemporaryFile()
+        self.written = 0
+        self.skipped = 0
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= 512*self.chunk:
+            self.compare(self.chunk)
+
+        return len(data)
+
+    def compare(self, count):
+        old = self.base.read(self.pos, count)
+        self.sha1.update(old)
+
+        for i in range(count):
+            sector = self.buffer[512*i:512*(i+1)]
+            if old[512*i:512*(i+1)] == sector:
+                self.skipped += 512
+                continue
+
+            if self.extents and sum(self.extents[-1]) == self.pos+i:
+                self.extents[-1][1] += 1
+            else:
+                self.extents.append([self.pos+i, 1])
+            self.data.write(sector)
+            self.written += 512
+
+        del self.buffer[:512*count]
+        self.pos += count
+
+    def close(self):
+        if len(self.buffer) % 512: self.buffer += bytes(512 - len(self.buffer) % 512)
+        while self.buffer:
+            self.compare(min(self.chunk, len(self.buffer)//512))
+
+        # the base image's checksum covers all of it
+        for s in range(self.pos, len(self.base), self.chunk):
+            self.sha1.update(self.base.read(s, self.chunk))
+
+        # the base is referenced relative to the overlay
+        if self.name == "-": base_name = os.path.abspath(self.base_name)
+        else:                base_name = os.path.relpath(os.path.abspath(self.base_name), os.path.dirname(os.path.abspath(self.name)))
+        base_name = base_name.encode("utf-8")
+
+        header = struct.pack(OVERLAY_HEADER, OVERLAY_MAGIC, self.pos, len(self.extents), len(self.base), self.sha1.digest(), self.mtime, len(base_name)) + base_name
+        if len(header) > 512:
+            raise IOError("Base image name too long")
+
+        table = b"".join(struct.pack(">LL", start, count) for start, count in self.extents)
+
+        with open_compressed(self.name, "wb") as f:
+            f.write(header + bytes(512 - len(header)))
+            f.write(table + bytes(-len(table) % 512))
+            self.data.seek(0)
+            shutil.copyfileobj(self.data, f, 1024*1024)
+
+        self.data.close()
+        self.base.close()
+
+def open_output(name, options):
+    if options.get("overlay"):
+        # only store what differs from the base image
+        return OverlayFile(name, options["overlay"])
+
+    if options.get("sync"):
+        # only write what differs from the existing image/device
+        return SyncFile(name)
+
+    # name may end with .gz, .bz2, .xz or .zst for a compressed image
+    return open_compressed(name, "wb")
+
+def print_output_stats(f, options):
+    if options.get("overlay"):
+        print("Sectors stored:                  ", f.written//512)
+        print("Sectors taken from base:         ", f.skipped//512)
+    elif options.get("sync"):
+        print("Bytes written:                   ", f.written)
+        print("Bytes unchanged:                 ", f.skipped)
+
+def write_zeros(f, count):
+    zero = memoryview(ZERO_BLOCK)
+    while count > 0:
+        f.write(zero[:min(count, len(zero))])
+        count -= len(zero)
 
 # parse hexdump and create a 512 byte sector from it
 def hex2sector(hexdump):
@@ -31,17 +217,58 @@ def file_exists(fs, name):
     # search for a file in root dir only
     
     for d in fs:
-        if d["name"] == name:
+        if d.name == name:
             return d
 
     return None
     
+def partition_layout(partitions):
+    # return the extended root sector (or None) and the start sector of each
+    # partition and the total number of sectors. The MBR holds up to four
+    # partitions. With more than that the fourth entry becomes an XGM
+    # partition chaining all further ones, each preceded by its root sector
+    begin = EXTRA+1              # mbr + 1 unused sector
+    layout = [ ]
+    for i in range(len(partitions)):
+        if len(partitions) > 4 and i >= 3:
+            layout.append( (begin, begin+1) )
+            begin += 1
+        else:
+            layout.append( (None, begin) )
+        begin += partitions[i]["size"]
+
+    return layout, begin
+
+def xgm_root(partitions, layout, i):
+    # create the extended root sector of partition i. The partition itself
+    # is relative to the root sector, the link to the next root sector is
+    # relative to the first one
+    sec = bytearray(512)
+    root, start = layout[i]
+    sec[0x1c6:0x1d2] = struct.pack(">B3sLL", 0x01, b"GEM", start-root, partitions[i]["size"])
+    if i+1 < len(partitions):
+        sec[0x1d2:0x1de] = struct.pack(">B3sLL", 0x01, b"XGM", layout[i+1][0]-layout[3][0], 1+partitions[i+1]["size"])
+
+    return sec
+
+def partition_table(mbr, partitions, bootable=False):
+    # write the total media size and the partition entries into the MBR
+    layout, total = partition_layout(partitions)
+    mbr[0x1c2:0x1c6] = struct.pack(">L", total)
+
+    for i in range(min(len(partitions), 4)):
+        if layout[i][0] != None:
+            # all remaining partitions are inside the XGM partition
+            mbr[0x1c6+12*i:0x1c6+12*(i+1)] = struct.pack(">B3sLL", 0x01, b"XGM", layout[i][0], total-layout[i][0])
+            break
+
+        # TODO: check if data actually fits into a regular 'GEM' partition
+        # set bootable flag if bootloader is to be included
+        mbr[0x1c6+12*i:0x1c6+12*(i+1)] = struct.pack(">B3sLL", 0x81 if i == 0 and bootable else 0x01, b"GEM", layout[i][1], partitions[i]["size"])
+
 def write_mbr(f, partitions, options, driver=None):
     print("Writing MBR")
 
-    # extra sectors between MBR and first partition. Typically 1
-    EXTRA = 1
-
     # write MBR and empty sectors incl. bootloader
     if driver:
         print("Including", driver["name"], "MBR bootloader")
@@ -50,21 +277,7 @@ def write_mbr(f, partitions, options, driver=None):
     else:
         mbr = bytearray(512)
 
-    # calculate required image size
-    begin = EXTRA+1              # mbr + 1 unused sector
-    total = begin
-    for p in partitions:
-        total += p["size"]
-
-    # write total media size
-    mbr[0x1c2:0x1c6] = struct.pack(">L", total)
-
-    # write partition entries
-    for i in range(len(partitions)):
-        # TODO: check if data actually fits into a regular 'GEM' partition
-        # set bootable flag if bootloader is to be included
-        mbr[0x1c6+12*i:0x1c6+12*(i+1)] = struct.pack(">B3sLL", 0x81 if i == 0 and driver else 0x01, b"GEM", begin, partitions[i]["size"])
-        begin += partitions[i]["size"]
+    partition_table(mbr, partitions, driver != None)
 
     if driver:
         adjust_csum(mbr)
@@ -73,144 +286,202 @@ def write_mbr(f, partitions, options, driver=None):
     f.write(mbr)
 
     # .. and the extra sectors
-    for i in range(EXTRA):
-        f.write(bytearray(512))
+    write_zeros(f, 512*EXTRA)
 
     return True
     
-def import_fs(fs, fat, data):
+def import_fs(fs, fat, data, spc=2):
+    csize = 512*spc
+
+    # the FAT may have more entries than there are clusters in the data area
+    limit = min(len(fat), len(data)//csize + 2)
+
+    # the first cluster that may still be free
+    free = [ 2 ]
+
+    def fat_allocate(size):
+        # allocate the clusters for size bytes and return them as a list of
+        # [start, count] extents. Clusters are allocated from the start, so
+        # a chain usually consists of a single extent
+        clusters = (size+csize-1)//csize
+        if not clusters: clusters = 1   # empty file uses one cluster
+
+        extents = [ ]
+        cur = free[0]
+        while clusters:
+            # search the next run of free clusters
+            while cur < limit and fat[cur]: cur += 1
+            if cur >= limit:
+                print("File system exceeded!")
+                return None
 
-    def import_dir(d, parent, fat, data):
-        def fat_allocate(fat, size):
-            chain = []
-            
-            # a cluster is always two sectors which in turn is always 1024 bytes                
-            clusters = (size+1023)//1024
-            if not clusters: clusters = 1   # empty file uses one cluster
-            
-            # search FAT for entries
-            # start search at FAT index 2
-            start = 2
-            while fat[start]: start += 1
-
-            cur = start
-            while clusters:
-                chain.append(cur)
-                
-                # will we need a next cluster?
-                if clusters > 1:                    
-                    next = cur+1
-
-                    # check if we reached end of fat (image is full)
-                    if next >= len(fat):
-                        print("File system exceeded!")
-                        return None
-                    
-                    while fat[next]: next += 1
-                else:
-                    # end of cluster chain marker
-                    next = 0xffff
-
-                fat[cur] = next
-                cur = next
-                clusters = clusters - 1
-
-            return chain
-        
+            count = 1
+            while count < clusters and cur+count < limit and not fat[cur+count]: count += 1
+            extents.append([cur, count])
+            clusters -= count
+
+            # link the clusters of this extent, the end of chain marker
+            # is replaced when another extent follows
+            fat[cur:cur+count] = range(cur+1, cur+count+1)
+            fat[cur+count-1] = 0xffff
+            if len(extents) > 1: fat[sum(extents[-2])-1] = cur
+            cur += count
+
+        free[0] = cur
+        return extents
+
+    def write_extents(extents, content):
+        # copy content into the clusters with one slice per extent
+        offset = 0
+        for start, count in extents:
+            length = min(count*csize, len(content)-offset)
+            if length <= 0: break
+            data[csize*(start-2):csize*(start-2)+length] = content[offset:offset+length]
+            offset += length
+
+    def import_dir(d, parent):
+        # return the entries of a directory as tuples to be encoded by
+        # encode_directory
         entries = []
         for f in d:
-            # create a directory entry for this
-            entry = bytearray(32)
-
-            # write 8+3 file name
-            entry[0:11] = b"           "
-            name = f["name"].split(".")[0].encode("latin-1")
-            entry[0:len(name)] = name
-            if "." in f["name"]:
-                ext = f["name"].split(".",1)[1].encode("latin-1")
-                entry[8:8+len(ext)] = ext
-
-            # write date and time
-            entry[22:26] = struct.pack("<HH", f["time"], f["date"])
-            
-            if "subdir" in f:
+            # 8+3 file name
+            name, _, ext = f.name.partition(".")
+            name = name.encode("latin-1")
+            ext = ext.encode("latin-1")
+
+            if f.subdir != None:
                 # allocate enough space for all subdirectory entries
-                clusters = fat_allocate(fat, 32*(len(f["subdir"])+2))
-                if not clusters: print("Failure when processing", f["name"])
-                
-                entry[11] = 0x10
+                extents = fat_allocate(32*(len(f.subdir)+2))
+                if not extents:
+                    print("Failure when processing", f.name)
+                    return None
+                cluster = extents[0][0]
 
                 # create '.' and '..' entries
-                dot_entry = bytearray(32)
-                dot_entry[0:11] = b".          "  # name
-                dot_entry[11] = 0x10              # attr
-                dot_entry[22:26] = struct.pack("<HH", f["time"], f["date"])
-                dot_entry[26:28] = struct.pack("<H", clusters[0])
-
-                dotdot_entry = bytearray(32)
-                dotdot_entry[0:11] = b"..         "  # name
-                dotdot_entry[11] = 0x10              # attr
-                dotdot_entry[22:26] = struct.pack("<HH", f["time"], f["date"])
-                dotdot_entry[26:28] = struct.pack("<H", parent)
-
-                subdir = [ dot_entry, dotdot_entry ]
-                subdir.extend(import_dir(f["subdir"], clusters[0], fat, data))
+                subdir = [ (b".", b"", 0x10, f.time, f.date, cluster, 0),
+                           (b"..", b"", 0x10, f.time, f.date, parent, 0) ]
+                sub = import_dir(f.subdir, cluster)
+                if sub == None: return None
+                subdir.extend(sub)
 
                 # write directory entries into clusters allocated by fat_allocate
-                cluster = 0
-                while subdir:
-                    # we can write 16 entries per sector and two sectors per cluster
-                    sector = 0
-                    while subdir and sector < 2: 
-                    
-                        index = 0
-                        while subdir and index < 16: 
-                            data[2*(clusters[cluster]-2)+sector][32*index:32*(index+1)] = subdir[0]
-
-                            subdir = subdir[1:]                                  
-                            index += 1
-                        sector += 1
-                    cluster += 1
-                            
-                # save start cluster in entry
-                entry[26:28] = struct.pack("<H", clusters[0]) 
+                write_extents(extents, encode_directory(subdir))
+
+                entries.append( (name, ext, 0x10, f.time, f.date, cluster, 0) )
             else:
                 # import a regular file
-                # print("import", f["name"], "len", f["size"])
-                
-                # no need to write attribute byte as it's set to zero by default
-                # write file length
-                entry[28:32] = struct.pack("<L", len(f["data"]))                
-
-                clusters = fat_allocate(fat, len(f["data"]))
-                if not clusters: print("Failure when processing", f["name"])
-
-                offset = 0
-                for c in clusters:
-                    # write data to both sectors of a cluster
-                    for s in range(2):
-                        bytes2copy = 512 if len(f["data"])-offset > 512 else len(f["data"])-offset
-                        if bytes2copy:
-                            data[2*(c-2)+s][0:bytes2copy] = f["data"][offset:offset+bytes2copy]
-                            
-                        offset += bytes2copy
-                
-                # save start cluster in entry
-                entry[26:28] = struct.pack("<H", clusters[0]) 
-
-            if len(entry) != 32:
-                # this is actually an internal error and should never happen
-                print("Error, directory length mismatch", len(entry))
-                return None
-                
-            entries.append(entry)                
+                extents = fat_allocate(len(f.data))
+                if not extents:
+                    print("Failure when processing", f.name)
+                    return None
+
+                # spilled contents are copied straight from the spill file
+                write_extents(extents, view(f.data))
+
+                entries.append( (name, ext, 0, f.time, f.date, extents[0][0], len(f.data)) )
 
         return entries
-            
-    return import_dir(fs, 0, fat, data)
-    
+
+    entries = import_dir(fs, 0)
+    if entries == None: return None
+    return encode_directory(entries)
+
+def encode_directory(entries):
+    # pack all entries into one buffer in a single pass. Names are padded
+    # with spaces, their lengths have been checked by check_names
+    data = bytearray(DIR_ENTRY.size*len(entries))
+    for i, (name, ext, attr, time, date, cluster, size) in enumerate(entries):
+        DIR_ENTRY.pack_into(data, DIR_ENTRY.size*i, name.ljust(8), ext.ljust(3), attr, time, date, cluster, size)
+
+    return data
+
+def check_names(fs, path=""):
+    # check that all names fit into 8+3 directory entries and are unique
+    # within their directory, as they'd be truncated otherwise
+    names = set()
+    for f in fs:
+        name, _, ext = f.name.partition(".")
+        try:
+            valid = 0 < len(name.encode("latin-1")) <= 8 and len(ext.encode("latin-1")) <= 3
+        except UnicodeEncodeError:
+            valid = False
+
+        if not valid:
+            print("Error, invalid 8+3 file name", path+f.name)
+            return False
+        if f.name.upper() in names:
+            print("Error, duplicate file name", path+f.name)
+            return False
+        names.add(f.name.upper())
+
+        if f.subdir != None and not check_names(f.subdir, path+f.name+"\\"):
+            return False
+
+    return True
+
+def count_clusters(fs, csize):
+    # number of clusters needed to store a file tree
+    clusters = 0
+    for f in fs:
+        if f.subdir != None:
+            clusters += (32*(len(f.subdir)+2)+csize-1)//csize
+            clusters += count_clusters(f.subdir, csize)
+        else:
+            clusters += max(1, (len(f.data)+csize-1)//csize)
+
+    return clusters
+
+def fat_layout(nsects, spc, ndirs):
+    # return the number of sectors per FAT and the number of usable clusters.
+    # Each FAT sector holds 256 entries of spc sectors each
+    spf = ((nsects - 1 - ndirs//16) + 256*spc-1) // (256*spc)
+    nclusters = min(256*spf-2, (nsects - 2*spf - ndirs//16 - 1) // spc)
+    return spf, nclusters
+
+def choose_layout(part, options):
+    # return sectors per cluster and number of root directory entries
+    spc = options.get("spc")
+    if spc != "auto":
+        return int(spc) if spc else 2, 416
+
+    # root directory rounded up to multiples of 32 entries (two sectors)
+    ndirs = max(32, (len(part["files"])+31)//32*32)
+
+    # pick the cluster size leaving the most space after importing all files.
+    # Bigger clusters need a smaller FAT but waste more space at the end of
+    # each file
+    best = None
+    for spc in SPC_CHOICES:
+        spf, nclusters = fat_layout(part["size"], spc, ndirs)
+        if nclusters > MAX_CLUSTERS: continue
+
+        free = (nclusters - count_clusters(part["files"], 512*spc)) * 512*spc
+        if best == None or free > best[0]:
+            best = (free, spc)
+
+    return best[1], ndirs
+
+def check_fits(part, options, drive):
+    # check if all files fit into the partition before anything is written
+    spc, ndirs = choose_layout(part, options)
+    nclusters = fat_layout(part["size"], spc, ndirs)[1]
+
+    if len(part["files"]) > ndirs:
+        print("Error, too many files in the root directory of", chr(ord("C")+drive)+":")
+        return False
+
+    if not check_names(part["files"], chr(ord("C")+drive)+":\\"):
+        return False
+
+    needed = count_clusters(part["files"], 512*spc)
+    if needed > nclusters:
+        print("Error, files need", needed, "clusters but partition", chr(ord("C")+drive)+":", "only has", nclusters)
+        return False
+
+    return True
+
 def write_partition(f, part, options, drive, driver):
-    print("Creating Partition", ["C:","D:","E:","F:"][drive])
+    print("Creating Partition", chr(ord("C")+drive)+":")
 
     # ========================== create boot sector ==================================
     if drive == 0 and driver:
@@ -220,18 +491,19 @@ def write_partition(f, part, options, drive, driver):
     else:
         bootsector = bytearray(512)
 
-    # TODO: calculate a sane number of root directory entries
-    ndirs = 416
+    spc, ndirs = choose_layout(part, options)
+    if options.get("spc") == "auto":
+        print("Using", spc, "sectors per cluster and", ndirs, "root directory entries")
 
     # calculate number of fat sectors needed
     nsects = part["size"]
-    spf = ((nsects - 1 - ndirs//16)+511) // 512  # 256 clusters of two sectors per cluster per sector
+    spf = fat_layout(nsects, spc, ndirs)[0]
 
     # the serial number should be random to detect media changes
     random_serial = bytearray([random.randint(0,255) for i in range(3)])
     
     # setup bootsector values
-    bootsector[2:16] = struct.pack("<6s3sHBH", bytearray([0,0,0,0,0,0]), random_serial, 512, 2, 1)
+    bootsector[2:16] = struct.pack("<6s3sHBH", bytearray([0,0,0,0,0,0]), random_serial, 512, spc, 1)
     bootsector[16:30] = struct.pack("<BHHBHHHH", 2, ndirs, nsects, 0xf8, spf, 0,0,0) 
 
     # adjust checksum to make bootsector bootable
@@ -240,7 +512,8 @@ def write_partition(f, part, options, drive, driver):
     f.write(bootsector)
 
     # ========================== create data area ==================================
-    data = [bytearray(512) for x in range(nsects-2*spf-ndirs//16-1)]
+    # a zero initialized buffer doesn't occupy memory until it's being written to
+    data = bytearray(512*(nsects-2*spf-ndirs//16-1))
     
     # ========================== setup empty FAT ==================================
     fat = [0 for x in range(spf*256)]   # 256 FAT16 entries per sector    
@@ -248,84 +521,121 @@ def write_partition(f, part, options, drive, driver):
     fat[1] = 0xffff
     
     # ========================== populate file system ==================================
-    rootdir = import_fs(part["files"], fat, data)
+    rootdir = import_fs(part["files"], fat, data, spc)
+    if rootdir == None: return False
 
     # write FAT twice
     print("Writing FATs ...")    
+    fat_data = struct.pack("<"+str(len(fat))+"H", *fat)
     for j in range(2):
-        for i in range(spf):
-            sec = bytearray(512)
-            for e in range(256): sec[2*e:2*e+2] = struct.pack("<H", fat[256*i+e])
-            f.write(sec)
+        f.write(fat_data)
         
     # write root directory
     print("Writing root directory ...")    
-    if len(rootdir) > ndirs:
+    if len(rootdir) > 32*ndirs:
         print("Error, root directory overflow")
         return False
 
-    for s in range(ndirs//16):
-        sec = bytearray(512)
-
-        # write root dir entries into sector
-        e = 0
-        while len(rootdir) and e < 16:
-            sec[e*32:(e+1)*32] = rootdir[0]
-            rootdir = rootdir[1:]
-            e += 1
-        
-        # this is an internal error and indicates that this script is broken ...
-        if len(sec) != 512: print("Error, invalid directory sector length", len(sec))        
-        f.write(sec)
+    f.write(rootdir)
+    write_zeros(f, 32*ndirs - len(rootdir))
     
-    # write data area
+    # write data area. Clusters are allocated from the start, so everything
+    # behind the last allocated cluster is free space and written as zeros
     print("Writing data ...")    
-    for sector in data:
-        # this is an internal error and indicates that this script is broken ...
-        if len(sector) != 512: print("Error, invalid data sector length", len(sector))        
-        f.write(sector)
+    used = len(fat)
+    while used > 2 and not fat[used-1]: used -= 1
+    used = min(len(data), 512*spc*(used-2))
+
+    # this is an internal error and indicates that this script is broken ...
+    if len(data) != 512*(nsects-2*spf-ndirs//16-1): print("Error, invalid data area length", len(data))
+    
+    f.write(memoryview(data)[:used])
+    write_zeros(f, len(data)-used)
 
     return True
     
+def is_untouched(part, options):
+    # a partition read from an image can be copied as is unless files have
+    # been added to it or its cluster size is to be changed
+    return "sectors" in part and not options.get("spc") and len(part["sectors"]) == part["size"] and \
+        tree_signature(part["files"]) == part["signature"]
+
+def copy_partition(f, part, drive, chunk=2048):
+    # copy the partition sector by sector, incl. its bootsector and serial
+    print("Copying unmodified partition", chr(ord("C")+drive)+":")
+    sectors = part["sectors"]
+    for s in range(0, len(sectors), chunk):
+        f.write(b"".join(sectors[s:s+chunk]))
+
 def write_hddimage(name, partitions, options):
     print("== writing '"+name+"' ==")
 
+    # don't leave a partially written image behind if files don't fit
+    for p in range(len(partitions)):
+        if not is_untouched(partitions[p], options) and not check_fits(partitions[p], options, p):
+            return False
+
     try:
-        f = open(name, "wb")
+        f = open_output(name, options)
     except Exception as e:
         print("Exception:", str(e))
         return False
 
     # check if filesytem contains a known harddisk driver
     driver = None
-    for d in BOOTLOADER:
-        if len(partitions):
-            bloader = file_exists(partitions[0]["files"], d["file"])
-            if bloader:
-                print("Partition C: contains", d["name"], d["file"])
-            
-                # check if we are supposed to patch the boot loader
-                if "patch" in d:
-                    print("Applying bootloader patches:", d["patchdesc"])
-                    data = list(bloader["data"])
-                    for patch in d["patch"]:
-                        if data:
-                            if data[patch[0]] == patch[1]:
-                                data[patch[0]] = patch[2]
-                            else:
-                                print("Patch failed")
-                                data = None
-                    
-                if data:
-                    bloader["data"] = data
-                    
-                driver = d
-    
+    if len(partitions):
+        for bloader in partitions[0]["files"]:
+            if bloader.subdir != None or not bloader.name in bootloader.FILES: continue
+            driver = bootloader.identify(bloader.name, view(bloader.data))
+            if driver: break
+
+    if driver:
+        print("Partition C: contains", driver["name"], bloader.name)
+
+        # check if we are supposed to patch the boot loader
+        if "patches" in driver:
+            print("Applying bootloader patches:", driver["patchdesc"])
+            data = bootloader.patch(driver, view(bloader.data))
+            if data and data != view(bloader.data): bloader.data = data
+
     write_mbr(f, partitions, options, driver)
 
+    layout = partition_layout(partitions)[0]
     for p in range(len(partitions)):
-        write_partition(f, partitions[p], options, p, driver)
+        if layout[p][0] != None: f.write(xgm_root(partitions, layout, p))
+        if is_untouched(partitions[p], options):
+            copy_partition(f, partitions[p], p)
+        else:
+            if not write_partition(f, partitions[p], options, p, driver):
+                f.close()
+                return False
     
     f.close()
+    print_output_stats(f, options)
+
+    return True
+
+def copy_image(name, dst, options, chunk=2048):
+    # write an image sector by sector. This flattens an overlay into a plain
+    # image or, with the overlay option, turns an image into an overlay
+    img = open_image(name)
+    if not img: return False
+
+    print("== writing '"+dst+"' ==")
+
+    try:
+        if hasattr(img, "check_base") and not img.check_base():
+            raise IOError("Base image of " + name + " has changed")
+
+        f = open_output(dst, options)
+        for s in range(0, len(img), chunk):
+            f.write(img.read(s, chunk))
+        f.close()
+    except Exception as e:
+        print("Exception:", str(e))
+        img.close()
+        return False
 
+    img.close()
+    print_output_stats(f, options)
     return True
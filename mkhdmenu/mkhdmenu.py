@@ -13,31 +13,93 @@
 # TODO:
 # - support variable sector size (bgm)
 
-import sys, os, datetime
-from io import BytesIO
-
-from hddimgreader import read_hddimage
-from hddimgwriter import write_hddimage
+import sys, os, datetime, glob, collections
+
+from hddimgreader import read_hddimage, read_floppy
+from hddimgentry import Entry
+from hddimgwriter import write_hddimage, copy_image, choose_layout, fat_layout, count_clusters
+from hddimgextract import extract_image
+from hddimgdiff import diff_images
+from hddimgresize import resize_image
+from hddimgdefrag import defrag_image, DEFRAG_MODES
+from hddimgfloppy import write_floppy, FLOPPY_FORMATS
 import zipfile
-import urllib.request
+from download import download
+from archiveindex import ArchiveIndex
+from payloadstore import PayloadStore, view
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# partitions beyond the fourth one are stored in XGM extended partitions.
+# GEMDOS supports drives up to P:
+DRIVES = [ chr(ord("C")+i) + ":\\" for i in range(14) ]
 
-# up to four partitions are currently supported
-DRIVES = [ "C:\\", "D:\\", "E:\\", "F:\\" ]
+# archives games can be imported from
+ARCHIVES = ( ".zip", ".st", ".msa" )
+FLOPPIES = ( ".st", ".msa" )
+
+# floppies are built as a single partition named like the drive
+FLOPPY_DRIVE = "A:\\"
 
 def usage(msg=None):
     if msg: print("Error:", msg)    
     print("Usage mkhdmenu.py [options] <imagename|size|cfgfile> [commands...] [outname]")
+    print("      mkhdmenu.py [options] <cfgfile> [cfgfiles...]")
+    print("      mkhdmenu.py -floppy=<format> <src> [srcs...] <outname>")
     print("Options:")
     print("  -export-bootloader=<name>   if present export bootloaders from MBR and")
     print("                              bootsectors to <name>_mbr.bin and <name>_bootsector.bin")
     print("  -quiet                      print less output")
+    print("  -extract=<dir|tarfile|->    extract all files of the given image into a host")
+    print("                              directory, a (compressed) tar file or a tar stream")
+    print("                              on stdout (-). Partitions are named C, D, ...")
+    print("  -imgdiff=<oldimage>         compare the given image with <oldimage> and list")
+    print("                              layout differences and added, removed and changed files")
+    print("  -sync                       update an existing image file or device in place and only")
+    print("                              write the blocks that actually changed")
+    print("  -overlay=<baseimage>        write an overlay image storing only the sectors that")
+    print("                              differ from <baseimage>. Overlays can be used like")
+    print("                              any other image as long as the base is unchanged")
+    print("  -resize=<size>              change the partition sizes of an existing image in place,")
+    print("                              e.g. -resize=16M+8M+8M. Partitions may grow or shrink")
+    print("                              and new partitions are appended empty")
+    print("  -defrag=<min|boot>          make all files of an existing image contiguous in place.")
+    print("                              min only moves fragmented files, boot also packs all")
+    print("                              files to the front, those needed for booting first")
+    print("  -flatten=<outname>          copy the given image sector by sector to <outname>. This")
+    print("                              turns an overlay into a plain image or, with -overlay,")
+    print("                              a plain image into an overlay")
+    print("  -spc=<n|auto>               sectors per cluster of the partitions written (1, 2, 4, 8,")
+    print("                              16 or 32, default 2). auto picks the cluster and root")
+    print("                              directory size leaving the most free space. Not all")
+    print("                              harddisk drivers support other values than 2")
+    print("  -floppy=<format>            build .st or .msa floppy images instead, format is one")
+    print("                              of "+", ".join(FLOPPY_FORMATS))
+    print("  -plan                       build the file trees and report the space needed without")
+    print("                              writing an image. Archives found in the archive index")
+    print("                              are neither downloaded nor unpacked")
+    print("  -index=<file>               record the members of all archives unpacked in an index")
+    print("                              kept in <file>, e.g. ~/.cache/mkhdmenu/archives.json")
+    print("  -memory=<size>              memory for the contents of the files imported, e.g. 256M")
+    print("                              (default 512M). Any more is kept in a temporary file")
     print("<imagename|size>              name of existing hdd image to start with or size description")
     print("                              of the individual partitions like e.g. 16M+16384K for two")
-    print("                              partitions of 16 megabytes each")
+    print("                              partitions of 16 megabytes each. Images may be compressed")
+    print("                              (.gz, .bz2, .xz, .zst) and - reads the image from stdin")
+    print("                              Up to 14 partitions (C: to P:) are supported, those")
+    print("                              beyond the fourth one in XGM extended partitions")
+    print("                              Partitions of an image no files are added to are copied")
+    print("                              unchanged unless -spc is given")
+    print("[outname]                     name of the image to be written. It's compressed if the")
+    print("                              name ends with .gz, .bz2, .xz or .zst and - writes to stdout")
+    print("<cfgfile> [cfgfiles...]       build one image per config file. Archives shared by")
+    print("                              several configs are only downloaded once")
+    print("<src> [srcs...] <outname>     with -floppy copy all srcs into the root of one floppy.")
+    print("                              With a * in outname like floppies/*.msa each folder or")
+    print("                              archive inside the src directories gets its own floppy")
     print("Commands:")
     print("  dest=src                    copy src into the dest path in the image.")
-    print("                              Src can be a zip file, a single regular file or")
-    print("                              a entire directory like e.g.")
+    print("                              Src can be a zip file, a .st or .msa floppy image,")
+    print("                              a single regular file or a entire directory like e.g.")
     print("                              C:\\GAMES\\BUBLGOST=zips/Bubble_Ghost.zip")
     print("")
     print("Bootloaders for AHDI and ICD will be installed in the MBR and the bootsector of")
@@ -65,14 +127,14 @@ def statistics(partitions):
         s = { "files":0, "directories":1, "datasize":0 }
         
         for i in fs:
-            if "subdir" in i:
-                d = fs_statistics(i["subdir"])
+            if i.subdir != None:
+                d = fs_statistics(i.subdir)
                 s["files"] += d["files"]
                 s["directories"] += d["directories"]
                 s["datasize"] += d["datasize"]
-            elif "data" in i:
+            elif i.data != None:
                 s["files"] += 1
-                s["datasize"] += len(i["data"])
+                s["datasize"] += len(i.data)
 
         return s
 
@@ -92,16 +154,31 @@ def statistics(partitions):
     print("Total number of files:           ", files)
     print("Total data bytes:                ", datasize)
 
+def plan_report(partitions, options):
+    # report the space the files will take without writing anything
+    print("== Plan ==")
+    ok = True
+    for p in range(len(partitions)):
+        spc, ndirs = choose_layout(partitions[p], options)
+        nclusters = fat_layout(partitions[p]["size"], spc, ndirs)[1]
+        needed = count_clusters(partitions[p]["files"], 512*spc)
+        print("Partition", DRIVES[p], "needs", needed, "of", nclusters, "clusters")
+        if needed > nclusters or len(partitions[p]["files"]) > ndirs:
+            print("Error, files don't fit into partition", DRIVES[p])
+            ok = False
+
+    return ok
+
 def dump_trees(partitions):
     # TODO: determine max depth first and adjust size offset dynamically
     
     def dump_tree(prefix, fs):
         for f in fs:
-            if "subdir" in f:
-                print(prefix+f["name"]+"\\")
-                dump_tree(prefix+"  ", f["subdir"])
+            if f.subdir != None:
+                print(prefix+f.name+"\\")
+                dump_tree(prefix+"  ", f.subdir)
             else:
-                print(prefix+f["name"], (" "*24)[:-len(f["name"]+prefix)-len(str(len(f["data"])))], len(f["data"]), " ", timestr(f["time"]), " ", datestr(f["date"]))
+                print(prefix+f.name, (" "*24)[:-len(f.name+prefix)-len(str(len(f.data)))], len(f.data), " ", timestr(f.time), " ", datestr(f.date))
 
     for i in range(len(partitions)):
         print("== Files on partition",DRIVES[i],"==")
@@ -110,11 +187,11 @@ def dump_trees(partitions):
 def find_file(partitions, name):
     def find_file_int(prefix, fs, name):
         for f in fs:
-            if "subdir" in f:
-                if find_file_int(prefix+f["name"]+"\\", f["subdir"], name):
+            if f.subdir != None:
+                if find_file_int(prefix+f.name+"\\", f.subdir, name):
                     return True
             else:
-                if prefix+f["name"] == name:
+                if prefix+f.name == name:
                     return True
 
         return False
@@ -132,37 +209,37 @@ def find_file(partitions, name):
 
 def get_file(flist, name):
     for f in flist:
-        if f["name"] == name:            
+        if f.name == name:            
             return f
 
-        if "subdir" in f:
-            h = get_file(f["subdir"], name)
+        if f.subdir != None:
+            h = get_file(f.subdir, name)
             if h: return h
         
     return None
     
 def add_file(files, file):
     # process path ...
-    for p in file["name"].split("\\")[:-1]:
+    for p in file.name.split("\\")[:-1]:
         d = get_file(files, p)
         if not d:            
             # create directory if it doesn't exist yet
-            d = { "name": p, "subdir": [], "time": file["time"], "date": file["date"] }
+            d = Entry(p, file.time, file.date, subdir=[])
             files.append(d)
 
-        if not "subdir" in d:
+        if d.subdir == None:
             print("Error, is not a directory", p)
             return False
             
-        files = d["subdir"]
+        files = d.subdir
 
     # ... and add the file itself
-    file["name"] = file["name"].split("\\")[-1]
+    file.name = file.name.split("\\")[-1]
 
     index = None
     # check if the file already exists
     for i in range(len(files)):
-        if files[i]["name"] == file["name"]:
+        if files[i].name == file.name:
             index = i
 
     if index != None:
@@ -172,18 +249,176 @@ def add_file(files, file):
     
     return True
 
-def import_zip(drive, partition, src, dst, prg):
-    # check if src is a (downloaded) byte array
-    name = None
-    if isinstance(src, tuple):
-        name = src[0]
-        src = BytesIO(src[1])
-    try:            
+def has_file(files, name, data):
+    # check if a file with the given path and contents already exists, so
+    # a partition read from an image isn't changed by writing it again
+    for p in name.split("\\")[:-1]:
+        files = next((f.subdir for f in files if f.name == p and f.subdir != None), None)
+        if files == None: return False
+
+    f = next((f for f in files if f.name == name.split("\\")[-1] and f.subdir == None), None)
+    return f != None and view(f.data) == data
+
+# archives are downloaded and unpacked only once per run, even if they
+# are being used by several images
+archive_cache = { }
+
+# the members of all archives ever unpacked are kept in an index on disk.
+# When only planning a build, indexed archives aren't fetched at all
+archive_index = None
+planning = False
+
+# the contents of all files imported, spilled to disk beyond a memory budget
+payloads = PayloadStore()
+
+def bounded_map(pool, fn, items, ahead):
+    # like pool.map, but only up to ahead items are processed in advance,
+    # so the results waiting to be consumed don't pile up in memory
+    jobs = collections.deque()
+    for item in items:
+        jobs.append(pool.submit(fn, item))
+        if len(jobs) > ahead: yield jobs.popleft().result()
+    while jobs: yield jobs.popleft().result()
+
+def unzip(src):
+    # read all members of a zip archive into a list of (filename, date_time, data)
+    try:
         archive = zipfile.ZipFile(src, 'r')
     except Exception as e:
         print(str(e))
         return None
 
+    members = [ ]
+    for info in archive.infolist():
+        members.append( (info.filename, info.date_time, archive.read(info)) )
+
+    archive.close()
+    return members
+
+def load_floppy(src):
+    # return the raw contents of a local or remote floppy image
+    if src.lower().startswith("http://") or src.lower().startswith("https://"):
+        print("Downloading", src)
+        data = download(src)
+        return data.getvalue() if data else None
+
+    try:
+        with open(src, "rb") as f:
+            return f.read()
+    except Exception as e:
+        print(str(e))
+        return None
+
+def load_archive(src):
+    # floppy images are read like ZIP archives
+    if src.lower().endswith(FLOPPIES):
+        data = load_floppy(src)
+        return read_floppy(data) if data else None
+
+    # check if this is a web url
+    if src.lower().startswith("http://") or src.lower().startswith("https://"):
+        print("Downloading", src)
+        data = download(src)
+        return unzip(data) if data else None
+
+    return unzip(src)
+    
+def index_archive(src, members):
+    if not archive_index or not members: return
+
+    name = src.replace("\\","/").split("/")[-1].split(".")[0]
+    executable = game_path(name, members)[1]
+    archive_index.add(src, members, executable)
+
+def cache_archive(src, members):
+    # index the members first, the contents are needed for their hash
+    index_archive(src, members)
+    if members: members = [ (filename, dt, payloads.put(data)) for filename, dt, data in members ]
+    archive_cache[src] = members
+
+def fetch_archive(src):
+    if not src in archive_cache:
+        if planning and archive_index and archive_index.lookup(src):
+            archive_cache[src] = archive_index.members(src)
+        else:
+            cache_archive(src, load_archive(src))
+            if archive_index: archive_index.save()
+
+    return archive_cache[src]
+
+def is_url(src):
+    return src.lower().startswith("http://") or src.lower().startswith("https://")
+
+def prefetch_archives(srcs, workers=8):
+    # download and unpack all archives not yet cached in parallel. Downloads
+    # are I/O bound and thus done in threads. Local ZIP archives are
+    # inflated in separate processes as zipfile spends much time in python
+    # code for archives with many small members
+    srcs = [ s for s in dict.fromkeys(srcs) if not s in archive_cache ]
+
+    # planning works with the sizes from the index alone
+    if planning and archive_index:
+        for s in srcs:
+            members = archive_index.members(s)
+            if members: archive_cache[s] = members
+        srcs = [ s for s in srcs if not s in archive_cache ]
+
+    if not srcs: return
+
+    floppies = [ s for s in srcs if s.lower().endswith(FLOPPIES) ]
+    archives = [ s for s in srcs if not s.lower().endswith(FLOPPIES) and is_url(s) ]
+    local = [ s for s in srcs if not s.lower().endswith(FLOPPIES) and not is_url(s) ]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        images = pool.map(load_floppy, floppies)
+        for src, members in zip(archives, bounded_map(pool, load_archive, archives, workers)):
+            cache_archive(src, members)
+        images = list(images)
+
+    if len(local) > 1:
+        with ProcessPoolExecutor() as pool:
+            for src, members in zip(local, bounded_map(pool, unzip, local, os.cpu_count() or 1)):
+                cache_archive(src, members)
+    else:
+        for src in local:
+            cache_archive(src, unzip(src))
+
+    # floppy images are parsed in pure python, so they are decoded in
+    # separate processes
+    for src, data in zip(floppies, images):
+        if not data: archive_cache[src] = None
+    floppies = [ (src, data) for src, data in zip(floppies, images) if data ]
+
+    if len(floppies) > 1:
+        with ProcessPoolExecutor() as pool:
+            for (src, _), members in zip(floppies, pool.map(read_floppy, [ data for _, data in floppies ])):
+                cache_archive(src, members)
+    else:
+        for src, data in floppies:
+            cache_archive(src, read_floppy(data))
+
+    if archive_index: archive_index.save()
+
+def game_path(name, members):
+    # derive the path of a game from the executable found in its archive
+    # and return it along with the executable
+    for filename, _, _ in members:
+        for prg_name in PPERA_PRG:
+            if filename.lower().endswith(prg_name.lower()):
+                # check if there's a full path in the name
+                return ("GAMES\\" if "/" in filename else "GAMES\\"+name+"\\"), filename
+
+    for filename, _, _ in members:
+        if filename.lower().endswith(".prg"):
+            return "GAMES\\"+filename.split(".")[0]+"\\", filename
+
+    return None, None
+
+def import_archive(drive, partition, src, dst, prg):
+    # src is a tuple of the archive's base name and its members
+    name, members = src
+    if members == None:
+        return None
+
     # make sure destination ends with a "\" as we are
     # importing whole directories
     if dst:
@@ -194,49 +429,34 @@ def import_zip(drive, partition, src, dst, prg):
             # prg was explicitely given
             dst = "GAMES\\"+prg+"\\"
         else:
-            dst = None
-            
             # search for PRG name and use it to create a path
-            for filename in archive.namelist():
-                for prg_name in PPERA_PRG:
-                    if not dst and filename.lower().endswith(prg_name.lower()):
-                        dst = "GAMES\\"
-                        # check if there's a full path in the name
-                        if not "/" in filename:                        
-                            dst += name + "\\"
-
-            if not dst:
-                for filename in archive.namelist():
-                    if not dst and filename.lower().endswith(".prg"):
-                        dst = "GAMES\\"+filename.split(".")[0]+"\\"
-                    
+            dst = game_path(name, members)[0]
+
         # cannot continue without path
         if not dst:
             print("No program path found in ZIP!")
             return None
 
-    for filename in archive.namelist():
+    for filename, dt, data in members:
         print("Creating", drive+dst+filename.replace("/","\\"))
-        with archive.open(filename) as f:
-            dt = archive.getinfo(filename).date_time
-            ftime = (dt[3] << 11) + (dt[4] << 5) + dt[5]//2
-            fdate = dt[2] + (dt[1] << 5) + ((dt[0]-1980)<<9)
+        ftime = (dt[3] << 11) + (dt[4] << 5) + dt[5]//2
+        fdate = dt[2] + (dt[1] << 5) + ((dt[0]-1980)<<9)
 
-            # adjust filename from unix to TOS style
-            filename = filename.replace("/","\\")
+        # adjust filename from unix to TOS style
+        filename = filename.replace("/","\\")
 
-            # ignore directory entries as they will be created whenever necessary
-            if filename[-1] != "\\":            
-                file = { "name": dst.upper()+filename.upper(), "data": f.read(), "time": ftime, "date":fdate }
-                if not add_file(partition, file):
-                    return None
+        # ignore directory entries as they will be created whenever necessary
+        if filename[-1] != "\\":            
+            file = Entry(dst.upper()+filename.upper(), ftime, fdate, data)
+            if not add_file(partition, file):
+                return None
 
     # if dst consists of "GAMES/" only, then the games path itself is inside the archive and
     # needs to be added for later name matching or csv generation
     if dst == "GAMES\\":
         # find all paths inside archive
         paths = []
-        for filename in archive.namelist():
+        for filename, _, _ in members:
             if "/" in filename:
                 if not filename.split("/")[0] in paths:
                     paths.append(filename.split("/")[0])
@@ -249,31 +469,53 @@ def import_zip(drive, partition, src, dst, prg):
     
     return drive + dst
 
-def import_directory(drive, partition, src, dst):
-    def import_dir(drive, partition, src, dst):
+def read_host_file(src):
+    # return timestamp and contents of a file on the host
+    try:
+        with open(src, 'rb') as f:
+            dt = datetime.datetime.fromtimestamp(os.fstat(f.fileno()).st_mtime, tz=datetime.timezone.utc)
+            data = f.read()
+    except Exception as e:
+        return str(e)
+
+    ftime = (dt.hour << 11) + (dt.minute << 5) + dt.second//2
+    fdate = dt.day + (dt.month << 5) + ((dt.year-1980)<<9)
+    return ftime, fdate, data
+
+def import_directory(drive, partition, src, dst, workers=8):
+    def scan_dir(src, dst):
         with os.scandir(src) as entries:
             dst_path = dst.upper()
             if len(dst_path): dst_path += "\\"
 
             for entry in entries:
                 if entry.is_file():
-                    import_file(drive, partition, src + "/" + entry.name, dst_path + entry.name.upper())                    
+                    files.append( (src + "/" + entry.name, dst_path + entry.name.upper()) )
 
                 elif entry.is_dir():
-                    import_dir(drive, partition, src+"/"+entry.name, dst_path + entry.name.upper())
+                    scan_dir(src+"/"+entry.name, dst_path + entry.name.upper())
 
     if len(dst) and dst[-1] == "\\": dst = dst[:-1]
     src = os.path.normpath(src)
-    
-    import_dir(drive, partition, src, dst)
+
+    # collect all files first, read them in parallel and then add them to
+    # the tree in the order they were found
+    files = [ ]
+    scan_dir(src, dst)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for (fsrc, fdst), content in zip(files, bounded_map(pool, read_host_file, [ f[0] for f in files ], 4*workers)):
+            add_host_file(drive, partition, fsrc, fdst, content)
         
     return True
     
 def import_file(drive, partition, src, dst):
-    try:            
-        f = open(src, 'rb')
-    except Exception as e:
-        print(str(e))
+    return add_host_file(drive, partition, src, dst, read_host_file(src))
+
+def add_host_file(drive, partition, src, dst, content):
+    # content is either the timestamp and data of the file or an error message
+    if isinstance(content, str):
+        print(content)
         return False
 
     # if the target ends with "\" then it's clear that a directory
@@ -286,17 +528,13 @@ def import_file(drive, partition, src, dst):
     else:
         # check if destination exists and is a directory
         i = get_file(partition, dst)
-        if i and "subdir" in i:
+        if i and i.subdir != None:
             dst = dst + "\\" + src.split("/")[-1].upper()
 
     print("Creating", drive + dst)
 
-    dt = datetime.datetime.fromtimestamp(os.stat(src).st_mtime, tz=datetime.timezone.utc)
-    ftime = (dt.hour << 11) + (dt.minute << 5) + dt.second//2
-    fdate = dt.day + (dt.month << 5) + ((dt.year-1980)<<9)
-
-    file = { "name": dst.upper(), "date": fdate, "time": ftime, "data": f.read() }
-    f.close()
+    ftime, fdate, data = content
+    file = Entry(dst.upper(), ftime, fdate, payloads.put(data))
     
     return add_file(partition, file)
     
@@ -305,16 +543,13 @@ def import_item(partitions, src, dst=None):
 
     # if a path was given, then check that it's valid
     if isinstance(dst, str):
-        if not dst[:3] in DRIVES:
-            print("Error, not a valid partition")
-            return False
-
-        if DRIVES.index(dst[:3]) > len(partitions):
-            print("Error, partition not present")
+        drives = [ p["drive"] for p in partitions ]
+        if not dst[:3] in drives:
+            print("Error, partition not present" if dst[:3] in DRIVES else "Error, not a valid partition")
             return False
 
         # select the right partition
-        partition = partitions[DRIVES.index(dst[:3])]
+        partition = partitions[drives.index(dst[:3])]
 
         # skip drive letter
         dst = dst[3:]
@@ -332,31 +567,26 @@ def import_item(partitions, src, dst=None):
         # be multiplex PRGs in the ZIP
 
         prg = None
-        if not src.lower().endswith(".zip") and src.rsplit(":",1)[0].lower().endswith(".zip"):
+        if not src.lower().endswith(ARCHIVES) and src.rsplit(":",1)[0].lower().endswith(ARCHIVES):
             src, prg = src.rsplit(":",1)
         
-        # only zip files are currently supported
-        if not src.lower().endswith(".zip"):
-            print("Only ZIP files can be downloaded")
+        # only zip files and floppy images are currently supported
+        if not src.lower().endswith(ARCHIVES):
+            print("Only ZIP files and ST/MSA floppy images can be downloaded")
             return False
         
-        print("Downloading", src)
-        with urllib.request.urlopen(src) as response:
-            if response.getcode() != 200:
-                print("Download failed with code", response.getcode())
-                return False
-
-            # add drive letter to generated path if needed (no dst path was given)
-            bname = src.split("/")[-1].split(".")[0]
-            return import_zip(partition["drive"], partition["files"], (bname, response.read()), dst, prg)
+        # add drive letter to generated path if needed (no dst path was given)
+        bname = src.split("/")[-1].split(".")[0]
+        return import_archive(partition["drive"], partition["files"], (bname, fetch_archive(src)), dst, prg)
     
     # check if this is a file url
     if src.lower().startswith("file://"):
         src = src[7:]
     
     # handle the various sources
-    if os.path.isfile(src) and src.lower().endswith(".zip"):
-        return import_zip(partition["drive"], partition["files"], src, dst, None)
+    if os.path.isfile(src) and src.lower().endswith(ARCHIVES):
+        bname = src.replace("\\","/").split("/")[-1].split(".")[0]
+        return import_archive(partition["drive"], partition["files"], (bname, fetch_archive(src)), dst, None)
     elif os.path.isdir(src):
         return import_directory(partition["drive"], partition["files"], src, dst)
     elif os.path.isfile(src):
@@ -414,10 +644,13 @@ def import_screenshots(partitions, games, data):
                 
             if result != None:
                 # result is the partition the file was found in (if it was found)
-                file = { "name": "GAMES\\"+game+"\\"+game+".NEO", "data": f.read(), "time": ftime, "date":fdate }
-                print("Adding screenshot", partitions[result]["drive"]+file["name"])
-                if not add_file(partitions[result]["files"], file):
-                    print("Failed to add screenshot!!")
+                file = Entry("GAMES\\"+game+"\\"+game+".NEO", ftime, fdate, f.read())
+                if has_file(partitions[result]["files"], file.name, file.data):
+                    print("Screenshot", partitions[result]["drive"]+file.name, "is up to date")
+                else:
+                    print("Adding screenshot", partitions[result]["drive"]+file.name)
+                    if not add_file(partitions[result]["files"], file):
+                        print("Failed to add screenshot!!")
             else:
                 print("Unable to identify", game)
 
@@ -429,20 +662,20 @@ def mk_csv(partitions, cfg=None):
     def csv_scan(files, parent):
         gamelist = [ ]
         for f in files:
-            if "subdir" in f:
-                sublist = csv_scan(f["subdir"], f["name"])
+            if f.subdir != None:
+                sublist = csv_scan(f.subdir, f.name)
                 for entry in sublist:
-                    gamelist.append(f["name"]+"\\"+entry)
+                    gamelist.append(f.name+"\\"+entry)
                 
             else:
                 # detect games following the klapauzius naming scheme
-                if parent and parent == f["name"].split(".")[0] and f["name"].split(".")[-1].lower() == "prg":
-                    gamelist.append(f["name"])
+                if parent and parent == f.name.split(".")[0] and f.name.split(".")[-1].lower() == "prg":
+                    gamelist.append(f.name)
                 # detect games following the ppera naming scheme
                 if parent:
                     for prg_name in PPERA_PRG:
-                        if f["name"].split("/")[-1].lower() == prg_name.lower():
-                            gamelist.append(f["name"].replace("/", "\\"))
+                        if f.name.split("/")[-1].lower() == prg_name.lower():
+                            gamelist.append(f.name.replace("/", "\\"))
                             return gamelist  # return when first exec found
 
         return gamelist
@@ -467,7 +700,7 @@ def mk_csv(partitions, cfg=None):
                             speaking_name = src["name"]            
 
             # no speaking name, but maybe a link?
-            if not speaking_name:
+            if not speaking_name and cfg:
                 if i.split("\\")[-2] in cfg["links"]:
                     speaking_name = cfg["links"][i.split("\\")[-2]]
                             
@@ -486,45 +719,16 @@ def mk_csv(partitions, cfg=None):
         ftime = (dt.hour << 11) + (dt.minute << 5) + dt.second//2
         fdate = dt.day + (dt.month << 5) + ((dt.year-1980)<<9)
 
-        import_screenshots(partitions, games, cfg["data"])
+        import_screenshots(partitions, games, cfg["data"] if cfg else None)
     
-        partitions[0]["files"].append( { "name": "HDMENU.CSV", "time":ftime, "date":fdate, "data":csv } )
+        # replace the game list of an existing image only if it has changed
+        if not has_file(partitions[0]["files"], "HDMENU.CSV", csv):
+            add_file(partitions[0]["files"], Entry("HDMENU.CSV", ftime, fdate, csv))
     else:
         print("Warning, no games found, creating no HDMENU.CSV")
             
 
-# ==========================================================================================        
-
-if len(sys.argv) < 2: usage("No arguments given")    # no arguments at all given ...
-
-# parse all options
-options = { "export-bootloader": None, "quiet": False }
-arg_idx = 1
-while len(sys.argv) > arg_idx and sys.argv[arg_idx][0] == '-':
-    # check if option has a "=" in it
-    if "=" in sys.argv[arg_idx][1:]:
-        name, parm = sys.argv[arg_idx][1:].split("=",1)
-    else:
-        name = sys.argv[arg_idx][1:]
-        parm = None
-        
-    if not name in options: usage("Unknown option "+sys.argv[arg_idx][1:])
-
-    # options that are not just a boolean take a parameter
-    if not isinstance(name, bool):
-        if not parm and arg_idx+1 == len(sys.argv):
-            usage("Missing option parameter")
-        elif parm:
-            options[name] = parm
-        else:
-            options[name] = sys.argv[arg_idx+1]
-            arg_idx += 1
-    else:
-        options[name] = True
-
-    arg_idx += 1
-
-def get_size(p):
+def get_size(p, limit=16*1024*1024):
     # check all parts for being numbers or numbers+"M" or numbers+"K"
     if not ((p[-1] == 'M' or p[-1] == 'K') and len(p) > 1 and p[:-1].isnumeric()) and not p.isnumeric():
         return None
@@ -533,7 +737,7 @@ def get_size(p):
     elif p[-1] == 'K': size = int(p[:-1]) * 1024
     else: size = int(p)
 
-    if size > 16*1024*1024:
+    if limit and size > limit:
         print("Error, partition size must be 16 Megabytes at most")
         return None
         
@@ -572,19 +776,19 @@ def add_hdmenu_cfg(part):
     dt = datetime.datetime.now()
     ftime = (dt.hour << 11) + (dt.minute << 5) + dt.second//2
     fdate = dt.day + (dt.month << 5) + ((dt.year-1980)<<9)
-    part["files"].append( { "name": "HDMENU.CFG", "time":ftime, "date":fdate, "data":data } )
+    part["files"].append( Entry("HDMENU.CFG", ftime, fdate, data) )
     
 def parse_cfg_file(filename):
     cfg = { "data": [], "links": { } }
     with open(filename) as cfgfile:
-        partition_index = 0   # start with one partition
+        cfg["partitions"] = 1   # start with one partition
         
         # parse config line by line
         for line in cfgfile:
             line = line.strip()
             
             # any line starting with # is a comment
-            if line[0] != '#':
+            if line and line[0] != '#':
                 # first is the command
                 cmd = line.split(" ",1)[0]
                 if cmd.lower() == "img":
@@ -600,7 +804,7 @@ def parse_cfg_file(filename):
                     # include a game
                     src = line.split(" ",1)[1].strip().split(";")
                     data = { "url": src[0].strip() }
-                    data["partition_index"] = partition_index
+                    data["partition_index"] = cfg["partitions"] - 1
                     if len(src) >= 2: data["name"]= src[1].strip()
                     if len(src) >= 3: data["neopic"]= src[2].strip()                        
                     cfg["data"].append(data)                    
@@ -608,7 +812,10 @@ def parse_cfg_file(filename):
                     link = line.split(" ",1)[1].strip().split(";")
                     cfg["links"][link[0].strip()] = link[1].strip()
                 elif cmd.lower() == "partition":
-                    partition_index += 1
+                    cfg["partitions"] += 1
+                    if cfg["partitions"] > len(DRIVES):
+                        print("Error, at most", len(DRIVES), "partitions are supported")
+                        return None
                 elif cmd.lower() == "cfg":
                     cfg["hdmenu_cfg"] = True
                 elif cmd.lower() == "end":
@@ -616,110 +823,318 @@ def parse_cfg_file(filename):
                 else:
                     print("Unknown command", cmd)
                     return None
-                             
-        # create empty image of give size
-        partitions = []
-        for i in range(partition_index+1):
-            partitions.append({"size":cfg["img"]["size"]//512, "files": [], "drive": DRIVES[i] })
 
-        # create a hdmenu.cfg if requested
-        if "hdmenu_cfg" in cfg and cfg["hdmenu_cfg"]:
-            add_hdmenu_cfg(partitions[0])
+    if not "img" in cfg or not cfg["img"]["size"]:
+        print("Error, no valid image given in", filename)
+        return None
+
+    return cfg
+
+def build_cfg(cfg, options):
+    # create empty image of give size
+    partitions = []
+    for i in range(cfg["partitions"]):
+        partitions.append({"size":cfg["img"]["size"]//512, "files": [], "drive": DRIVES[i] })
+
+    # create a hdmenu.cfg if requested
+    if "hdmenu_cfg" in cfg and cfg["hdmenu_cfg"]:
+        add_hdmenu_cfg(partitions[0])
         
-        # import all src items
-        for item in cfg["data"]:            
-            p = import_item(partitions, item["url"], item["path"] if "path" in item else item["partition_index"])
-            if not "path" in item: item["path"] = p
+    # import all src items
+    for item in cfg["data"]:            
+        p = import_item(partitions, item["url"], item["path"] if "path" in item else item["partition_index"])
+        if not "path" in item: item["path"] = p
 
-        mk_csv(partitions, cfg)
+    mk_csv(partitions, cfg)
     
-        if not options["quiet"]:
-            # dump the fs trees
-            dump_trees(partitions)
+    if not options["quiet"]:
+        # dump the fs trees
+        dump_trees(partitions)
 
-            # do some fs statistics
-            statistics(partitions)
+        # do some fs statistics
+        statistics(partitions)
 
-        write_hddimage(cfg["img"]["name"], partitions, options)
+    return partitions
 
-# nothing else remaining?
-if len(sys.argv) == arg_idx: usage("Missing <imagename|size|cfgfile> argument")
+def archive_source(src):
+    # return the archive a source item refers to (if any) so it can be
+    # fetched ahead of time
+    if src.lower().startswith("http://") or src.lower().startswith("https://"):
+        if not src.lower().endswith(ARCHIVES) and src.rsplit(":",1)[0].lower().endswith(ARCHIVES):
+            src = src.rsplit(":",1)[0]
+        return src if src.lower().endswith(ARCHIVES) else None
 
-if not options["quiet"]: print("== mkhdmenu.py ==")
+    if src.lower().startswith("file://"):
+        src = src[7:]
+        
+    return src if src.lower().endswith(ARCHIVES) and os.path.isfile(src) else None
+    
+def build_cfg_files(filenames, options):
+    # parse all configs first to be able to fetch all archives at once
+    cfgs = [ ]
+    for filename in filenames:
+        print("Building from config file", filename)
+        cfg = parse_cfg_file(filename)
+        if not cfg: return False
+        cfgs.append(cfg)
+
+    # each archive is downloaded and unpacked only once, even if it's
+    # used by multiple configs
+    srcs = [ ]
+    for cfg in cfgs:
+        for item in cfg["data"]:
+            src = archive_source(item["url"])
+            if src: srcs.append(src)
+    prefetch_archives(srcs)
+
+    # assemble the file trees one after the other ...
+    images = [ ]
+    for cfg in cfgs:
+        images.append( (cfg["img"]["name"], build_cfg(cfg, options)) )
+
+    if options["plan"]:
+        return all([ plan_report(partitions, options) for name, partitions in images ])
+
+    # ... and write the images in parallel. Writing is pure python and
+    # thus CPU bound, so it's done in separate processes
+    if len(images) == 1:
+        return write_hddimage(images[0][0], images[0][1], options)
+
+    ok = True
+    with ProcessPoolExecutor() as pool:
+        jobs = [ pool.submit(write_hddimage, name, partitions, options) for name, partitions in images ]
+        for (name, _), job in zip(images, jobs):
+            if not job.result():
+                print("Error writing", name)
+                ok = False
+                
+    return ok
 
-# check if only one parameter given and if it's a config file
-if len(sys.argv) == arg_idx+1 and sys.argv[arg_idx].lower().endswith(".cfg"):
-    print("Building from config file", sys.argv[arg_idx])
+def build_floppies(srcs, outname, options):
+    fmt = options["floppy"]
 
-    parse_cfg_file(sys.argv[arg_idx])
-    sys.exit(0)
+    # with a pattern every game folder or archive becomes a floppy of its own
+    if "*" in outname:
+        jobs = [ ]
+        for src in srcs:
+            if not os.path.isdir(src):
+                print("Error,", src, "is not a directory")
+                return False
 
-image = sys.argv[arg_idx]
-arg_idx += 1
+            for entry in sorted(os.scandir(src), key=lambda e: e.name):
+                if entry.is_dir():
+                    jobs.append( (outname.replace("*", entry.name.upper()), [ entry.path ]) )
+                elif entry.name.lower().endswith(ARCHIVES):
+                    jobs.append( (outname.replace("*", entry.name.rsplit(".",1)[0].upper()), [ entry.path ]) )
+    else:
+        jobs = [ (outname, srcs) ]
 
-# check if image is actually a size description like 16M+16M+8M
-parts = image.split("+")
+    prefetch_archives([ src for name, sources in jobs for src in map(archive_source, sources) if src ])
 
-# check all parts for being numbers or numbers+"M" or numbers+"K"
-is_size = True
-for p in parts:
-    if not ((p[-1] == 'M' or p[-1] == 'K') and len(p) > 1 and p[:-1].isnumeric()) and not p.isnumeric():
-        is_size = False
+    floppies = [ ]
+    for name, sources in jobs:
+        partition = { "size": 0, "files": [ ], "drive": FLOPPY_DRIVE }
+        for src in sources:
+            if not import_item([ partition ], src, FLOPPY_DRIVE):
+                return False
+        floppies.append( (name, partition["files"]) )
+
+    # just like hard disk images the floppies are written in parallel
+    if len(floppies) == 1:
+        return write_floppy(floppies[0][0], floppies[0][1], fmt)
+
+    ok = True
+    with ProcessPoolExecutor() as pool:
+        jobs = [ pool.submit(write_floppy, name, files, fmt) for name, files in floppies ]
+        for (name, _), job in zip(floppies, jobs):
+            if not job.result():
+                print("Error writing", name)
+                ok = False
+
+    return ok
+
+def main():
+    if len(sys.argv) < 2: usage("No arguments given")    # no arguments at all given ...
+
+    # parse all options
+    options = { "export-bootloader": None, "quiet": False, "extract": None, "imgdiff": None, "sync": False, "spc": None, "overlay": None, "flatten": None, "resize": None, "defrag": None, "floppy": None, "plan": False, "index": None, "memory": None }
+    arg_idx = 1
+    while len(sys.argv) > arg_idx and sys.argv[arg_idx][0] == '-' and sys.argv[arg_idx] != '-':
+        # check if option has a "=" in it
+        if "=" in sys.argv[arg_idx][1:]:
+            name, parm = sys.argv[arg_idx][1:].split("=",1)
+        else:
+            name = sys.argv[arg_idx][1:]
+            parm = None
+        
+        if not name in options: usage("Unknown option "+sys.argv[arg_idx][1:])
+
+        # options that are not just a boolean take a parameter
+        if not isinstance(options[name], bool):
+            if not parm and arg_idx+1 == len(sys.argv):
+                usage("Missing option parameter")
+            elif parm:
+                options[name] = parm
+            else:
+                options[name] = sys.argv[arg_idx+1]
+                arg_idx += 1
+        else:
+            options[name] = True
+
+        arg_idx += 1
+
+    if options["spc"] and options["spc"] != "auto" and not options["spc"] in [ "1", "2", "4", "8", "16", "32" ]:
+        usage("Invalid number of sectors per cluster "+options["spc"])
+
+    if options["defrag"] and not options["defrag"] in DEFRAG_MODES:
+        usage("Invalid defragmentation mode "+options["defrag"])
+
+    if options["floppy"] and not options["floppy"] in FLOPPY_FORMATS:
+        usage("Invalid floppy format "+options["floppy"])
+
+    if options["memory"]:
+        budget = get_size(options["memory"], None)
+        if budget == None: usage("Invalid memory budget "+options["memory"])
+        payloads.budget = budget
+
+    if options["sync"] and options["overlay"]:
+        usage("-sync and -overlay cannot be combined")
+
+    # archives are looked up in and added to the index, if one is given
+    global archive_index, planning
+    archive_index = ArchiveIndex(options["index"]) if options["index"] else None
+    planning = options["plan"]
+
+    # nothing else remaining?
+    if len(sys.argv) == arg_idx: usage("Missing <imagename|size|cfgfile> argument")
+
+    # extract an existing image and exit
+    if options["extract"]:
+        if len(sys.argv) != arg_idx+1: usage("Extraction needs exactly one image")
+        sys.exit(0 if extract_image(sys.argv[arg_idx], options["extract"], options) else -1)
+
+    # compare an image with another one and exit
+    if options["imgdiff"]:
+        if len(sys.argv) != arg_idx+1: usage("Comparison needs exactly one image")
+        diffs = diff_images(options["imgdiff"], sys.argv[arg_idx])
+        sys.exit(-1 if diffs == None else 1 if diffs else 0)
+
+    # change the partition layout of an image in place and exit
+    if options["resize"]:
+        if len(sys.argv) != arg_idx+1: usage("Resizing needs exactly one image")
+        sizes = [ get_size(p) for p in options["resize"].split("+") ]
+        if None in sizes: usage("Invalid partition sizes "+options["resize"])
+        if len(sizes) > len(DRIVES): usage("At most "+str(len(DRIVES))+" partitions are supported")
+        sys.exit(0 if resize_image(sys.argv[arg_idx], [ s//512 for s in sizes ], options) else -1)
+
+    # defragment an image in place and exit
+    if options["defrag"]:
+        if len(sys.argv) != arg_idx+1: usage("Defragmenting needs exactly one image")
+        sys.exit(0 if defrag_image(sys.argv[arg_idx], options["defrag"], options) else -1)
+
+    # copy an image sector by sector and exit
+    if options["flatten"]:
+        if len(sys.argv) != arg_idx+1: usage("Flattening needs exactly one image")
+        if options["flatten"] == "-": sys.stdout = sys.stderr
+        sys.exit(0 if copy_image(sys.argv[arg_idx], options["flatten"], options) else -1)
+
+    # build floppy images and exit
+    if options["floppy"]:
+        if len(sys.argv) < arg_idx+2: usage("Floppies need at least one source and an outname")
+        if sys.argv[-1] == "-": sys.stdout = sys.stderr
+        sys.exit(0 if build_floppies(sys.argv[arg_idx:-1], sys.argv[-1], options) else -1)
+
+    # an image written to stdout must not be mixed with any other output
+    if len(sys.argv) > arg_idx+1 and sys.argv[-1] == "-": sys.stdout = sys.stderr
+
+    if not options["quiet"]: print("== mkhdmenu.py ==")
+
+    # check if all remaining parameters are config files. Wildcards are
+    # expanded here as well as not every shell does that
+    if all(arg.lower().endswith(".cfg") for arg in sys.argv[arg_idx:]):
+        cfg_files = [ ]
+        for arg in sys.argv[arg_idx:]:
+            if glob.has_magic(arg): cfg_files.extend(sorted(glob.glob(arg)))
+            else:                   cfg_files.append(arg)
+
+        if not cfg_files: usage("No config files found")
+        sys.exit(0 if build_cfg_files(cfg_files, options) else -1)
+
+    image = sys.argv[arg_idx]
+    arg_idx += 1
 
-# is a valid size desciption -> setup empty partitions scheme
-if is_size:
-    partitions = []
+    # check if image is actually a size description like 16M+16M+8M
+    parts = image.split("+")
+
+    # check all parts for being numbers or numbers+"M" or numbers+"K"
+    is_size = True
     for p in parts:
-        if p[-1] == 'M': size = int(p[:-1]) * 1048576
-        elif p[-1] == 'K': size = int(p[:-1]) * 1024
-        else: size = int(p)
+        if not ((p[-1] == 'M' or p[-1] == 'K') and len(p) > 1 and p[:-1].isnumeric()) and not p.isnumeric():
+            is_size = False
 
-        if size > 16*1024*1024:
-            print("Error, partition size must be 16 Megabytes at most")
-            sys.exit(-1)
-        
-        if size & 511:
-            print("Error, partition size must be a multiple of 512")
-            sys.exit(-1)
+    # is a valid size desciption -> setup empty partitions scheme
+    if is_size:
+        partitions = []
+        for p in parts:
+            size = get_size(p)
+            if not size: sys.exit(-1)
         
-        partitions.append( {"size":size//512, "files": [] }  ) 
-else:   
-    # read given image into memory
-    partitions = read_hddimage(image, options)
-
-if not partitions: sys.exit(-1)
+            partitions.append( {"size":size//512, "files": [] }  ) 
+    else:   
+        # read given image into memory
+        partitions = read_hddimage(image, options)
 
-# set drive name for each partition
-for p in range(len(partitions)):
-    partitions[p]["drive"] = DRIVES[p]
+    if not partitions: sys.exit(-1)
 
-# scan over any further argument until the last one
-while arg_idx < len(sys.argv)-1:
-    cmd = sys.argv[arg_idx]
-
-    # argument may be like
-    if cmd[:3] in DRIVES:
-        # convert any \ to / to simplify work        
-        dst, src = cmd.split("=",1)        
-        dst = dst.replace("/", "\\")
+    if len(partitions) > len(DRIVES):
+        print("Error, at most", len(DRIVES), "partitions are supported")
+        sys.exit(-1)
 
-        if not import_item(partitions, src, dst):
+    # set drive name for each partition
+    for p in range(len(partitions)):
+        partitions[p]["drive"] = DRIVES[p]
+
+    # fetch all archives ahead of time so they are being downloaded and
+    # unpacked in parallel
+    # when only planning, the outname may be omitted
+    end = len(sys.argv) if options["plan"] and sys.argv[-1][:3] in DRIVES else len(sys.argv)-1
+    srcs = [ archive_source(cmd.split("=",1)[1]) for cmd in sys.argv[arg_idx:end] if "=" in cmd ]
+    prefetch_archives([ src for src in srcs if src ])
+
+    # scan over any further argument until the last one
+    while arg_idx < end:
+        cmd = sys.argv[arg_idx]
+
+        # argument may be like
+        if cmd[:3] in DRIVES:
+            # convert any \ to / to simplify work        
+            dst, src = cmd.split("=",1)        
+            dst = dst.replace("/", "\\")
+
+            if not import_item(partitions, src, dst):
+                sys.exit(-1)
+        else:
+            print("Error, unknown command", cmd)
             sys.exit(-1)
-    else:
-        print("Error, unknown command", cmd)
-        sys.exit(-1)
         
-    arg_idx += 1
+        arg_idx += 1
 
-mk_csv(partitions)
+    mk_csv(partitions)
     
-if not options["quiet"]:
-    # dump the fs trees
-    dump_trees(partitions)
+    if not options["quiet"]:
+        # dump the fs trees
+        dump_trees(partitions)
 
-    # do some fs statistics
-    statistics(partitions)
+        # do some fs statistics
+        statistics(partitions)
     
-# write the entire disk image into a file
-if arg_idx == len(sys.argv)-1:
-    write_hddimage(sys.argv[-1], partitions, options)
+    # only report the space needed
+    if options["plan"]:
+        sys.exit(0 if plan_report(partitions, options) else -1)
+
+    # write the entire disk image into a file
+    if arg_idx == len(sys.argv)-1:
+        sys.exit(0 if write_hddimage(sys.argv[-1], partitions, options) else -1)
+
+if __name__ == "__main__":
+    main()
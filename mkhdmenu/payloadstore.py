@@ -0,0 +1,115 @@
+# payloadstore.py - keep the contents of imported files within a memory budget
+#
+# All files to be written are kept until the image has been written. Once
+# the contents of all files exceed the budget, further files are appended
+# to a temporary spill file instead. They are then represented by a Payload
+# which knows its place in that file. When writing, each payload is mapped
+# into memory on its own and read as a view into that mapping, so the data
+# is only copied by the kernel and the mapping is gone with the view.
+#
+# Payloads can be passed to other processes. They are pickled as the name
+# of the spill file and the payload's place in it.
+
+import os, mmap, atexit, tempfile, threading
+
+DEFAULT_BUDGET = 512*1024*1024
+
+# spill files opened for reading by processes which didn't create them
+_readers = { }
+
+def map_view(f, offset, size):
+    # mappings have to start at a multiple of the allocation granularity
+    if not size: return memoryview(b"")
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    m = mmap.mmap(f.fileno(), offset-start+size, access=mmap.ACCESS_READ, offset=start)
+    return memoryview(m)[offset-start:offset-start+size]
+
+def _open_payload(path, offset, size):
+    if not path in _readers: _readers[path] = SpillReader(path)
+    return Payload(_readers[path], offset, size)
+
+class Payload:
+    __slots__ = ( "store", "offset", "size" )
+
+    def __init__(self, store, offset, size):
+        self.store = store
+        self.offset = offset
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __reduce__(self):
+        # the other process reads the spill file by name
+        self.store.flush()
+        return _open_payload, (self.store.path, self.offset, self.size)
+
+    def view(self):
+        return self.store.view(self.offset, self.size)
+
+class SpillReader:
+    # read-only access to the spill file of another process
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+
+    def view(self, offset, size):
+        return map_view(self.file, offset, size)
+
+    def flush(self):
+        pass
+
+class PayloadStore:
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.used = 0           # bytes kept in memory
+        self.spilled = 0        # bytes in the spill file
+        self.file = None
+        self.path = None
+        self.lock = threading.Lock()
+
+    def put(self, data):
+        # return data itself if it still fits into the budget or else a
+        # payload referring to a copy in the spill file
+        if isinstance(data, Payload) or not hasattr(data, "__getitem__"):
+            return data
+
+        with self.lock:
+            if self.used + len(data) <= self.budget:
+                self.used += len(data)
+                return data
+
+            if not self.file:
+                fd, self.path = tempfile.mkstemp(prefix="mkhdmenu-", suffix=".spill")
+                self.file = os.fdopen(fd, "w+b")
+                atexit.register(self.close)
+
+            self.file.seek(self.spilled)
+            self.file.write(data)
+            payload = Payload(self, self.spilled, len(data))
+            self.spilled += len(data)
+            return payload
+
+    def view(self, offset, size):
+        with self.lock:
+            self.file.flush()
+            return map_view(self.file, offset, size)
+
+    def flush(self):
+        with self.lock:
+            if self.file: self.file.flush()
+
+    def close(self):
+        if not self.file: return
+
+        self.file.close()
+        self.file = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+def view(data):
+    # return the contents of a file as a bytes-like object. Payloads and
+    # contents read from an image on demand provide their own view
+    return data.view() if hasattr(data, "view") else data
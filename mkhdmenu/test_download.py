@@ -0,0 +1,107 @@
+# test_download.py - download from a local http server
+#
+# Run with "python3 -m unittest" from within this directory.
+
+import os, io, random, threading, unittest, contextlib
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import download
+
+DATA = bytes(random.Random(0).getrandbits(8) for i in range(200000))
+
+class Handler(BaseHTTPRequestHandler):
+    # /file is served completely, /broken drops the connection halfway
+    # through unless a range is requested, /moved redirects to /file
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    requests = [ ]
+
+    def setup(self):
+        super().setup()
+        Handler.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        Handler.requests.append( (self.path, self.headers.get("Range")) )
+
+        if self.path == "/moved":
+            self.send_response(302)
+            self.send_header("Location", "/file")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if not self.path in [ "/file", "/broken" ]:
+            self.send_error(404)
+            return
+
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(DATA)-1, len(DATA)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(DATA)-start))
+        self.send_header("ETag", '"1"')
+        self.end_headers()
+
+        if self.path == "/broken" and not start:
+            self.wfile.write(DATA[:len(DATA)//2])
+            self.close_connection = True
+            return
+
+        self.wfile.write(DATA[start:])
+
+class Download(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+        cls.url = "http://127.0.0.1:%d" % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        download.pool.close()
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.thread.join()
+
+    def setUp(self):
+        # the server must not be reached through a proxy
+        env = { k: v for k, v in os.environ.items() if not k.lower().endswith("_proxy") }
+        patcher = mock.patch.dict(os.environ, env, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        download.pool.close()
+        Handler.connections = 0
+        Handler.requests = [ ]
+
+    def fetch(self, path):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return download.download(self.url + path)
+
+    def test_reuse(self):
+        for i in range(3):
+            self.assertEqual(self.fetch("/file").read(), DATA)
+        self.assertEqual(Handler.connections, 1)
+
+    def test_redirect(self):
+        self.assertEqual(self.fetch("/moved").read(), DATA)
+        self.assertEqual([ p for p, r in Handler.requests ], [ "/moved", "/file" ])
+        self.assertEqual(Handler.connections, 1)
+
+    def test_resume(self):
+        self.assertEqual(self.fetch("/broken").read(), DATA)
+        self.assertEqual(Handler.requests, [ ("/broken", None), ("/broken", "bytes=%d-" % (len(DATA)//2)) ])
+
+    def test_missing(self):
+        self.assertIsNone(self.fetch("/missing"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,364 @@
+# test_roundtrip.py - write images and read them back
+#
+# Run with "python3 -m unittest" from within this directory.
+
+import os, io, json, random, unittest, tempfile, contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+from hddimgentry import Entry
+from hddimgwriter import write_hddimage, copy_image, SyncFile
+from hddimgextract import extract_image
+from hddimgreader import open_image, partition_entries, read_layout, read_sectors, cluster_chain, read_floppy, decode_msa
+from hddimgresize import resize_image, used_clusters, fix_directories
+from hddimgdefrag import defrag_image, scan_directories, write_fat, is_fragmented
+from hddimgfloppy import write_floppy, build_floppy, encode_msa, FLOPPY_FORMATS
+from archiveindex import ArchiveIndex, IndexedData
+from payloadstore import PayloadStore, Payload, view
+
+OPTIONS = { "quiet": True, "export-bootloader": None }
+
+# 2024-01-01
+DATE = (44 << 9) | (1 << 5) | 1
+
+def sample_files():
+    rnd = random.Random(0)
+    return { "README.TXT": b"hello world\r\n" * 1000,
+             "EMPTY.TXT": b"",
+             "GAMES/X/X.PRG": bytes(rnd.getrandbits(8) for i in range(300000)) }
+
+def sample_tree(files):
+    tree = [ ]
+    for path, data in files.items():
+        entries = tree
+        for d in path.split("/")[:-1]:
+            sub = next((e for e in entries if e.name == d), None)
+            if not sub:
+                sub = Entry(d, 0, DATE, subdir=[ ])
+                entries.append(sub)
+            entries = sub.subdir
+        entries.append(Entry(path.split("/")[-1], 0, DATE, data))
+    return tree
+
+def quietly(fn, *args):
+    # the extractor may write a tar stream to sys.stdout.buffer
+    with contextlib.redirect_stdout(io.TextIOWrapper(io.BytesIO())):
+        return fn(*args)
+
+def payload_contents(data):
+    # runs in another process, payloads are read from the spill file there
+    return bytes(view(data))
+
+class RoundTrip(unittest.TestCase):
+    def write(self, image, files, **options):
+        # the volume serials are random, so they are made reproducible
+        partitions = [ { "size": 16384, "files": sample_tree(files) },
+                       { "size": 8192, "files": [ ] } ]
+        random.seed(0)
+        self.assertTrue(quietly(write_hddimage, image, partitions, { **OPTIONS, **options }))
+
+    def check_files(self, dst, files):
+        for path, data in files.items():
+            with open(os.path.join(dst, "C", *path.split("/")), "rb") as f:
+                self.assertEqual(f.read(), data, path)
+
+    def check_extract(self, name):
+        files = sample_files()
+        partitions = [ { "size": 16384, "files": sample_tree(files) },
+                       { "size": 8192, "files": [ ] } ]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            image = os.path.join(tmp, name)
+            self.assertTrue(quietly(write_hddimage, image, partitions, OPTIONS))
+
+            dst = os.path.join(tmp, "out")
+            self.assertTrue(quietly(extract_image, image, dst, OPTIONS))
+            self.check_files(dst, files)
+
+    def rename_entry(self, image, old, new):
+        # patch the 8.3 name of a root directory entry of partition C:
+        img = open_image(image, True)
+        flags, pid, start, length = next(partition_entries(img))
+        fs = read_layout(img[start:start+length])
+        root = read_sectors(fs["sectors"], fs["root"], fs["ndirs"]//16)
+        img.close()
+
+        offset = 512*(start+fs["root"]) + root.index(old)
+        with open(image, "r+b") as f:
+            f.seek(offset)
+            f.write(new)
+
+    def partition(self, image, drive=0):
+        img = open_image(image, True)
+        flags, pid, start, length = list(partition_entries(img))[drive]
+        fs = read_layout(img[start:start+length])
+        img.close()
+        return start, length, fs
+
+    def scatter(self, image, seed):
+        # move all used clusters of partition C: to random places
+        start, length, fs = self.partition(image)
+        fat = fs["fat"]
+        spc = fs["spc"]
+        limit = min(len(fat), (fs["nsects"]-fs["data"])//spc + 2)
+        used = used_clusters(fat)
+        moves = dict(zip(used, random.Random(seed).sample(range(2, limit), len(used))))
+
+        with open(image, "r+b") as f:
+            data = { }
+            for c in used:
+                f.seek(512*(start+fs["data"]+spc*(c-2)))
+                data[c] = f.read(512*spc)
+            for c, n in moves.items():
+                f.seek(512*(start+fs["data"]+spc*(n-2)))
+                f.write(data[c])
+
+            new = fat[:]
+            for c in used: new[c] = 0
+            for c, n in moves.items(): new[n] = moves.get(fat[c], fat[c])
+            fs["fat"] = new
+            fix_directories(f, start, fs, moves)
+            write_fat(f, start, fs, range(len(new)))
+
+    def fragmented(self, image):
+        start, length, fs = self.partition(image)
+        with open(image, "rb") as f:
+            items = scan_directories(f, start, fs)
+        return [ i["path"] for i in items if is_fragmented(list(cluster_chain(fs["fat"], i["start"]))) ]
+
+    def test_resize(self):
+        files = sample_files()
+
+        for sizes in ( [ 6144, 16384, 8192 ], [ 32768, 8192 ] ):
+            with self.subTest(sizes), tempfile.TemporaryDirectory() as tmp:
+                image = os.path.join(tmp, "test.hd")
+                self.write(image, files)
+                self.scatter(image, 1)
+                self.assertTrue(quietly(resize_image, image, sizes, OPTIONS))
+
+                img = open_image(image, True)
+                self.assertEqual([ e[3] for e in partition_entries(img) ], sizes)
+                img.close()
+
+                dst = os.path.join(tmp, "out")
+                self.assertTrue(quietly(extract_image, image, dst, OPTIONS))
+                self.check_files(dst, files)
+
+    def test_defrag(self):
+        files = sample_files()
+
+        for mode in ( "min", "boot" ):
+            with self.subTest(mode), tempfile.TemporaryDirectory() as tmp:
+                image = os.path.join(tmp, "test.hd")
+                self.write(image, files)
+                self.scatter(image, 2)
+                self.assertTrue(self.fragmented(image))
+
+                self.assertTrue(quietly(defrag_image, image, mode, OPTIONS))
+                self.assertEqual(self.fragmented(image), [ ])
+
+                dst = os.path.join(tmp, "out")
+                self.assertTrue(quietly(extract_image, image, dst, OPTIONS))
+                self.check_files(dst, files)
+
+    def test_floppy(self):
+        files = sample_files()
+
+        for fmt in ( "360K", "720K", "1440K" ):
+            for ext in ( ".st", ".msa" ):
+                with self.subTest(fmt+ext), tempfile.TemporaryDirectory() as tmp:
+                    image = os.path.join(tmp, "test" + ext)
+                    self.assertTrue(quietly(write_floppy, image, sample_tree(files), fmt))
+                    with open(image, "rb") as f:
+                        members = quietly(read_floppy, f.read())
+
+                    self.assertEqual({ m[0]: m[2] for m in members if not m[0].endswith("/") }, files)
+                    self.assertEqual(sorted(m[0] for m in members if m[0].endswith("/")), [ "GAMES/", "GAMES/X/" ])
+
+    def test_msa(self):
+        # .MSA tracks are stored raw or run length encoded
+        tracks, sides, spt, media = FLOPPY_FORMATS["720K"]
+        st = bytearray(quietly(build_floppy, sample_tree(sample_files()), "720K"))
+        st[-512:] = b"\xe5" * 512
+        st = bytes(st)
+        self.assertEqual(decode_msa(encode_msa(st, spt, sides)), st)
+
+    def test_floppy_full(self):
+        files = { "BIG.DAT": bytes(400000) }
+        with tempfile.TemporaryDirectory() as tmp:
+            image = os.path.join(tmp, "test.st")
+            self.assertFalse(quietly(write_floppy, image, sample_tree(files), "360K"))
+            self.assertFalse(os.path.exists(image))
+
+    def test_archive_index(self):
+        members = [ ( "GAME/", (2024, 1, 1, 12, 0, 0), b"" ),
+                    ( "GAME/GAME.PRG", (2024, 1, 1, 12, 0, 2), b"x" * 1000 ) ]
+        url = "https://example.com/game.zip"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "index.json")
+            archive = os.path.join(tmp, "game.zip")
+            with open(archive, "wb") as f:
+                f.write(b"zip")
+
+            index = ArchiveIndex(path)
+            index.add(archive, members, "GAME.PRG")
+            index.add(url, members, "GAME.PRG")
+            index.save()
+
+            # stand-ins for the data are never added again
+            index = ArchiveIndex(path)
+            stored = index.members(archive)
+            index.add(archive, stored, "OTHER.PRG")
+            self.assertFalse(index.changed)
+
+            for src in ( archive, url ):
+                self.assertEqual(index.lookup(src)["executable"], "GAME.PRG")
+                stored = index.members(src)
+                self.assertEqual([ (m[0], m[1], len(m[2])) for m in stored ], [ (m[0], m[1], len(m[2])) for m in members ])
+                self.assertTrue(all(isinstance(m[2], IndexedData) for m in stored))
+
+            # both sources refer to the same archive
+            self.assertEqual(len(index.archives), 1)
+
+            # a changed local file is not looked up anymore
+            os.utime(archive, ns=(0, 0))
+            self.assertIsNone(index.lookup(archive))
+
+            # neither is anything in an index of another version
+            self.assertTrue(ArchiveIndex(path).lookup(url))
+            with open(path) as f:
+                old = json.load(f)
+            old["version"] = 1
+            with open(path, "w") as f:
+                json.dump(old, f)
+            self.assertIsNone(ArchiveIndex(path).lookup(url))
+
+    def test_payload_store(self):
+        files = list(sample_files().values()) + [ bytes(range(256)) * 200 ]
+        store = PayloadStore(20000)
+        stored = [ store.put(data) for data in files ]
+
+        # only what exceeds the budget is spilled
+        self.assertEqual([ isinstance(p, Payload) for p in stored ], [ False, False, True, True ])
+        self.assertEqual([ bytes(view(p)) for p in stored ], files)
+
+        with ProcessPoolExecutor(2) as pool:
+            self.assertEqual(list(pool.map(payload_contents, stored)), files)
+
+        path = store.path
+        self.assertTrue(os.path.exists(path))
+        store.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_unsafe_names(self):
+        partitions = [ { "size": 16384, "files": sample_tree(sample_files()) } ]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            image = os.path.join(tmp, "test.hd")
+            self.assertTrue(quietly(write_hddimage, image, partitions, OPTIONS))
+            self.rename_entry(image, b"README  TXT", b"..         ")
+            self.rename_entry(image, b"GAMES      ", b"../GAMES   ")
+
+            dst = os.path.join(tmp, "out", "dst")
+            self.assertTrue(quietly(extract_image, image, dst, OPTIONS))
+            self.assertEqual(os.listdir(os.path.join(tmp, "out")), [ "dst" ])
+            self.assertEqual(os.listdir(os.path.join(dst, "C")), [ "EMPTY.TXT" ])
+
+    def test_invalid_names(self):
+        for names in ( [ "TOOLONGNAME.TXT" ], [ "A.TEXT" ], [ "A.TXT", "a.txt" ] ):
+            with self.subTest(names):
+                partitions = [ { "size": 16384, "files": [ Entry(n, 0, DATE, b"x") for n in names ] } ]
+                with tempfile.TemporaryDirectory() as tmp:
+                    image = os.path.join(tmp, "test.hd")
+                    self.assertFalse(quietly(write_hddimage, image, partitions, OPTIONS))
+                    self.assertFalse(os.path.exists(image))
+
+    def test_plain(self):
+        self.check_extract("test.hd")
+
+    def test_sync_file(self):
+        old = bytes(random.Random(1).getrandbits(8) for i in range(20*4096))
+        new = bytearray(old[:16*4096])
+        new[5*4096+7] ^= 0xff
+        new[6*4096] ^= 0xff
+        new[12*4096+100] ^= 0xff
+
+        with tempfile.TemporaryDirectory() as tmp:
+            target = os.path.join(tmp, "target.img")
+            with open(target, "wb") as f:
+                f.write(old)
+
+            # written in odd pieces to cross the block boundaries
+            out = SyncFile(target, 4096)
+            for i in range(0, len(new), 3000):
+                out.write(new[i:i+3000])
+            out.close()
+
+            with open(target, "rb") as f:
+                self.assertEqual(f.read(), new)
+            self.assertEqual(out.written, 3*4096)
+            self.assertEqual(out.skipped, 13*4096)
+
+    def test_sync_image(self):
+        files = sample_files()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            image = os.path.join(tmp, "test.hd")
+            plain = os.path.join(tmp, "plain.hd")
+            self.write(image, files)
+
+            # the synced image must be identical to a freshly written one
+            files["README.TXT"] = b"goodbye world\r\n" * 1000
+            self.write(image, files, sync=True)
+            self.write(plain, files)
+            with open(image, "rb") as f, open(plain, "rb") as g:
+                self.assertEqual(f.read(), g.read())
+
+            dst = os.path.join(tmp, "out")
+            self.assertTrue(quietly(extract_image, image, dst, OPTIONS))
+            self.check_files(dst, files)
+
+    def test_overlay(self):
+        files = sample_files()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            base = os.path.join(tmp, "base.hd")
+            overlay = os.path.join(tmp, "overlay.hd")
+            plain = os.path.join(tmp, "plain.hd")
+            flat = os.path.join(tmp, "flat.hd")
+            self.write(base, files)
+
+            files["README.TXT"] = b"goodbye world\r\n" * 1000
+            self.write(overlay, files, overlay=base)
+            self.write(plain, files)
+            self.assertLess(os.path.getsize(overlay), os.path.getsize(plain) // 10)
+
+            dst = os.path.join(tmp, "out")
+            self.assertTrue(quietly(extract_image, overlay, dst, OPTIONS))
+            self.check_files(dst, files)
+
+            self.assertTrue(quietly(copy_image, overlay, flat, OPTIONS))
+            with open(flat, "rb") as f, open(plain, "rb") as g:
+                self.assertEqual(f.read(), g.read())
+
+            # a copy of the base with a new mtime is verified and still used
+            os.utime(base, ns=(0, 0))
+            img = quietly(open_image, overlay, True)
+            self.assertTrue(img)
+            img.close()
+
+            # but a modified one is refused
+            with open(base, "r+b") as f:
+                f.seek(len(f.read()) - 512)
+                f.write(b"x")
+            os.utime(base, ns=(0, 0))
+            self.assertIsNone(quietly(open_image, overlay, True))
+            self.assertFalse(quietly(copy_image, overlay, flat, OPTIONS))
+
+    def test_compressed(self):
+        for ext in ( ".gz", ".bz2", ".xz" ):
+            with self.subTest(ext):
+                self.check_extract("test.hd" + ext)
+
+if __name__ == "__main__":
+    unittest.main()
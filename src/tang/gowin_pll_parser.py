@@ -1,55 +1,524 @@
 #!/usr/bin/env python3
 
-import sys
+import sys, os, csv, json, glob, math, configparser
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
-params = { }
-with open(sys.argv[1]) as f:
+# numpy is optional and only used to speed up the solver
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# PLL primitive and input clock of each board
+BOARDS = {
+    "nano20k":     { "pll": "rPLL", "inst": "rpll_inst", "fclkin": 27 },
+    "primer25k":   { "pll": "PLLA", "inst": "PLLA_inst", "fclkin": 50 },
+    "console60k":  { "pll": "PLLA", "inst": "PLLA_inst", "fclkin": 50 },
+    "console138k": { "pll": "PLL",  "inst": "PLL_inst",  "fclkin": 50 },
+    "mega138kpro": { "pll": "PLL",  "inst": "PLL_inst",  "fclkin": 50 }
+}
+
+# divider ranges and frequency limits in MHz of the PLL primitives as given
+# in the Gowin clock user guides (UG286 for rPLL, UG306 for GW5A PLL/PLLA)
+LIMITS = {
+    "rPLL": { "idiv": 64, "fbdiv": 64, "odiv": [ 2, 4, 8, 16, 32, 48, 64, 80, 96, 112, 128 ], "sdiv": 128,
+              "pfd": (3, 500), "vco": (500, 1250), "clkout": (3.90625, 625) },
+    "PLL":  { "idiv": 64, "fbdiv": 64, "mdiv": (2, 128), "odiv": 128,
+              "pfd": (19, 800), "vco": (800, 2000), "clkout": (3.125, 1000) }
+}
+LIMITS["PLLA"] = LIMITS["PLL"]
+
+def parse_defparam(line):
+    # return (instance, parameter, value) of a defparam line or None
+    parts = line.strip().rstrip(";").split()
+    if len(parts) == 4 and parts[0].lower() == "defparam" and parts[2] == "=":
+        inst, _, name = parts[1].rpartition(".")
+        value = parts[3].strip("\"")
+
+        if value.lower() == "false": value = False
+        elif value.lower() == "true": value = True
+        elif value.isdigit(): value = int(value)
+        elif not parts[3].startswith("\""): value = None
+
+        if value != None:
+            return inst, name.lower(), value
+
+    return None
+
+def parse_defparams(f):
+    params = { }
     for line in f:
-        parts = line.strip().rstrip(";").split()
-        if len(parts) == 4 and parts[0].lower() == "defparam" and parts[2] == "=":
-            name = parts[1].split(".")[-1].lower()
-            value = parts[3].strip("\"")
+        p = parse_defparam(line)
+        if p: params[p[1]] = p[2]
 
-            if value.lower() == "false": value = False 
-            elif value.lower() == "true": value = True
-            elif value.isdigit(): value = int(value)
-            else: value = None
+    return params
 
-            if value != None:
-                params[name] = value
+def pll_outputs(pll, params):
+    # return the VCO frequency and the list of enabled outputs as
+    # (name, frequency, phase) of a PLL instance
+    fclkin = params["fclkin"]
 
-if not "fclkin" in params:
-    print("No input clock found!")
-    sys.exit(-1)
+    if pll == "rPLL":
+        # the rPLL divider parameters are encoded as divider-1
+        idiv = params.get("idiv_sel", 0) + 1
+        fbdiv = params.get("fbdiv_sel", 0) + 1
+        odiv = params.get("odiv_sel", 8)
+        clkout = fclkin*fbdiv/idiv
+
+        # PSDA_SEL is a binary string, phase shift is in 1/16 cycles
+        psda = int(str(params.get("psda_sel", 0)), 2)
+        outputs = [ ("clkout", clkout, 0.0), ("clkoutp", clkout, 22.5*psda) ]
+        if not params.get("clkoutd_bypass", False):
+            outputs.append( ("clkoutd", clkout/params.get("dyn_sdiv_sel", 2), 0.0) )
+        outputs.append( ("clkoutd3", clkout/3, 0.0) )
+        return clkout*odiv, outputs
+
+    fbdiv = params.get("fbdiv_sel", 1)
+    idiv = params.get("idiv_sel", 1)
+    mdiv = params.get("mdiv_sel", 1)
+    if "mdiv_frac_sel" in params: mdiv = mdiv + params["mdiv_frac_sel"]/8
+    pf = fclkin*fbdiv/idiv*mdiv
 
-fclkin = params["fclkin"]
-    
-if "fbdiv_sel" in params:  fbdiv = params["fbdiv_sel"]
-else:                      fbdiv = 1
+    outputs = [ ]
+    for i in range(8):
+        if "clkout"+str(i)+"_en" in params and params["clkout"+str(i)+"_en"]:
+            odiv = params["odiv"+str(i)+"_sel"]
+            if "odiv"+str(i)+"_frac_sel" in params:
+                odiv = odiv + params["odiv"+str(i)+"_frac_sel"]/8
 
-if "idiv_sel" in params:   idiv = params["idiv_sel"]
-else:                      idiv = 1
+            phase = params.get("clkout"+str(i)+"_pe_coarse", 0)
+            phase = phase + params.get("clkout"+str(i)+"_pe_fine", 0)/8;
+            phase = 360 * phase / odiv
+            outputs.append( ("clkout"+str(i), pf/odiv, phase) )
 
-if "mdiv_sel" in params:   mdiv = params["mdiv_sel"]
-else:                      mdiv = 1
+    return pf, outputs
 
-if "mdiv_frac_sel" in params: mdiv = mdiv + params["mdiv_frac_sel"]/8
+def print_clocks(pll, params, inst=None):
+    if not "fclkin" in params:
+        print("No input clock found!")
+        sys.exit(-1)
 
-print("Input clock:", fclkin, "Mhz")
-pf = fclkin*fbdiv/idiv*mdiv
-print("pf:", pf, "Mhz")
+    pf, outputs = pll_outputs(pll, params)
 
-for i in range(8):
-    if "clkout"+str(i)+"_en" in params and params["clkout"+str(i)+"_en"]:
-        odiv = params["odiv"+str(i)+"_sel"]
-        if "odiv"+str(i)+"_frac_sel" in params:
-            odiv = odiv + params["odiv"+str(i)+"_frac_sel"]/8
-        
-        print("Output"+str(i)+":")
-        print("  Freq:", pf/odiv, "Mhz")
+    print("Primitive:", pll, inst if inst else "")
+    print("Input clock:", params["fclkin"], "Mhz")
+    print("VCO:" if pll == "rPLL" else "pf:", pf, "Mhz")
 
-        phase = params["clkout"+str(i)+"_pe_coarse"]
-        phase = phase + params["clkout"+str(i)+"_pe_fine"]/8;
-        phase = 360 * phase / odiv
+    for name, freq, phase in outputs:
+        print("Output"+(" "+name.upper() if pll == "rPLL" else name[6:])+":")
+        print("  Freq:", freq, "Mhz")
         print("  Phase:", str(phase) + "°")
 
+# ============================== PLL inventory ==============================
+
+def parse_verilog(name):
+    # return all PLL instances of a verilog file. Each instance is a dict
+    # holding the module it's used in, the primitive, the defparams and
+    # the nets connected to its outputs
+    instances = { }
+    outputs = { }
+    module = None
+    inst = None
+
+    with open(name, errors="replace") as f:
+        for line in f:
+            words = line.replace("(", " ( ").split()
+            if not words: continue
+
+            if inst:
+                # .CLKOUT(clkout), until the end of the port list
+                if line.strip().startswith("."):
+                    port, _, net = line.strip()[1:].partition("(")
+                    instances[(module, inst)]["ports"][port.strip().lower()] = net.split(")")[0].strip()
+                elif line.strip().startswith(");"):
+                    inst = None
+            elif words[0] == "module" and len(words) > 1:
+                module = words[1]
+                outputs[module] = set()
+            elif words[0] == "output" and module:
+                # output [7:0] a, b;
+                decl = line.split("output", 1)[1].split("]")[-1].strip().rstrip(";")
+                outputs[module].update(n.strip() for n in decl.split(",") if n.strip())
+            elif words[0] in LIMITS and len(words) > 1 and module:
+                inst = words[1]
+                instances[(module, inst)] = { "file": name, "module": module, "instance": inst,
+                                    "pll": words[0], "params": { }, "ports": { } }
+            else:
+                p = parse_defparam(line)
+                if p and (module, p[0]) in instances:
+                    instances[(module, p[0])]["params"][p[1]] = p[2]
+
+    # an output is in use if it's driving one of the module's outputs
+    for i in instances.values():
+        i["outputs"] = outputs.get(i["module"], set())
+
+    return [ i for i in instances.values() if "fclkin" in i["params"] ]
+
+def parse_ipc(name):
+    # the IP generator's config contains the frequencies and phases
+    # the PLL was generated for
+    config = configparser.ConfigParser()
+    try:
+        config.read(name)
+        return dict(config["Config"]) if "Config" in config else None
+    except configparser.Error:
+        return None
+
+def expected_clocks(instance):
+    # return { output: (frequency, phase, tolerance) } the PLL was made for
+    # as given by the IP generator's config file. Without one nothing is
+    # known about the PLL
+    module = instance["module"].lower()
+    if module.endswith("_mod"): module = module[:-4]
+
+    ipc = parse_ipc(os.path.join(os.path.dirname(instance["file"]), module+".ipc"))
+    if ipc and instance["pll"] != "rPLL":
+        expected = { }
+        for i in range(8):
+            freq = ipc.get("clkout"+str(i)+"expectedfrequency")
+            if freq == None or (i > 0 and ipc.get("enableclkout"+str(i)) != "true"):
+                continue
+            expected["clkout"+str(i)] = ( freq, ipc.get("clkout"+str(i)+"phasestaticvalue", "0"),
+                                          float(ipc.get("clkout"+str(i)+"tolerance", "0")) )
+        return expected
+
+    return { }
+
+def matches(value, expected):
+    # the expected values are rounded to the number of digits given
+    digits = len(expected.partition(".")[2])
+    return round(value, digits) == float(expected)
+
+def board_clocks(board, path):
+    files = sorted(glob.glob(os.path.join(path, "**", "*.v"), recursive=True) +
+                   glob.glob(os.path.join(path, "**", "*.sv"), recursive=True))
+
+    rows = [ ]
+    for name in files:
+        for instance in parse_verilog(name):
+            pll = instance["pll"]
+            params = instance["params"]
+            vco, outputs = pll_outputs(pll, params)
+            expected = expected_clocks(instance)
+
+            for output, freq, phase in outputs:
+                # skip rPLL outputs which are not connected to anything
+                if pll == "rPLL" and not instance["ports"].get(output) in instance["outputs"]:
+                    continue
+
+                row = { "board": board, "file": os.path.relpath(name, path), "module": instance["module"],
+                        "instance": instance["instance"], "pll": pll, "device": params.get("device"),
+                        "net": instance["ports"].get(output), "output": output, "fclkin": params["fclkin"],
+                        "vco": round(vco, 6), "freq": round(freq, 6), "phase": round(phase, 3),
+                        "expected_freq": None, "expected_phase": None, "deviation": None, "exact": None,
+                        "phase_exact": None }
+
+                if output in expected:
+                    efreq, ephase, tolerance = expected[output]
+                    row["expected_freq"] = float(efreq)
+                    row["deviation"] = round(100*(freq-float(efreq))/float(efreq), 4)
+                    row["exact"] = matches(freq, efreq)
+
+                    # phases are often tuned by hand after generating a
+                    # PLL, so they are only reported
+                    if ephase != None:
+                        row["expected_phase"] = float(ephase)
+                        row["phase_exact"] = matches(phase, ephase)
+
+                rows.append(row)
+
+    return rows
+
+def inventory(path, workers=None):
+    # every board lives in its own directory next to this script
+    boards = sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
+
+    # parsing is CPU bound, so the boards are scanned in separate processes
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(board_clocks, boards, [ os.path.join(path, b) for b in boards ])
+        return [ row for rows in results for row in rows ]
+
+def print_inventory(rows, fmt):
+    if fmt == "json":
+        json.dump(rows, sys.stdout, indent=2)
+        print()
+        return
+
+    columns = [ "board", "file", "module", "instance", "pll", "device", "net", "output", "fclkin", "vco",
+                "freq", "phase", "expected_freq", "expected_phase", "deviation", "exact", "phase_exact" ]
+    writer = csv.DictWriter(sys.stdout, columns, lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(rows)
+
+# ============================== PLL solver ==============================
+
+@lru_cache(maxsize=None)
+def vco_candidates(pll, fclkin):
+    # All valid (vco, idiv, fbdiv, mdiv) settings of a GW5A PLL. MDIV is
+    # given in 1/8 steps. Of all settings leading to the same VCO frequency
+    # only the one with the smallest dividers is kept.
+    lim = LIMITS[pll]
+    mdiv_min, mdiv_max = lim["mdiv"]
+
+    if np:
+        idiv = np.arange(1, lim["idiv"]+1)
+        idiv = idiv[(fclkin/idiv >= lim["pfd"][0]) & (fclkin/idiv <= lim["pfd"][1])]
+        fbdiv = np.arange(1, lim["fbdiv"]+1)
+        mdiv = np.arange(8*mdiv_min, 8*mdiv_max+1)
+
+        i, fb, m = np.meshgrid(idiv, fbdiv, mdiv, indexing="ij")
+        vco = fclkin * fb * m / (8.0 * i)
+        valid = (vco >= lim["vco"][0]) & (vco <= lim["vco"][1])
+        i, fb, m, vco = i[valid], fb[valid], m[valid], vco[valid]
+
+        # sort by vco, then by dividers and keep the first of each vco
+        order = np.lexsort((m, fb, i, np.round(vco, 9)))
+        i, fb, m, vco = i[order], fb[order], m[order], vco[order]
+        first = np.concatenate(([True], np.diff(np.round(vco, 9)) != 0))
+        return (vco[first], i[first], fb[first], m[first])
+
+    cands = { }
+    for i in range(1, lim["idiv"]+1):
+        if fclkin/i < lim["pfd"][0] or fclkin/i > lim["pfd"][1]: continue
+        for fb in range(1, lim["fbdiv"]+1):
+            # range of mdiv keeping the vco within its limits
+            step = fclkin * fb / (8.0 * i)
+            lo = max(8*mdiv_min, math.ceil(lim["vco"][0] / step - 1e-9))
+            hi = min(8*mdiv_max, math.floor(lim["vco"][1] / step + 1e-9))
+            for m in range(lo, hi+1):
+                key = round(step*m, 9)
+                if not key in cands or (i, fb, m) < cands[key][1:]:
+                    cands[key] = (step*m, i, fb, m)
+
+    c = sorted(cands.values())
+    return ([x[0] for x in c], [x[1] for x in c], [x[2] for x in c], [x[3] for x in c])
+
+def best_odiv(vco, target, frac, lim):
+    # return the output divider (in 1/8 steps) getting closest to target
+    # while keeping the output within its limits or None if there's none
+    step = 1 if frac else 8
+    lo = max(8, math.ceil(8*vco/lim["clkout"][1]/step - 1e-9)*step)
+    hi = min(8*lim["odiv"], math.floor(8*vco/lim["clkout"][0]/step + 1e-9)*step)
+    if lo > hi: return None
+
+    best = None
+    for odiv in [ math.floor(8*vco/target/step)*step, math.ceil(8*vco/target/step)*step ]:
+        odiv = min(max(odiv, lo), hi)
+        err = abs(8*vco/odiv - target) / target
+        if best == None or err < best[1]: best = (odiv, err)
+    return best
+
+def solve_gw5a(pll, fclkin, targets, count):
+    lim = LIMITS[pll]
+    vco, idiv, fbdiv, mdiv = vco_candidates(pll, fclkin)
+
+    if np:
+        # evaluate all vco candidates for all targets at once, the same
+        # way best_odiv() does
+        err = np.zeros(len(vco))
+        valid = np.ones(len(vco), dtype=bool)
+        odivs = [ ]
+        for k, t in enumerate(targets):
+            step = 1 if k == 0 else 8     # only ODIV0 has a fractional part
+            olo = np.maximum(8, np.ceil(8*vco/lim["clkout"][1]/step - 1e-9)*step)
+            ohi = np.minimum(8*lim["odiv"], np.floor(8*vco/lim["clkout"][0]/step + 1e-9)*step)
+            valid &= olo <= ohi
+
+            lo = np.clip(np.floor(8*vco/t/step)*step, olo, ohi)
+            hi = np.clip(np.ceil(8*vco/t/step)*step, olo, ohi)
+            elo = np.abs(8*vco/lo - t) / t
+            ehi = np.abs(8*vco/hi - t) / t
+            odivs.append(np.where(elo <= ehi, lo, hi).astype(int))
+            err = np.maximum(err, np.minimum(elo, ehi))
+
+        # prefer exact matches, then high PFD (small IDIV) and high VCO for low jitter
+        order = np.lexsort((-vco, idiv, np.round(err, 12)))
+        order = order[valid[order]][:count]
+        return [ (float(err[n]), float(vco[n]), int(idiv[n]), int(fbdiv[n]), int(mdiv[n]),
+                  [ int(o[n]) for o in odivs ]) for n in order ]
+
+    solutions = [ ]
+    for n in range(len(vco)):
+        best = [ best_odiv(vco[n], t, k == 0, lim) for k, t in enumerate(targets) ]
+        if None in best: continue
+
+        err = max(e for odiv, e in best)
+        solutions.append( (round(err, 12), idiv[n], -vco[n], n, [ odiv for odiv, e in best ]) )
+
+    solutions.sort()
+    return [ (err, -v, idiv[n], fbdiv[n], mdiv[n], odivs) for err, _, v, n, odivs in solutions[:count] ]
+
+def solve_rpll(fclkin, targets, count):
+    # rPLL: CLKOUT = FCLKIN*FBDIV/IDIV with VCO = CLKOUT*ODIV, the second
+    # output is CLKOUTD = CLKOUT/SDIV. The search space is small.
+    lim = LIMITS["rPLL"]
+    solutions = [ ]
+    for idiv in range(1, lim["idiv"]+1):
+        if fclkin/idiv < lim["pfd"][0] or fclkin/idiv > lim["pfd"][1]: continue
+        for fbdiv in range(1, lim["fbdiv"]+1):
+            clkout = fclkin * fbdiv / idiv
+            if clkout < lim["clkout"][0] or clkout > lim["clkout"][1]: continue
+
+            # any valid ODIV will do, the highest VCO has the least jitter
+            odiv = [ o for o in lim["odiv"] if clkout*o >= lim["vco"][0] and clkout*o <= lim["vco"][1] ]
+            if not odiv: continue
+
+            err = abs(clkout - targets[0]) / targets[0]
+            sdiv = None
+            if len(targets) > 1:
+                sdiv = min(range(2, lim["sdiv"]+1, 2), key=lambda s: abs(clkout/s - targets[1]))
+                err = max(err, abs(clkout/sdiv - targets[1]) / targets[1])
+
+            solutions.append( (round(err, 12), idiv, -clkout*odiv[-1], fbdiv, odiv[-1], sdiv) )
+
+    solutions.sort()
+    return [ (err, -v, idiv, fbdiv, odiv, sdiv) for err, idiv, v, fbdiv, odiv, sdiv in solutions[:count] ]
+
+@lru_cache(maxsize=None)
+def solve(board, fclkin, targets, phases, tolerance, count=10):
+    # return the best settings for the given targets, memoized per board
+    # and target. Tolerance is in percent
+    pll = BOARDS[board]["pll"]
+    if pll == "rPLL":
+        if len(targets) > 2:
+            print("Error, the rPLL has only two independent outputs")
+            return [ ]
+        solutions = solve_rpll(fclkin, targets, count)
+    else:
+        if len(targets) > 7:
+            print("Error, the PLL has only seven outputs")
+            return [ ]
+        solutions = solve_gw5a(pll, fclkin, targets, count)
+
+    return [ s for s in solutions if 100*s[0] <= tolerance ]
+
+def defparams(board, fclkin, solution, targets, phases):
+    inst = BOARDS[board]["inst"]
+    lines = [ "defparam "+inst+".FCLKIN = \""+str(fclkin)+"\";" ]
+
+    if BOARDS[board]["pll"] == "rPLL":
+        err, vco, idiv, fbdiv, odiv, sdiv = solution
+        lines.append("defparam "+inst+".IDIV_SEL = "+str(idiv-1)+";")
+        lines.append("defparam "+inst+".FBDIV_SEL = "+str(fbdiv-1)+";")
+        lines.append("defparam "+inst+".ODIV_SEL = "+str(odiv)+";")
+        if sdiv: lines.append("defparam "+inst+".DYN_SDIV_SEL = "+str(sdiv)+";")
+        if phases[0]:
+            # CLKOUTP is shifted in steps of 22.5 degrees
+            lines.append("defparam "+inst+".PSDA_SEL = \""+format(round(phases[0]/22.5) % 16, "04b")+"\";")
+        return lines
+
+    err, vco, idiv, fbdiv, mdiv, odivs = solution
+    lines.append("defparam "+inst+".IDIV_SEL = "+str(idiv)+";")
+    lines.append("defparam "+inst+".FBDIV_SEL = "+str(fbdiv)+";")
+    lines.append("defparam "+inst+".MDIV_SEL = "+str(mdiv//8)+";")
+    lines.append("defparam "+inst+".MDIV_FRAC_SEL = "+str(mdiv%8)+";")
+    for k in range(len(odivs)):
+        lines.append("defparam "+inst+".ODIV"+str(k)+"_SEL = "+str(odivs[k]//8)+";")
+        if k == 0: lines.append("defparam "+inst+".ODIV0_FRAC_SEL = "+str(odivs[k]%8)+";")
+        lines.append("defparam "+inst+".CLKOUT"+str(k)+"_EN = \"TRUE\";")
+
+        # phase shift in 1/8 VCO cycles
+        steps = round(phases[k]/360 * odivs[k]) % odivs[k]
+        lines.append("defparam "+inst+".CLKOUT"+str(k)+"_PE_COARSE = "+str(steps//8)+";")
+        lines.append("defparam "+inst+".CLKOUT"+str(k)+"_PE_FINE = "+str(steps%8)+";")
+
+    return lines
+
+def print_solutions(board, fclkin, targets, phases, tolerance):
+    print("== "+board+" ("+BOARDS[board]["pll"]+", "+str(fclkin)+" MHz input) ==")
+    solutions = solve(board, fclkin, targets, phases, tolerance)
+    if not solutions:
+        print("No solution within", str(tolerance)+"%")
+        return False
+
+    for n, s in enumerate(solutions):
+        if BOARDS[board]["pll"] == "rPLL":
+            err, vco, idiv, fbdiv, odiv, sdiv = s
+            clkout = fclkin*fbdiv/idiv
+            outs = [ clkout ] + ([ clkout/sdiv ] if sdiv else [ ])
+            desc = "IDIV {} FBDIV {} ODIV {}".format(idiv, fbdiv, odiv) + (" SDIV {}".format(sdiv) if sdiv else "")
+        else:
+            err, vco, idiv, fbdiv, mdiv, odivs = s
+            outs = [ 8*vco/o for o in odivs ]
+            desc = "IDIV {} FBDIV {} MDIV {:g} ODIV {}".format(idiv, fbdiv, mdiv/8, " ".join("{:g}".format(o/8) for o in odivs))
+
+        print("#{:<2} {:<5} VCO {:8.3f} MHz  {}  ->  {}".format(n+1, "exact" if err == 0 else "{:.3f}%".format(100*err),
+              vco, desc, " ".join("{:.4f}".format(o) for o in outs)))
+
+    print("Best solution:")
+    for line in defparams(board, fclkin, solutions[0], targets, phases):
+        print("  "+line)
+
+    return True
+
+def usage(msg=None):
+    if msg: print("Error:", msg)
+    print("Usage: gowin_pll_parser.py <pll.v>")
+    print("       gowin_pll_parser.py -solve [options] <MHz>[@<degrees>] [<MHz>[@<degrees>] ...]")
+    print("       gowin_pll_parser.py -inventory [-format=csv|json] [<dir>]")
+    print("Options:")
+    print("  -board=<board>        one of", ", ".join(BOARDS), "or all (default)")
+    print("  -fclkin=<MHz>         input clock, defaults to the board's clock")
+    print("  -tolerance=<percent>  maximum deviation of any output, default 0.2")
+    print("  -format=<format>      inventory output format, csv (default) or json")
+    sys.exit(-1)
+
+def main():
+    if len(sys.argv) < 2: usage("No arguments given")
+
+    if sys.argv[1] == "-inventory":
+        fmt = "csv"
+        path = os.path.dirname(os.path.abspath(__file__))
+        for arg in sys.argv[2:]:
+            if arg.startswith("-format="): fmt = arg[8:]
+            elif arg.startswith("-"): usage("Unknown option "+arg)
+            else: path = arg
+
+        if not fmt in [ "csv", "json" ]: usage("Unknown format "+fmt)
+
+        # exit with an error if any frequency differs from what it's expected
+        # to be. Clocks without known expectations aren't checked
+        rows = inventory(path)
+        print_inventory(rows, fmt)
+        sys.exit(1 if any(row["exact"] == False for row in rows) else 0)
+
+    if sys.argv[1] != "-solve":
+        instances = parse_verilog(sys.argv[1])
+        if not instances:
+            # a file with defparams only, the rPLL has a single ODIV
+            with open(sys.argv[1]) as f:
+                params = parse_defparams(f)
+            instances = [ { "pll": "rPLL" if "odiv_sel" in params else "PLL", "instance": None, "params": params } ]
+
+        for i in instances:
+            print_clocks(i["pll"], i["params"], i["instance"])
+        return
+
+    options = { "board": "all", "fclkin": None, "tolerance": "0.2" }
+    targets = [ ]
+    phases = [ ]
+    for arg in sys.argv[2:]:
+        if arg.startswith("-"):
+            name, _, value = arg[1:].partition("=")
+            if not name in options or not value: usage("Unknown option "+arg)
+            options[name] = value
+        else:
+            freq, _, phase = arg.partition("@")
+            try:
+                targets.append(float(freq))
+                phases.append(float(phase) if phase else 0.0)
+            except ValueError:
+                usage("Invalid target "+arg)
+
+    if not targets: usage("No target frequency given")
+
+    boards = list(BOARDS) if options["board"] == "all" else [ options["board"] ]
+    for board in boards:
+        if not board in BOARDS: usage("Unknown board "+board)
+        fclkin = float(options["fclkin"]) if options["fclkin"] else BOARDS[board]["fclkin"]
+        if fclkin == int(fclkin): fclkin = int(fclkin)
+        print_solutions(board, fclkin, tuple(targets), tuple(phases), float(options["tolerance"]))
+
+if __name__ == "__main__":
+    main()
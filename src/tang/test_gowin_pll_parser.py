@@ -0,0 +1,80 @@
+# test_gowin_pll_parser.py - check the PLL solver against the Gowin limits
+#
+# Run with "python3 -m unittest" from within this directory.
+
+import unittest
+
+import gowin_pll_parser as pll
+
+# incl. some beyond the output limits which can only be approximated
+TARGETS = [ (100,), (33.75,), (85.909, 42.954), (3.2,), (900,), (128, 64, 32, 16), (1200,), (100, 2.5) ]
+
+class Solver(unittest.TestCase):
+    def tearDown(self):
+        pll.vco_candidates.cache_clear()
+        pll.solve.cache_clear()
+
+    def solve_gw5a(self, targets, numpy):
+        # the numpy and the pure python path are both checked
+        np = pll.np
+        if not numpy: pll.np = None
+        try:
+            pll.vco_candidates.cache_clear()
+            return pll.solve_gw5a("PLL", 50, targets, 10)
+        finally:
+            pll.np = np
+
+    def check_gw5a(self, numpy):
+        lim = pll.LIMITS["PLL"]
+        for targets in TARGETS:
+            with self.subTest(targets):
+                solutions = self.solve_gw5a(targets, numpy)
+                self.assertTrue(solutions)
+                for err, vco, idiv, fbdiv, mdiv, odivs in solutions:
+                    self.assertTrue(lim["pfd"][0] <= 50/idiv <= lim["pfd"][1])
+                    self.assertTrue(lim["vco"][0] <= vco <= lim["vco"][1])
+                    self.assertAlmostEqual(vco, 50*fbdiv*mdiv/(8*idiv))
+                    self.assertEqual(len(odivs), len(targets))
+                    for odiv in odivs:
+                        self.assertTrue(8 <= odiv <= 8*lim["odiv"])
+                        self.assertTrue(lim["clkout"][0] <= 8*vco/odiv <= lim["clkout"][1])
+
+                    # only ODIV0 has a fractional part
+                    self.assertFalse(any(odiv % 8 for odiv in odivs[1:]))
+
+    def test_gw5a(self):
+        self.check_gw5a(False)
+
+    @unittest.skipUnless(pll.np, "numpy not installed")
+    def test_gw5a_numpy(self):
+        self.check_gw5a(True)
+        for targets in TARGETS:
+            with self.subTest(targets):
+                fast = self.solve_gw5a(targets, True)
+                slow = self.solve_gw5a(targets, False)
+                self.assertEqual([ s[1:] for s in fast ], [ s[1:] for s in slow ])
+                for a, b in zip(fast, slow):
+                    self.assertAlmostEqual(a[0], b[0])
+
+    def test_out_of_range(self):
+        # the closest settings within the limits are too far off
+        self.assertEqual(pll.solve("console138k", 50, (1200,), (0,), 1), [ ])
+        self.assertEqual(pll.solve("console138k", 50, (100, 2.5), (0, 0), 1), [ ])
+        self.assertEqual(pll.solve("nano20k", 27, (700,), (0,), 1), [ ])
+
+    def test_rpll(self):
+        lim = pll.LIMITS["rPLL"]
+        for targets in ( (27,), (71.59,), (85.909, 42.954), (200, 50), (700,) ):
+            with self.subTest(targets):
+                solutions = pll.solve_rpll(27, targets, 10)
+                self.assertTrue(solutions)
+                for err, vco, idiv, fbdiv, odiv, sdiv in solutions:
+                    clkout = 27*fbdiv/idiv
+                    self.assertTrue(lim["pfd"][0] <= 27/idiv <= lim["pfd"][1])
+                    self.assertTrue(lim["clkout"][0] <= clkout <= lim["clkout"][1])
+                    self.assertTrue(lim["vco"][0] <= vco <= lim["vco"][1])
+                    self.assertAlmostEqual(vco, clkout*odiv)
+                    self.assertIn(odiv, lim["odiv"])
+
+if __name__ == "__main__":
+    unittest.main()